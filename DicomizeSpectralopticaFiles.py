@@ -28,16 +28,24 @@
 
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from enum import Enum
 from io import BytesIO
 import PIL
+import argparse
 import datetime
+import hashlib
+import numpy as np
 import pydicom
-from pydicom.valuerep import VR
-import glob
 import json
 import requests
 import os
+import time
 
 
 class Filter(Enum):
@@ -46,199 +54,814 @@ class Filter(Enum):
     IR = 800
 
 
-orthanc_server = "http://localhost:8042"
-
-path_to_project = "data/sample-same_sized"
-SOURCE = f"{path_to_project}/*.jpg"
-calib_file = f"{path_to_project}/spectral.json"
-images = sorted(glob.glob(SOURCE))
-i = 0
-
-
-with open(calib_file, "rb") as f:
-    spectral_dict = json.load(f)
-
-study_uid = pydicom.uid.generate_uid()
-series_uid = pydicom.uid.generate_uid()
-
-if "thumbnails" in spectral_dict and spectral_dict["thumbnails"]:
-    thumbnails_width = spectral_dict["thumbnails_width"]
-    thumbnails_height = spectral_dict["thumbnails_height"]
-
-now = datetime.datetime.now()
-
-for image in spectral_dict["spectral"]:
-    image_name = image["name"]
-    image_path = f"{path_to_project}/{image_name}"
-    camera = os.path.basename(image_path)
-    print(camera)
-    ds = pydicom.dataset.Dataset()
-    ds.PatientName = "Tombe^Egyptienne^MS"
-    ds.PatientID = "MS36587845"
-    ds.PatientBirthDate = "20200914"
-    ds.PatientSex = "O"
-
-    ds.StudyDate = now.strftime("%Y%m%d")
-    ds.StudyTime = now.strftime("%H%M%S")
+DEFAULT_ORTHANC_URL = os.environ.get("ORTHANC_SERVER", "http://localhost:8042")
+CALIBRATION_FILE = "spectral.json"
+
+# --encoding -> transfer syntax of the pixel data. JPEG files are encapsulated
+# as is in JPEG baseline, other 8-bit images are compressed to it; high bit
+# depths need one of the lossless encodings, which also keep 8-bit data intact.
+TRANSFER_SYNTAXES = {
+    "jpeg": pydicom.uid.JPEGBaseline8Bit,
+    "rle": pydicom.uid.RLELossless,
+    "jpeg-ls": pydicom.uid.JPEGLSLossless,
+    "jpeg2000": pydicom.uid.JPEG2000Lossless,
+}
+
+# private tag holding the digest of the files an instance was encoded from,
+# which tells whether an instance found in Orthanc is the one of a file
+PRIVATE_CREATOR = "Spectraloptica"
+PRIVATE_GROUP = 0x0011
+SOURCE_DIGEST_ELEMENT = 0x01
+SOURCE_DIGEST_TAG = "0011-1001"
+
+# delay before the first retry of a failed upload, doubled at each attempt
+RETRY_BACKOFF = 1.0
+UPLOAD_TIMEOUT = 300
+
+
+def load_project(path) -> tuple:
+    """
+    Return the (directory, calibration) of a project, given either its
+    directory or its spectral.json file.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, CALIBRATION_FILE)
+    with open(path, "rb") as f:
+        spectral_dict = json.load(f)
+    return os.path.dirname(os.path.abspath(path)), spectral_dict
+
+
+def get_metadata(project_dir, spectral_dict) -> dict:
+    """
+    DICOM attributes shared by all the instances of a project, by keyword.
+
+    They are read from the "metadata" object of spectral.json, and default to
+    the name of the project directory for the patient and the study.
+    """
+    project = os.path.basename(project_dir)
+    metadata = {
+        "PatientName": project,
+        "PatientID": project,
+        "PatientSex": "O",
+        "StudyDescription": project,
+        "SeriesDescription": "Spectral acquisition",
+        "Laterality": "L",
+    }
+    metadata.update(spectral_dict.get("metadata", {}))
+    for keyword in metadata:
+        if not pydicom.datadict.dictionary_has_tag(keyword):
+            raise ValueError(f"Unknown DICOM keyword in {project}: {keyword}")
+    return metadata
+
+
+def get_identity(project_dir, spectral_dict) -> str:
+    """
+    Identity of a project, from which its UIDs derive: the StudyInstanceUID of
+    the "metadata" object of spectral.json if it has one, otherwise a digest of
+    the name of the project and of its calibration.
+
+    It only depends on the content of the project, so that ingesting it again,
+    even without its ledger or from a copy, addresses the same instances.
+    """
+    metadata = spectral_dict.get("metadata", {})
+    if "StudyInstanceUID" in metadata:
+        return metadata["StudyInstanceUID"]
+    # the descriptive attributes of the metadata may be corrected between two
+    # ingests without the project becoming another one
+    calibration = {k: v for k, v in spectral_dict.items() if k != "metadata"}
+    digest = hashlib.sha256(os.path.basename(project_dir).encode())
+    digest.update(json.dumps(calibration, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class IngestLedger:
+    """
+    Record of the files of a project already stored in Orthanc, kept next to
+    its spectral.json so that an interrupted ingest resumes where it stopped.
+
+    Files are identified by the SHA-256 of their content, which is only
+    computed again when their size or modification time changes.
+    The ledger is a cache: without it, the instances of a project are found
+    again in Orthanc by their UIDs, which derive from get_identity().
+    """
+
+    FILE_NAME = ".spectraloptica-ingest.json"
+
+    def __init__(self, project_dir):
+        self.path = os.path.join(project_dir, self.FILE_NAME)
+        try:
+            with open(self.path) as f:
+                ledger = json.load(f)
+        except FileNotFoundError:
+            ledger = {}
+        # StudyDate and StudyTime of the first ingest of the project
+        self.study = ledger.get("study", {})
+        # file name -> sha256, size, mtime, SOPInstanceUID and Orthanc ID
+        self.files = ledger.get("files", {})
+        self.read_only = False
+
+    def hash(self, path, name) -> dict:
+        stat = os.stat(path)
+        entry = self.files.get(name)
+        if entry and (entry["size"], entry["mtime"]) == (stat.st_size, stat.st_mtime):
+            sha256 = entry["sha256"]
+        else:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            sha256 = digest.hexdigest()
+        return {"sha256": sha256, "size": stat.st_size, "mtime": stat.st_mtime}
+
+    def record(self, job, uuid):
+        # the files of the frames of a multi-frame instance share its entry
+        for source in job.get("frames", [job]):
+            self.files[source["name"]] = {
+                **source["hash"],
+                "encoding": job["encoding"],
+                "SOPInstanceUID": job["sop_instance_uid"],
+                "ID": uuid,
+            }
+        self.save()
+
+    def save(self):
+        if self.read_only:
+            return
+        # write aside then rename, so that an interruption never corrupts it
+        temporary = f"{self.path}.tmp"
+        try:
+            with open(temporary, "w") as f:
+                json.dump({"study": self.study, "files": self.files}, f, indent=2)
+            os.replace(temporary, self.path)
+        except OSError as error:
+            # only a cache of the hashes: the stored instances are still found
+            # by their UIDs and digests at the next ingest
+            print(f"{self.path}: not saved, {error}")
+            self.read_only = True
+
+
+def create_jobs(
+    project_dir, spectral_dict, ledger, encoding="jpeg", multiframe=False
+) -> list:
+    """
+    List the images of a project, with everything needed to encode them. In
+    `multiframe` mode, the spectral images are the frames of a single instance.
+    """
+    # UIDs derive from the identity of the project and from the file names, so
+    # that ingesting a project again addresses the same study, series and
+    # instances
+    project = os.path.basename(project_dir)
+    identity = get_identity(project_dir, spectral_dict)
+    study_uid = spectral_dict.get("metadata", {}).get("StudyInstanceUID")
+    if study_uid is None:
+        study_uid = pydicom.uid.generate_uid(entropy_srcs=["study", identity])
+    series_uid = pydicom.uid.generate_uid(entropy_srcs=["series", identity])
+
+    thumbnail_size = None
+    if "thumbnails" in spectral_dict and spectral_dict["thumbnails"]:
+        thumbnail_size = (
+            spectral_dict["thumbnails_width"],
+            spectral_dict["thumbnails_height"],
+        )
 
-    ds.ImageType = ["ORIGINAL", "PRIMARY", "", "WAVELENGTH"]
-    ds.UserContentLabel = camera
-    ds.Laterality = "L"
-    ds.LossyImageCompression = "01"
-    ds.Modality = "XC"  # External-camera photography
-    ds.SOPClassUID = pydicom.uid.VLPhotographicImageStorage
-    ds.SOPInstanceUID = pydicom.uid.generate_uid()
-    ds.SeriesInstanceUID = series_uid
-    ds.StudyInstanceUID = study_uid
-    ds.PixelSpacing = spectral_dict["PixelRatio"]
+    if not ledger.study:
+        now = datetime.datetime.now()
+        ledger.study = {
+            "StudyDate": now.strftime("%Y%m%d"),
+            "StudyTime": now.strftime("%H%M%S"),
+        }
+    common = {
+        "project_dir": project_dir,
+        "project": project,
+        "metadata": {**get_metadata(project_dir, spectral_dict), **ledger.study},
+        "study_uid": study_uid,
+        "series_uid": series_uid,
+        "pixel_ratio": spectral_dict["PixelRatio"],
+        # significant bits of high bit depth images, e.g. 12 for most sensors,
+        # from which the viewers scale them to 8 bits by default
+        "bits_stored": spectral_dict.get("BitsStored"),
+        "thumbnail_size": thumbnail_size,
+        "encoding": encoding,
+    }
+
+    images = [
+        # spectral images are labelled by file name
+        (
+            image,
+            os.path.basename(image["name"]),
+            ["ORIGINAL", "PRIMARY", "", "WAVELENGTH"],
+        )
+        for image in spectral_dict["spectral"]
+    ] + [
+        (image, image_label, ["ORIGINAL", "PRIMARY"])
+        for image_label, image in spectral_dict.get("individualImages", {}).items()
+    ]
+    jobs = []
+    for image, label, image_type in images:
+        image_path = os.path.join(project_dir, image["name"])
+        jobs.append(
+            {
+                **common,
+                "image": image,
+                "name": image["name"],
+                "image_path": image_path,
+                "hash": ledger.hash(image_path, image["name"]),
+                "sop_instance_uid": pydicom.uid.generate_uid(
+                    entropy_srcs=["instance", identity, image["name"]]
+                ),
+                "label": label,
+                "image_type": image_type,
+                "instance_number": len(jobs) + 1,
+            }
+        )
+    spectral_count = len(spectral_dict["spectral"])
+    if multiframe and spectral_count:
+        frames, individual = jobs[:spectral_count], jobs[spectral_count:]
+        jobs = [
+            {
+                **common,
+                "frames": frames,
+                "name": CALIBRATION_FILE,
+                "sop_instance_uid": pydicom.uid.generate_uid(
+                    entropy_srcs=["instance", identity, "frames"]
+                ),
+                "label": "Spectral images",
+                "image_type": ["ORIGINAL", "PRIMARY", "", "WAVELENGTH"],
+                "instance_number": 1,
+            }
+        ]
+        for job in individual:
+            job["instance_number"] = len(jobs) + 1
+            jobs.append(job)
+    return jobs
+
+
+def source_digest(job) -> str:
+    """Digest of the files of an instance and of their encoding."""
+    digest = hashlib.sha256(job["encoding"].encode())
+    for source in job.get("frames", [job]):
+        digest.update(source["hash"]["sha256"].encode())
+    return digest.hexdigest()
+
+
+def image_to_array(im) -> np.ndarray:
+    """Read an image as a (rows, columns) or (rows, columns, 3) array."""
+    if im.mode in ("I;16", "I;16L", "I;16B", "I;16N"):
+        return np.asarray(im).astype(np.uint16)
+    if im.mode == "I":
+        # 16-bit PNG and some TIFF are read as 32-bit integers
+        array = np.asarray(im)
+        if array.min() < 0 or array.max() > 0xFFFF:
+            raise ValueError("Only unsigned images of up to 16 bits are supported")
+        return array.astype(np.uint16)
+    if im.mode not in ("L", "RGB"):
+        im = im.convert("L" if im.mode in ("1", "LA") else "RGB")
+    return np.asarray(im)
+
+
+def to_8bit(array, bits_stored) -> np.ndarray:
+    """Scale the significant bits of an image to 8 bits, e.g. for its thumbnail."""
+    if array.dtype == np.uint8:
+        return array
+    return (array >> max(bits_stored - 8, 0)).clip(0, 255).astype(np.uint8)
+
+
+def encapsulate_jpeg(ds, frames, size, color=True):
+    """Store JPEG files as the frames of an instance, without decoding them."""
+    # a fragment per frame, which Orthanc serves as /content/7fe0-0010/<n + 1>
+    ds.PixelData = pydicom.encaps.encapsulate(frames)
+    ds["PixelData"].VR = "OB"  # always for encapsulated pixel data
+    ds.Columns, ds.Rows = size
+    if color:
+        ds.PlanarConfiguration = 0
+    ds.SamplesPerPixel = 3 if color else 1
+    ds.BitsAllocated = 8
+    ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.PhotometricInterpretation = "YBR_FULL_422" if color else "MONOCHROME2"
+    ds.file_meta = pydicom.dataset.FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = pydicom.uid.JPEGBaseline8Bit
+
+
+def set_pixel_data(ds, frames, encoding, bits_stored=None):
+    """Compress images of the same size as the frames of an instance."""
+    if any(
+        frame.shape != frames[0].shape or frame.dtype != frames[0].dtype
+        for frame in frames
+    ):
+        raise ValueError("The frames of an instance must have the same size and mode")
+    array = frames[0] if len(frames) == 1 else np.stack(frames)
+    if array.dtype == np.uint8:
+        bits_stored = 8
+    elif encoding == "jpeg":
+        raise ValueError("Images of more than 8 bits need a lossless --encoding")
+    else:
+        bits_stored = bits_stored or 16
+        if int(array.max()) >> bits_stored:
+            raise ValueError(f"The image has more than {bits_stored} significant bits")
+    color = frames[0].ndim == 3
+    ds.Rows, ds.Columns = frames[0].shape[:2]
+    ds.SamplesPerPixel = 3 if color else 1
+    if color:
+        ds.PlanarConfiguration = 0
+    ds.BitsAllocated = array.itemsize * 8
+    ds.BitsStored = bits_stored
+    ds.HighBit = bits_stored - 1
+    ds.PixelRepresentation = 0
+    if not color:
+        ds.PhotometricInterpretation = "MONOCHROME2"
+    elif encoding == "jpeg":
+        ds.PhotometricInterpretation = "YBR_FULL_422"
+    elif encoding == "jpeg2000":
+        # lossless JPEG 2000 decorrelates the color components reversibly
+        ds.PhotometricInterpretation = "YBR_RCT"
+    else:
+        ds.PhotometricInterpretation = "RGB"
+    if encoding != "jpeg":
+        ds.LossyImageCompression = "00"
+    ds.file_meta = pydicom.dataset.FileMetaDataset()
+    if encoding == "jpeg":
+        fragments = []
+        for frame in frames:
+            buffer = BytesIO()
+            PIL.Image.fromarray(frame).save(buffer, format="JPEG", quality=95)
+            fragments.append(buffer.getvalue())
+        ds.PixelData = pydicom.encaps.encapsulate(fragments)
+        ds["PixelData"].VR = "OB"
+        ds.file_meta.TransferSyntaxUID = pydicom.uid.JPEGBaseline8Bit
+    else:
+        # the UIDs of the instances derive from their files, see create_jobs()
+        ds.compress(TRANSFER_SYNTAXES[encoding], array, generate_instance_uid=False)
+
+
+def set_frame_functional_groups(ds, frames):
+    """Describe the band of every frame of a multi-frame instance."""
+    ds.NumberOfFrames = len(frames)
+    items = []
+    for frame in frames:
+        item = pydicom.dataset.Dataset()
+        content = pydicom.dataset.Dataset()
+        content.FrameLabel = frame["label"]
+        item.FrameContentSequence = [content]
+        set_wavelengths(item, frame["image"])
+        items.append(item)
+    ds.PerFrameFunctionalGroupsSequence = items
+
+
+def set_wavelengths(ds, image):
     ds.ImagePathFilterPassThroughWavelength = Filter[image["filter"]["type"]].value
     try:
         ds.IlluminationWaveLength = image["wavelength"]["value"]
     except Exception:
         pass
-    ds.AccessionNumber = None
-    ds.ReferringPhysicianName = None
-    ds.SeriesNumber = None
-    ds.StudyID = None
-    ds.StudyDescription = "MS Tombe Egyptienne"
-    ds.SeriesDescription = "Acquisition de la parois"
-    ds.Manufacturer = None
-    ds.AcquisitionContextSequence = None
-    ds.InstanceNumber = i + 1
-
-    # Basic encapsulation of color JPEG
-    # httpss://pydicom.github.io/pydicom/stable/tutorials/pixel_data/compressing.html
-
-    with open(image_path, "rb") as f:
-        frames = [f.read()]
-        ds.PixelData = pydicom.encaps.encapsulate(frames)
-
-    with PIL.Image.open(image_path) as im:
-        ds.Rows = im.size[1]
-        ds.Columns = im.size[0]
-        thumbnail_buffer = None
-        if "thumbnails" in spectral_dict and spectral_dict["thumbnails"]:
-            im.thumbnail((thumbnails_width, thumbnails_height))
-            thumbnail_buffer = BytesIO()
-            im.save(thumbnail_buffer, format="JPEG")
-
-    ds.PlanarConfiguration = 0
-    ds.SamplesPerPixel = 3
-    ds.BitsAllocated = 8
-    ds.BitsStored = 8
-    ds.HighBit = 7
-    ds.PixelRepresentation = 0
-    ds.PhotometricInterpretation = "YBR_FULL_422"
-
-    ds["PixelData"].VR = "OB"  # always for encapsulated pixel data
-    ds.is_little_endian = True
-    ds.is_implicit_VR = False
-
-    meta = pydicom.dataset.FileMetaDataset()
-    meta.TransferSyntaxUID = pydicom.uid.JPEGBaseline8Bit
-    ds.file_meta = meta
-
-    out: BytesIO = BytesIO()
-    ds.save_as(out, write_like_original=False)
-
-    response = requests.post(f"{orthanc_server}/instances", out.getvalue())
-
-    response.raise_for_status()
-
-    uuid = response.json()["ID"]
-    series_uuid = response.json()["ParentSeries"]
 
-    if thumbnail_buffer:
-        r = requests.put(
-            f"{orthanc_server}/instances/{uuid}/attachments/thumbnail",
-            data=thumbnail_buffer.getvalue(),
-        )
-    i += 1
 
-for image_label in spectral_dict["individualImages"]:
-    print(image_label)
-    image = spectral_dict["individualImages"][image_label]
-    image_name = image["name"]
-    image_path = f"{path_to_project}/{image_name}"
+def encode_instance(job) -> dict:
+    """
+    Encode an image as a DICOM instance, together with its thumbnail, or the
+    frames of a multi-frame instance, the viewers then rendering thumbnails.
+    """
     ds = pydicom.dataset.Dataset()
-    ds.PatientName = "Tombe^Egyptienne^MS"
-    ds.PatientID = "MS36587845"
-    ds.PatientBirthDate = "20200914"
-    ds.PatientSex = "O"
+    for keyword, value in job["metadata"].items():
+        setattr(ds, keyword, value)
 
-    ds.StudyDate = now.strftime("%Y%m%d")
-    ds.StudyTime = now.strftime("%H%M%S")
-
-    ds.ImageType = ["ORIGINAL", "PRIMARY"]
-    ds.UserContentLabel = image_label
-    ds.Laterality = "L"
+    ds.ImageType = job["image_type"]
+    ds.UserContentLabel = job["label"]
     ds.LossyImageCompression = "01"
     ds.Modality = "XC"  # External-camera photography
     ds.SOPClassUID = pydicom.uid.VLPhotographicImageStorage
-    ds.SOPInstanceUID = pydicom.uid.generate_uid()
-    ds.SeriesInstanceUID = series_uid
-    ds.StudyInstanceUID = study_uid
-    ds.PixelSpacing = spectral_dict["PixelRatio"]
-    ds.ImagePathFilterPassThroughWavelength = Filter[image["filter"]["type"]].value
+    ds.SOPInstanceUID = job["sop_instance_uid"]
+    ds.SeriesInstanceUID = job["series_uid"]
+    ds.StudyInstanceUID = job["study_uid"]
+    ds.PixelSpacing = job["pixel_ratio"]
+    if "frames" in job:
+        set_frame_functional_groups(ds, job["frames"])
+    else:
+        set_wavelengths(ds, job["image"])
+    for keyword in (
+        "AccessionNumber",
+        "ReferringPhysicianName",
+        "SeriesNumber",
+        "StudyID",
+        "Manufacturer",
+        "AcquisitionContextSequence",
+    ):
+        if keyword not in ds:
+            setattr(ds, keyword, None)
+    ds.InstanceNumber = job["instance_number"]
+    ds.private_block(PRIVATE_GROUP, PRIVATE_CREATOR, create=True).add_new(
+        SOURCE_DIGEST_ELEMENT, "LO", source_digest(job)
+    )
+
+    # the files are read once, for both the pixel data and their size and
+    # thumbnail
+    data = []
+    for source in job.get("frames", [job]):
+        with open(source["image_path"], "rb") as f:
+            data.append(f.read())
+    images = [PIL.Image.open(BytesIO(frame)) for frame in data]
     try:
-        ds.IlluminationWaveLength = image["wavelength"]["value"]
-    except Exception:
-        pass
-    ds.AccessionNumber = None
-    ds.ReferringPhysicianName = None
-    ds.SeriesNumber = None
-    ds.StudyID = None
-    ds.StudyDescription = "MS Tombe Egyptienne"
-    ds.SeriesDescription = "Acquisition de la parois"
-    ds.Manufacturer = None
-    ds.AcquisitionContextSequence = None
-    ds.InstanceNumber = i + 1
-
-    # Basic encapsulation of color JPEG
-    # httpss://pydicom.github.io/pydicom/stable/tutorials/pixel_data/compressing.html
-
-    with open(image_path, "rb") as f:
-        frames = [f.read()]
-        ds.PixelData = pydicom.encaps.encapsulate(frames)
-
-    with PIL.Image.open(image_path) as im:
-        ds.Rows = im.size[1]
-        ds.Columns = im.size[0]
+        first = images[0]
+        if job["encoding"] == "jpeg" and all(
+            im.format == "JPEG"
+            and im.mode in ("RGB", "L")
+            and (im.mode, im.size) == (first.mode, first.size)
+            for im in images
+        ):
+            # Basic encapsulation of JPEG
+            # https://pydicom.github.io/pydicom/stable/tutorials/pixel_data/compressing.html
+            encapsulate_jpeg(ds, data, first.size, color=first.mode == "RGB")
+            thumbnail = first
+        else:
+            arrays = [image_to_array(im) for im in images]
+            set_pixel_data(ds, arrays, job["encoding"], job["bits_stored"])
+            thumbnail = PIL.Image.fromarray(to_8bit(arrays[0], ds.BitsStored))
         thumbnail_buffer = None
-        if "thumbnails" in spectral_dict and spectral_dict["thumbnails"]:
-            im.thumbnail((thumbnails_width, thumbnails_height))
+        # an attachment holds a single thumbnail, and a multi-frame instance
+        # holds several images
+        if job["thumbnail_size"] and "frames" not in job:
+            thumbnail.thumbnail(job["thumbnail_size"])
             thumbnail_buffer = BytesIO()
-            im.save(thumbnail_buffer, format="JPEG")
+            thumbnail.save(thumbnail_buffer, format="JPEG")
+    finally:
+        for im in images:
+            im.close()
 
-    ds.PlanarConfiguration = 0
-    ds.SamplesPerPixel = 3
-    ds.BitsAllocated = 8
-    ds.BitsStored = 8
-    ds.HighBit = 7
-    ds.PixelRepresentation = 0
-    ds.PhotometricInterpretation = "YBR_FULL_422"
-
-    ds["PixelData"].VR = "OB"  # always for encapsulated pixel data
     ds.is_little_endian = True
     ds.is_implicit_VR = False
 
-    meta = pydicom.dataset.FileMetaDataset()
-    meta.TransferSyntaxUID = pydicom.uid.JPEGBaseline8Bit
-    ds.file_meta = meta
-
     out: BytesIO = BytesIO()
     ds.save_as(out, write_like_original=False)
 
-    response = requests.post(f"{orthanc_server}/instances", out.getvalue())
+    return {
+        "label": f"{job['project']}/{job['label']}",
+        "dicom": out.getvalue(),
+        "thumbnail": thumbnail_buffer.getvalue() if thumbnail_buffer else None,
+    }
+
+
+def create_session(concurrency, auth=None) -> requests.Session:
+    """Session keeping up to `concurrency` connections alive to Orthanc."""
+    session = requests.Session()
+    session.auth = auth
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=concurrency
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def send(session, method, url, data, retries) -> requests.Response:
+    """Send a request, retrying with exponential backoff on network or 5xx errors."""
+    for attempt in range(retries + 1):
+        try:
+            response = session.request(method, url, data=data, timeout=UPLOAD_TIMEOUT)
+            if response.status_code < 500 or attempt == retries:
+                response.raise_for_status()
+                return response
+            print(f"{method} {url} failed ({response.status_code}), retrying")
+        except (requests.ConnectionError, requests.Timeout) as error:
+            if attempt == retries:
+                raise
+            print(f"{method} {url} failed ({error}), retrying")
+        time.sleep(RETRY_BACKOFF * 2**attempt)
+
+
+def upload_instance(session, orthanc_url, encoded, retries) -> str:
+    """Store an encoded instance and its thumbnail, returning its Orthanc ID."""
+    # storing the same instance twice is harmless, so POST can be retried
+    response = send(
+        session, "POST", f"{orthanc_url}/instances", encoded["dicom"], retries
+    )
+    uuid = response.json()["ID"]
 
-    response.raise_for_status()
+    if encoded["thumbnail"]:
+        send(
+            session,
+            "PUT",
+            f"{orthanc_url}/instances/{uuid}/attachments/thumbnail",
+            encoded["thumbnail"],
+            retries,
+        )
+    return uuid
+
+
+class Progress:
+    """Report the progress and the throughput of an ingest."""
+
+    def __init__(self, total):
+        self.total = total
+        self.uploaded = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+
+    def succeed(self, encoded):
+        self.uploaded += 1
+        self.bytes += len(encoded["dicom"]) + len(encoded["thumbnail"] or b"")
+        elapsed = time.monotonic() - self.start
+        print(
+            f"[{self.uploaded + self.failed}/{self.total}] {encoded['label']} "
+            f"({len(encoded['dicom']) / 1e6:.1f} MB) - "
+            f"{self.uploaded / elapsed:.2f} images/s, "
+            f"{self.bytes / 1e6 / elapsed:.1f} MB/s"
+        )
+
+    def fail(self, label, error):
+        self.failed += 1
+        print(f"[{self.uploaded + self.failed}/{self.total}] {label} FAILED: {error}")
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        print(
+            f"{self.uploaded} images ({self.bytes / 1e6:.1f} MB) uploaded "
+            f"in {elapsed:.1f} s, {self.failed} failed - "
+            f"{self.uploaded / elapsed:.2f} images/s, "
+            f"{self.bytes / 1e6 / elapsed:.1f} MB/s"
+        )
 
-    uuid = response.json()["ID"]
-    series_uuid = response.json()["ParentSeries"]
 
-    if thumbnail_buffer:
-        r = requests.put(
-            f"{orthanc_server}/instances/{uuid}/attachments/thumbnail",
-            data=thumbnail_buffer.getvalue(),
+def find_stored_instances(session, orthanc_url, series_uid, retries) -> dict:
+    """Return the SOPInstanceUID -> Orthanc ID of the instances of a series."""
+    query = {
+        "Level": "Instance",
+        "Query": {"SeriesInstanceUID": series_uid},
+        "Expand": True,
+    }
+    response = send(
+        session, "POST", f"{orthanc_url}/tools/find", json.dumps(query), retries
+    )
+    return {
+        instance["MainDicomTags"]["SOPInstanceUID"]: instance["ID"]
+        for instance in response.json()
+    }
+
+
+def get_stored_digest(session, orthanc_url, uuid, retries) -> str:
+    """The digest of the files a stored instance was encoded from, if it has one."""
+    url = f"{orthanc_url}/instances/{uuid}/content/{SOURCE_DIGEST_TAG}"
+    try:
+        return send(session, "GET", url, None, retries).content.decode().strip()
+    except requests.HTTPError:
+        return None
+
+
+def select_jobs(jobs, ledger, session, orthanc_url, retries) -> list:
+    """
+    Drop the jobs of the files of a project already stored in Orthanc. An
+    instance the ledger does not know is only taken for the one of a file if it
+    was encoded from the same content.
+    """
+    if not jobs:
+        return jobs
+    # a single lookup for the whole series, instead of one per file
+    stored = find_stored_instances(session, orthanc_url, jobs[0]["series_uid"], retries)
+    selected = []
+    for job in jobs:
+        uuid = stored.get(job["sop_instance_uid"])
+        sources = job.get("frames", [job])
+        entries = [ledger.files.get(source["name"]) for source in sources]
+        for entry in entries:
+            # stored by a run in the other mode, single or multi-frame
+            if entry is not None and entry["SOPInstanceUID"] != job["sop_instance_uid"]:
+                previous = stored.pop(entry["SOPInstanceUID"], None)
+                if previous is not None:
+                    url = f"{orthanc_url}/instances/{previous}"
+                    send(session, "DELETE", url, None, retries)
+        if uuid is not None:
+            if all(
+                entry is not None
+                and entry["SOPInstanceUID"] == job["sop_instance_uid"]
+                and entry["sha256"] == source["hash"]["sha256"]
+                and entry.get("encoding", "jpeg") == job["encoding"]
+                for entry, source in zip(entries, sources)
+            ):
+                continue
+            if all(entry is None for entry in entries):
+                stored_digest = get_stored_digest(session, orthanc_url, uuid, retries)
+                if stored_digest == source_digest(job):
+                    # stored by a run whose ledger was lost, or from a copy
+                    ledger.record(job, uuid)
+                    continue
+                # not ours to replace, and Orthanc would ignore the new one
+                print(
+                    f"{job['name']}: an instance with the same SOPInstanceUID but "
+                    "other content is stored in Orthanc, skipped"
+                )
+                continue
+            # a file or the encoding changed since it was stored, and Orthanc
+            # would keep the previous instance with the same SOPInstanceUID
+            send(session, "DELETE", f"{orthanc_url}/instances/{uuid}", None, retries)
+        selected.append(job)
+    return selected
+
+
+def dicomize(jobs, session, orthanc_url, retries, on_stored) -> Progress:
+    """Encode and upload the images one after the other."""
+    progress = Progress(len(jobs))
+    for job in jobs:
+        try:
+            encoded = encode_instance(job)
+            on_stored(job, upload_instance(session, orthanc_url, encoded, retries))
+            progress.succeed(encoded)
+        except Exception as error:
+            progress.fail(job["label"], error)
+    progress.summary()
+    return progress
+
+
+def dicomize_bulk(
+    jobs, session, orthanc_url, workers, concurrency, retries, on_stored
+) -> Progress:
+    """
+    Encode the images in a pool of processes, and upload them concurrently over
+    a pool of keep-alive connections.
+
+    At most `workers + concurrency` images are in flight at once, so that the
+    encoded instances waiting for their upload do not pile up in memory.
+    """
+    progress = Progress(len(jobs))
+    pending = iter(jobs)
+    encoding = dict()  # future -> job
+    uploading = dict()  # future -> (job, encoded instance)
+
+    with ProcessPoolExecutor(max_workers=workers) as encoders, ThreadPoolExecutor(
+        max_workers=concurrency
+    ) as uploaders:
+
+        def fill():
+            while len(encoding) + len(uploading) < workers + concurrency:
+                job = next(pending, None)
+                if job is None:
+                    return
+                encoding[encoders.submit(encode_instance, job)] = job
+
+        fill()
+        while encoding or uploading:
+            done, _ = wait(
+                list(encoding) + list(uploading), return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if future in encoding:
+                    job = encoding.pop(future)
+                    try:
+                        encoded = future.result()
+                    except Exception as error:
+                        progress.fail(job["label"], error)
+                        continue
+                    upload = uploaders.submit(
+                        upload_instance, session, orthanc_url, encoded, retries
+                    )
+                    uploading[upload] = (job, encoded)
+                else:
+                    job, encoded = uploading.pop(future)
+                    try:
+                        on_stored(job, future.result())
+                        progress.succeed(encoded)
+                    except Exception as error:
+                        progress.fail(encoded["label"], error)
+            fill()
+
+    progress.summary()
+    return progress
+
+
+def dicomize_projects(
+    paths,
+    orthanc_url=DEFAULT_ORTHANC_URL,
+    bulk=False,
+    workers=None,
+    concurrency=4,
+    retries=3,
+    auth=None,
+    encoding="jpeg",
+    multiframe=False,
+) -> Progress:
+    """
+    Convert several projects to DICOM and upload them to Orthanc as a single
+    batch, each project becoming a study with one series.
+
+    `paths` are project directories or their spectral.json files. In bulk mode,
+    the images of all the projects share the same pools of processes and
+    connections. Files already stored by a previous run with the same
+    `encoding`, one of TRANSFER_SYNTAXES, are skipped. In `multiframe` mode,
+    the spectral images of a project are the frames of a single instance.
+    """
+    session = create_session(concurrency if bulk else 1, auth)
+    ledgers = dict()
+    jobs = []
+    for path in paths:
+        project_dir, spectral_dict = load_project(path)
+        ledger = ledgers[project_dir] = IngestLedger(project_dir)
+        project_jobs = create_jobs(
+            project_dir, spectral_dict, ledger, encoding, multiframe
+        )
+        selected = select_jobs(project_jobs, ledger, session, orthanc_url, retries)
+        print(
+            f"{os.path.basename(project_dir)}: {len(project_jobs) - len(selected)} "
+            f"of {len(project_jobs)} images already stored"
+        )
+        ledger.save()
+        jobs.extend(selected)
+
+    def on_stored(job, uuid):
+        ledgers[job["project_dir"]].record(job, uuid)
+
+    if bulk:
+        return dicomize_bulk(
+            jobs,
+            session,
+            orthanc_url,
+            workers or os.cpu_count(),
+            concurrency,
+            retries,
+            on_stored,
         )
-    i += 1
+    return dicomize(jobs, session, orthanc_url, retries, on_stored)
+
+
+def dicomize_project(path, **options) -> Progress:
+    """Convert a project to DICOM and upload it, see dicomize_projects()."""
+    return dicomize_projects([path], **options)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert Spectraloptica projects to DICOM and upload them to Orthanc"
+    )
+    parser.add_argument(
+        "projects",
+        nargs="+",
+        help="project directories, or their spectral.json files",
+    )
+    parser.add_argument(
+        "--orthanc",
+        default=DEFAULT_ORTHANC_URL,
+        help=f"URL of the Orthanc server (default: {DEFAULT_ORTHANC_URL})",
+    )
+    parser.add_argument(
+        "--username",
+        default=os.environ.get("ORTHANC_USERNAME"),
+        help="Orthanc username (default: $ORTHANC_USERNAME)",
+    )
+    parser.add_argument(
+        "--password",
+        default=os.environ.get("ORTHANC_PASSWORD"),
+        help="Orthanc password (default: $ORTHANC_PASSWORD)",
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="encode in parallel processes and upload concurrently",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of encoding processes in bulk mode (default: CPU count)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="number of concurrent uploads in bulk mode (default: 4)",
+    )
+    parser.add_argument(
+        "--encoding",
+        choices=TRANSFER_SYNTAXES,
+        default="jpeg",
+        help="compression of the pixel data: JPEG baseline, or lossless RLE, "
+        "JPEG-LS or JPEG 2000 for 16-bit images (default: jpeg)",
+    )
+    parser.add_argument(
+        "--multiframe",
+        action="store_true",
+        help="store the spectral images as the frames of a single instance",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="number of retries of a failed upload (default: 3)",
+    )
+    args = parser.parse_args()
+
+    progress = dicomize_projects(
+        args.projects,
+        orthanc_url=args.orthanc.rstrip("/"),
+        bulk=args.bulk,
+        workers=args.workers,
+        concurrency=args.concurrency,
+        retries=args.retries,
+        encoding=args.encoding,
+        multiframe=args.multiframe,
+        auth=(args.username, args.password) if args.username else None,
+    )
+    if progress.failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,58 @@
-from flask import (
-    Flask,
+from quart import (
+    Quart,
     render_template,
     jsonify,
     request,
-    send_from_directory,
-    send_file,
+    Response,
     abort,
+    g,
 )
 
-from flask_cors import CORS, cross_origin
+from quart_cors import cors
 
-from base64 import encodebytes
-import glob
-import io
+import argparse
+import asyncio
+from collections import defaultdict, OrderedDict
+import hashlib
 import os
-from PIL import Image
 import json
-import numpy as np
-import requests
+import time
+import httpx
 
+import spectraloptica
 
 cwd = os.getcwd()
 
-auth = None  # HTTPBasicAuth(os.environ.get("ORTHANC_USERNAME"), os.environ.get("ORTHANC_PASSWD"))
+auth = None  # (os.environ.get("ORTHANC_USERNAME"), os.environ.get("ORTHANC_PASSWD"))
 orthanc_server = os.environ.get("ORTHANC_SERVER")
 
+# connections kept alive to Orthanc, per worker process
+ORTHANC_CONNECTIONS = int(os.environ.get("ORTHANC_CONNECTIONS", 32))
+# largest chunk of an image held in memory while relaying it to a client
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 64 * 1024))
+# concurrent Orthanc requests of a single fan-out, e.g. attachments of a series
+FANOUT_CONCURRENCY = int(os.environ.get("FANOUT_CONCURRENCY", 16))
+# largest side of the thumbnails rendered for the frames of an instance, in pixels
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", 256))
+# series whose manifest and pixel spacings are kept, per worker
+SERIES_CACHE_SIZE = int(os.environ.get("SERIES_CACHE_SIZE", 1000))
+# wavelengths, in nm, below which light is UV and above which it is IR
+BAND_BOUNDARIES = tuple(
+    float(boundary)
+    for boundary in os.environ.get("BAND_BOUNDARIES", "400,700").split(",")
+)
+
 # configuration
 DEBUG = True
 
 # instantiate the app
-app = Flask(
+app = Quart(
     __name__,
     static_folder="dist/static",
     template_folder="dist",
     static_url_path="/static",
 )
-cors = CORS(app)
+app = cors(app, allow_origin="*")
 app.config["CORS_HEADERS"] = "Content-Type"
 app.config.from_object(__name__)
 
@@ -49,156 +66,512 @@ OWNER = {
 # pass data to the frontend
 site_data = {"site": SITE, "owner": OWNER}
 
+# HTTP client shared by all the requests of a worker, pooling its connections
+client: httpx.AsyncClient = None
+
+
+class Metrics:
+    """Counters and latency histograms of a worker, in the Prometheus text format.
+
+    Every worker process keeps its own values: Prometheus tells them apart by
+    the instance label of their scrapes, or sums them up.
+    """
+
+    # upper bounds, in seconds, of the buckets of the latency histograms
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # name -> labels, as a sorted tuple of pairs -> value
+        self.counters = defaultdict(lambda: defaultdict(float))
+
+    def increment(self, name, amount=1, **labels):
+        self.counters[name][tuple(sorted(labels.items()))] += amount
+
+    def observe(self, endpoint, status, seconds, sent):
+        self.increment("requests_total", endpoint=endpoint, status=status)
+        self.increment("response_bytes_total", sent, endpoint=endpoint)
+        self.increment("request_duration_seconds_sum", seconds, endpoint=endpoint)
+        self.increment("request_duration_seconds_count", endpoint=endpoint)
+        for bound in (*self.LATENCY_BUCKETS, "+Inf"):
+            if bound == "+Inf" or seconds <= bound:
+                self.increment(
+                    "request_duration_seconds_bucket", endpoint=endpoint, le=bound
+                )
+
+    def render(self) -> str:
+        lines = []
+        for name, values in sorted(self.counters.items()):
+            for labels, value in sorted(values.items(), key=str):
+                text = ",".join(f'{key}="{value}"' for key, value in labels)
+                lines.append(f"{self.prefix}_{name}{{{text}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics("spectraloptica_gateway")
+
+
+class LRUCache:
+    """Mapping bounded by its number of entries, evicting the least recently used.
+
+    The requests of a worker share its event loop, so no lock is needed.
+    """
+
+    def __init__(self, name, max_entries):
+        self.name = name
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            metrics.increment("cache_evictions_total", cache=self.name)
+
+
+async def count_orthanc_request(orthanc_request):
+    metrics.increment("orthanc_requests_total", method=orthanc_request.method)
+
+
+@app.before_request
+async def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+async def observe_request(response):
+    if request.url_rule is not None and request.url_rule.rule != "/metrics":
+        # streamed answers only count when their length is known in advance
+        metrics.observe(
+            request.url_rule.rule,
+            response.status_code,
+            time.perf_counter() - g.start,
+            response.content_length or 0,
+        )
+    return response
+
+
+@app.route("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.before_serving
+async def open_client():
+    global client
+    client = httpx.AsyncClient(
+        base_url=orthanc_server,
+        auth=auth,
+        limits=httpx.Limits(
+            max_connections=ORTHANC_CONNECTIONS,
+            max_keepalive_connections=ORTHANC_CONNECTIONS,
+        ),
+        # requests may wait for a free connection as long as needed
+        timeout=httpx.Timeout(60.0, pool=None),
+        event_hooks={"request": [count_orthanc_request]},
+    )
+
+
+@app.after_serving
+async def close_client():
+    await client.aclose()
+
 
 # landing page
 @app.route("/<id>")
-def welcome(id):
+async def welcome(id):
     print(f"id : {id}")
-    return render_template("index.html", **site_data)
+    return await render_template("index.html", **site_data)
 
 
-def get_response_thumbnail(instance):
-    byte_arr = requests.get(
-        url=f"{orthanc_server}/instances/{instance}/attachments/thumbnail/data",
-        auth=auth,
-    ).content
-    return byte_arr
+async def stream_orthanc(url, headers=None) -> Response:
+    """Relay a binary resource of Orthanc chunk by chunk, without buffering it."""
+    orthanc_response = await client.send(
+        client.build_request("GET", url, headers=headers), stream=True
+    )
+    if orthanc_response.status_code != 200:
+        await orthanc_response.aclose()
+        abort(orthanc_response.status_code)
 
+    async def body():
+        try:
+            async for chunk in orthanc_response.aiter_raw(STREAM_CHUNK_SIZE):
+                yield chunk
+        finally:
+            await orthanc_response.aclose()
 
-def get_response_image(instance):
-    byte_arr = requests.get(
-        url=f"{orthanc_server}/instances/{instance}/content/7fe0-0010/1", auth=auth
-    ).content
-    return byte_arr
+    # the raw body is relayed, so is its possible compression
+    headers = {
+        header: orthanc_response.headers[header]
+        for header in ("Content-Length", "Content-Encoding")
+        if header in orthanc_response.headers
+    }
+    return Response(body(), mimetype="image/jpeg", headers=headers)
 
 
-# send single image
-@app.route("/<id>/<image_id>/full-image")
-@cross_origin()
-def image(id, image_id):
-    try:
-        image_binary = get_response_image(image_id)
-        return send_file(
-            io.BytesIO(image_binary), mimetype="image/jpeg", as_attachment=False
-        )
-    except Exception as error:
-        print(error)
+# Orthanc renders a frame as a JPEG when asked for one, as a PNG otherwise
+RENDERED_HEADERS = {"Accept": "image/jpeg"}
+
+
+def get_thumbnail_url(band) -> str:
+    instance, frame = spectraloptica.parse_band(band)
+    if frame is None:
+        return f"/instances/{instance}/attachments/thumbnail/data"
+    # no thumbnail is stored for the frames of an instance: Orthanc renders them
+    return (
+        f"/instances/{instance}/frames/{frame}/rendered"
+        f"?width={THUMBNAIL_SIZE}&height={THUMBNAIL_SIZE}"
+    )
+
+
+def get_thumbnail_attachment(band) -> str:
+    """The attachment a thumbnail is made of, whose MD5 validates it."""
+    return "thumbnail" if spectraloptica.parse_band(band)[1] is None else "dicom"
+
+
+def get_response_thumbnail(band):
+    return stream_orthanc(get_thumbnail_url(band), RENDERED_HEADERS)
+
+
+def get_response_image(band):
+    instance, frame = spectraloptica.parse_band(band)
+    # the first fragment is the offset table, then every frame has its own
+    fragment = 1 if frame is None else frame + 1
+    return stream_orthanc(f"/instances/{instance}/content/7fe0-0010/{fragment}")
+
+
+# DICOM instances never change once stored, so browsers may keep their images
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+async def get_etag(band, attachment):
+    instance = spectraloptica.parse_band(band)[0]
+    response = await client.get(f"/instances/{instance}/attachments/{attachment}/md5")
+    # Orthanc may be configured not to store the MD5 of attachments
+    md5 = response.text if response.is_success else ""
+    return f"{band}-{md5}"
+
+
+async def send_instance_image(instance, attachment, get_response):
+    etag = await get_etag(instance, attachment)
+    if request.if_none_match.contains(etag):
+        response = Response("", status=304)
+    else:
+        response = await get_response(instance)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+# send single image, an instance or "<instance>/frames/<index>"
+@app.route("/<id>/<path:image_id>/full-image")
+async def image(id, image_id):
+    return await send_instance_image(image_id, "dicom", get_response_image)
 
 
 # send single image
-@app.route("/<id>/<image_id>/thumbnail")
-@cross_origin()
-def thumbnail(id, image_id):
-    try:
-        image_binary = get_response_thumbnail(image_id)
-        return send_file(
-            io.BytesIO(image_binary), mimetype="image/jpeg", as_attachment=False
-        )
-    except Exception as error:
-        print(error)
+@app.route("/<id>/<path:image_id>/thumbnail")
+async def thumbnail(id, image_id):
+    return await send_instance_image(
+        image_id, get_thumbnail_attachment(image_id), get_response_thumbnail
+    )
 
 
-# send StackData
-@app.route("/<id>/images")
-@cross_origin()
-def images(id):
-    response = requests.get(
-        url=f"{orthanc_server}/series/{id}/instances-tags?simplify", auth=auth
+# series ID -> (LastUpdate, json body, etag) of the manifests already built
+manifest_cache = LRUCache("manifests", SERIES_CACHE_SIZE)
+
+
+async def gather_bounded(coroutines):
+    """Run coroutines concurrently, at most FANOUT_CONCURRENCY at once."""
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[run(coroutine) for coroutine in coroutines])
+
+
+async def build_manifest(id) -> dict:
+    response = await client.get(f"/series/{id}/instances-tags?simplify")
+    if not response.is_success:
+        abort(404)
+    orthanc_dict: dict = response.json()
+
+    # the attachments of all the instances are looked up concurrently
+    all_attachments = await gather_bounded(
+        [client.get(f"/instances/{instance}/attachments") for instance in orthanc_dict]
     )
-    if not response.ok:
+    if not all(attachments.is_success for attachments in all_attachments):
         abort(404)
-    orthanc_dict: dict = json.loads(response.content)
-
-    to_jsonify = {}
-    encoded_images = []
-    individual_images = dict()
-    height = 0
-    width = 0
-    for instance, tags in orthanc_dict.items():
-        attachments = requests.get(
-            url=f"{orthanc_server}/instances/{instance}/attachments", auth=auth
-        )
-        if not response.ok:
-            abort(404)
-        thumbnail = "thumbnail" in json.loads(attachments.content)
-        height = tags["Rows"]
-        width = tags["Columns"]
-        try:
-            image = {
-                "name": instance,
-                "label": tags["UserContentLabel"],
-                "filter": {
-                    "type": (
-                        "VIS"
-                        if not "ImagePathFilterPassThroughWavelength" in tags
-                        or not tags["ImagePathFilterPassThroughWavelength"]
-                        else (
-                            "UV"
-                            if float(tags["ImagePathFilterPassThroughWavelength"]) < 400
-                            else "IR"
-                        )
-                    ),
-                    "description": "",
-                },
-                "wavelength": {
-                    "type": (
-                        "VIS"
-                        if not "IlluminationWaveLength" in tags
-                        or not tags["IlluminationWaveLength"]
-                        or (
-                            float(tags["IlluminationWaveLength"]) >= 400
-                            and float(tags["IlluminationWaveLength"]) <= 700
-                        )
-                        else (
-                            "UV"
-                            if float(tags["IlluminationWaveLength"]) < 400
-                            else "IR"
-                        )
-                    ),
-                    "value": (
-                        float(tags["IlluminationWaveLength"])
-                        if "IlluminationWaveLength" in tags
-                        else None
-                    ),
-                },
-            }
-            if "WAVELENGTH" in tags["ImageType"]:
-                encoded_images.append(image)
-            else:
-                individual_images[tags["UserContentLabel"]] = image
-        except Exception as error:
-            print(error)
-            continue
-
-    to_jsonify = {
-        "spectralImages": sorted(
-            encoded_images, key=lambda image: image["wavelength"]["value"]
+
+    return spectraloptica.build_manifest(
+        orthanc_dict,
+        BAND_BOUNDARIES,
+        # the gateway relays the thumbnails stored by the dicomizer, if any
+        thumbnails=all(
+            "thumbnail" in attachments.json() for attachments in all_attachments
         ),
-        "individualImages": individual_images,
-        "size": {"height": height, "width": width},
-        "thumbnails": thumbnail,
-    }
-    return jsonify(to_jsonify)
+        warn=print,
+    )
 
 
-@app.route("/<id>/position")
-@cross_origin()
-def compute_landmark(id):
-    x = float(request.args.get("x"))
-    y = float(request.args.get("y"))
-    response = requests.get(
-        url=f"{orthanc_server}/series/{id}/instances-tags?simplify", auth=auth
-    )
-    if not response.ok:
+async def get_manifest(id):
+    # the gateway gets no change notifications from Orthanc: a single lookup of
+    # the series tells whether the cached manifest is still up to date
+    response = await client.get(f"/series/{id}")
+    if not response.is_success:
+        abort(404)
+    last_update = response.json()["LastUpdate"]
+
+    cached = manifest_cache.get(id)
+    hit = cached is not None and cached[0] == last_update
+    metrics.increment("manifest_cache_lookups_total", result="hit" if hit else "miss")
+    if hit:
+        return cached[1], cached[2]
+
+    body = json.dumps(await build_manifest(id))
+    etag = hashlib.sha1(body.encode()).hexdigest()
+    manifest_cache.put(id, (last_update, body, etag))
+    return body, etag
+
+
+# send StackData
+@app.route("/<id>/images")
+async def images(id):
+    body, etag = await get_manifest(id)
+    if request.if_none_match.contains(etag):
+        response = Response("", status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+async def fetch_thumbnail(band) -> bytes:
+    response = await client.get(get_thumbnail_url(band), headers=RENDERED_HEADERS)
+    return response.content if response.is_success else None
+
+
+# send the thumbnails of all the images of a series in a single multipart answer:
+# spectral images by wavelength, then the individual images
+@app.route("/<id>/band-set")
+async def band_set(id):
+    body, manifest_etag = await get_manifest(id)
+    etag = f"band-set-{manifest_etag}"
+    if request.if_none_match.contains(etag):
+        response = Response("", status=304)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+
+    manifest = json.loads(body)
+    instances = [image["name"] for image in manifest["spectralImages"]] + [
+        image["name"] for image in manifest["individualImages"].values()
+    ]
+    boundary = hashlib.sha1(etag.encode()).hexdigest()
+
+    async def parts():
+        # thumbnails are fetched FANOUT_CONCURRENCY ahead, and every part is
+        # sent as soon as it and the ones before it are there
+        semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+        async def fetch(instance):
+            async with semaphore:
+                return await fetch_thumbnail(instance)
+
+        tasks = [asyncio.ensure_future(fetch(instance)) for instance in instances]
+        try:
+            for instance, task in zip(instances, tasks):
+                thumbnail = await task
+                if thumbnail is None:
+                    continue
+                yield (
+                    f"--{boundary}\r\n"
+                    "Content-Type: image/jpeg\r\n"
+                    f"Content-Length: {len(thumbnail)}\r\n"
+                    f"Content-ID: <{instance}>\r\n\r\n"
+                ).encode()
+                yield thumbnail
+                yield b"\r\n"
+            yield f"--{boundary}--\r\n".encode()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    response = Response(parts(), mimetype=f"multipart/mixed; boundary={boundary}")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+# series ID -> (LastUpdate, instance ID -> (x, y) pixel spacing)
+pixel_spacing_cache = LRUCache("pixel_spacings", SERIES_CACHE_SIZE)
+
+
+async def get_pixel_spacings(id) -> dict:
+    response = await client.get(f"/series/{id}")
+    if not response.is_success:
         abort(404)
+    last_update = response.json()["LastUpdate"]
+
+    cached = pixel_spacing_cache.get(id)
+    if cached is not None and cached[0] == last_update:
+        return cached[1]
 
-    all_tags: dict = json.loads(response.content)
-    key = next(iter(all_tags.keys()))
-    tags = all_tags[key]
-    pixel_spacing = [float(x) for x in tags["PixelSpacing"].split("\\")]
+    response = await client.get(f"/series/{id}/instances-tags?simplify")
+    if not response.is_success:
+        abort(404)
+    spacings = {
+        instance: spectraloptica.parse_pixel_spacing(tags["PixelSpacing"])
+        for instance, tags in response.json().items()
+        if "PixelSpacing" in tags
+    }
+    if not spacings:
+        abort(404)
+    pixel_spacing_cache.put(id, (last_update, spacings))
+    return spacings
+
+
+@app.route("/<id>/position")
+async def compute_landmark(id):
+    try:
+        x = float(request.args["x"])
+        y = float(request.args["y"])
+    except (KeyError, ValueError):
+        abort(400)
+    pixel_spacing = next(iter((await get_pixel_spacings(id)).values()))
     position = {"x": x * pixel_spacing[0], "y": y * pixel_spacing[1]}
     return jsonify(position)
 
 
+# measure a batch of points, distances, polylines and polygons
+@app.route("/<id>/measurements", methods=["POST"])
+async def measurements(id):
+    body = await request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+    spacings = await get_pixel_spacings(id)
+    # the images of a series usually share their spacing
+    instance = body.get("instance", next(iter(spacings)))
+    # the frames of an instance share its spacing
+    instance = spectraloptica.parse_band(instance)[0]
+    if instance not in spacings:
+        abort(400)
+    try:
+        return jsonify(spectraloptica.measure(body, spacings[instance]))
+    except ValueError as error:
+        return Response(str(error), status=400)
+
+
+# annotations of the series, in a SQLite database of the gateway
+annotation_store = spectraloptica.AnnotationStore(
+    os.environ.get("ANNOTATIONS_DATABASE", os.path.join(cwd, "annotations.sqlite"))
+)
+
+
+def parse_bbox(value):
+    if value is None:
+        return None
+    try:
+        min_x, min_y, max_x, max_y = map(float, value.split(","))
+    except ValueError:
+        abort(400)
+    return min_x, min_y, max_x, max_y
+
+
+# SQLite calls block: they run in threads, out of the event loop
+@app.route("/<id>/annotations", methods=["GET", "POST"])
+async def series_annotations(id):
+    if request.method == "GET":
+        answer = await asyncio.to_thread(
+            annotation_store.query,
+            id,
+            bbox=parse_bbox(request.args.get("bbox")),
+            band=request.args.get("band"),
+            since=request.args.get("since", type=int),
+        )
+        return jsonify(answer)
+    body = await request.get_json(silent=True)
+    try:
+        answer = await asyncio.to_thread(
+            annotation_store.create, id, body if isinstance(body, list) else [body]
+        )
+    except ValueError as error:
+        return Response(str(error), status=400)
+    return jsonify(answer)
+
+
+@app.route("/<id>/annotations/<int:annotation>", methods=["GET", "PUT", "DELETE"])
+async def series_annotation(id, annotation):
+    revision = request.args.get("revision", type=int)
+    try:
+        if request.method == "GET":
+            answer = await asyncio.to_thread(annotation_store.get, id, annotation)
+            if answer is None:
+                abort(404)
+        elif request.method == "PUT":
+            answer = await asyncio.to_thread(
+                annotation_store.update,
+                id,
+                annotation,
+                await request.get_json(silent=True),
+                revision,
+            )
+        else:
+            await asyncio.to_thread(annotation_store.delete, id, annotation, revision)
+            answer = {}
+    except KeyError:
+        abort(404)
+    except spectraloptica.Conflict as error:
+        return Response(str(error), status=409)
+    except ValueError as error:
+        return Response(str(error), status=400)
+    return jsonify(answer)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spectraloptica gateway to Orthanc")
+    parser.add_argument(
+        "--bind",
+        default=os.environ.get("GATEWAY_BIND", "0.0.0.0:5000"),
+        help="address to listen on (default: $GATEWAY_BIND or 0.0.0.0:5000)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("GATEWAY_WORKERS", os.cpu_count())),
+        help="number of worker processes (default: $GATEWAY_WORKERS or CPU count)",
+    )
+    parser.add_argument(
+        "--dev",
+        action="store_true",
+        help="run the Quart development server, with reloading",
+    )
+    args = parser.parse_args()
+
+    if args.dev:
+        host, port = args.bind.rsplit(":", 1)
+        app.run(host=host, port=int(port), debug=True)
+        return
+
+    from hypercorn.config import Config
+    from hypercorn.run import run
+
+    config = Config()
+    config.application_path = "app:app"
+    config.bind = [args.bind]
+    config.workers = args.workers
+    run(config)
+
+
 if __name__ == "__main__":
-    app.run()
+    main()
@@ -0,0 +1,155 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Generate synthetic Spectraloptica projects, as the camera software writes them:
+one JPEG per band and a spectral.json calibration file.
+
+    python -m benchmarks.dataset /tmp/bench --bands 16 --width 4000 --height 3000
+"""
+
+import argparse
+from io import BytesIO
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+# wavelengths of the bands of the camera, in nm, spread over this range
+WAVELENGTHS = (365, 1000)
+
+
+def filter_type(wavelength) -> str:
+    if wavelength < 400:
+        return "UV"
+    if wavelength > 700:
+        return "IR"
+    return "VIS"
+
+
+def generate_band(rng, width, height, quality) -> bytes:
+    """A JPEG with smooth structures and fine noise, compressing like a photograph."""
+    coarse = rng.integers(0, 256, (max(2, height // 64), max(2, width // 64), 3))
+    image = Image.fromarray(coarse.astype(np.uint8)).resize(
+        (width, height), Image.BICUBIC
+    )
+    array = np.asarray(image, dtype=np.int16) + rng.integers(
+        -12, 13, (height, width, 1), dtype=np.int16
+    )
+    image = Image.fromarray(np.clip(array, 0, 255).astype(np.uint8))
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def generate_project(
+    directory,
+    bands=16,
+    width=2048,
+    height=1536,
+    individual_images=1,
+    thumbnails=True,
+    quality=90,
+    seed=0,
+) -> str:
+    """Write a project with `bands` spectral images, and return its directory."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    spectral = []
+    for index, wavelength in enumerate(
+        np.linspace(*WAVELENGTHS, bands).round().astype(int).tolist()
+    ):
+        name = f"band_{index:03d}_{wavelength}nm.jpg"
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(generate_band(rng, width, height, quality))
+        spectral.append(
+            {
+                "name": name,
+                "filter": {"type": filter_type(wavelength)},
+                "wavelength": {"value": wavelength},
+            }
+        )
+    individual = dict()
+    for index in range(individual_images):
+        name = f"individual_{index:03d}.jpg"
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(generate_band(rng, width, height, quality))
+        individual[f"image {index}"] = {"name": name, "filter": {"type": "VIS"}}
+
+    with open(os.path.join(directory, "spectral.json"), "w") as f:
+        json.dump(
+            {
+                "PixelRatio": [0.01, 0.01],
+                "thumbnails": thumbnails,
+                "thumbnails_width": 256,
+                "thumbnails_height": 256,
+                "spectral": spectral,
+                "individualImages": individual,
+            },
+            f,
+            indent=2,
+        )
+    return directory
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic Spectraloptica projects"
+    )
+    parser.add_argument("directory", help="directory to write the projects into")
+    parser.add_argument("--projects", type=int, default=1, help="(default: 1)")
+    parser.add_argument("--bands", type=int, default=16, help="(default: 16)")
+    parser.add_argument("--width", type=int, default=2048, help="(default: 2048)")
+    parser.add_argument("--height", type=int, default=1536, help="(default: 1536)")
+    parser.add_argument("--individual-images", type=int, default=1, help="(default: 1)")
+    parser.add_argument(
+        "--no-thumbnails",
+        action="store_true",
+        help="let the plugin generate the thumbnails",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="(default: 0)")
+    args = parser.parse_args()
+
+    for index in range(args.projects):
+        path = generate_project(
+            os.path.join(args.directory, f"project_{index:03d}"),
+            bands=args.bands,
+            width=args.width,
+            height=args.height,
+            individual_images=args.individual_images,
+            thumbnails=not args.no_thumbnails,
+            seed=args.seed + index,
+        )
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+In-memory stand-in of the parts of the Orthanc REST API used by the gateway and
+the dicomizer, to benchmark them without a database nor a storage area.
+
+Instances are stored by POST /instances, or preloaded from projects with the
+dicomizer encoder, and answered with the sizes a real Orthanc would send:
+
+    python -m benchmarks.fake_orthanc --port 8042 --preload /tmp/bench/project_000
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+
+import pydicom
+
+import DicomizeSpectralopticaFiles as dicomizer
+
+
+def orthanc_id(*uids) -> str:
+    """Identifier in the format of Orthanc: a SHA-1 of the DICOM UIDs."""
+    digest = hashlib.sha1("|".join(uids).encode()).hexdigest()
+    return "-".join(digest[i : i + 8] for i in range(0, 40, 8))
+
+
+def simplify(ds) -> dict:
+    """The `?simplify` JSON of the main tags of an instance."""
+    tags = dict()
+    for element in ds:
+        if not element.keyword or element.VR in ("SQ", "OB", "OW", "UN"):
+            continue
+        value = element.value
+        if value is None:
+            tags[element.keyword] = None
+        elif isinstance(value, pydicom.multival.MultiValue):
+            tags[element.keyword] = "\\".join(str(item) for item in value)
+        else:
+            tags[element.keyword] = str(value)
+    return tags
+
+
+class Store:
+    """The instances stored in the fake Orthanc, grouped by series."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.instances = dict()
+        self.series = dict()
+
+    def add(self, dicom) -> dict:
+        ds = pydicom.dcmread(BytesIO(dicom))
+        series_id = orthanc_id(ds.StudyInstanceUID, ds.SeriesInstanceUID)
+        instance_id = orthanc_id(
+            ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.SOPInstanceUID
+        )
+        frame = next(pydicom.encaps.generate_frames(ds.PixelData, number_of_frames=1))
+        with self.lock:
+            self.instances[instance_id] = {
+                "dicom": dicom,
+                "frame": frame,
+                "tags": simplify(ds),
+                "series": series_id,
+                "attachments": dict(),
+            }
+            series = self.series.setdefault(
+                series_id,
+                {"Instances": [], "SeriesInstanceUID": ds.SeriesInstanceUID},
+            )
+            if instance_id not in series["Instances"]:
+                series["Instances"].append(instance_id)
+            series["LastUpdate"] = time.strftime("%Y%m%dT%H%M%S")
+        return {"ID": instance_id, "ParentSeries": series_id, "Status": "Success"}
+
+    def delete(self, instance_id):
+        with self.lock:
+            instance = self.instances.pop(instance_id)
+            self.series[instance["series"]]["Instances"].remove(instance_id)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store: Store = None
+    # simulated processing time of Orthanc, in seconds
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self, body, content_type="application/json", status=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        time.sleep(self.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_found(self):
+        self.answer({"HttpStatus": 404, "Message": "Unknown resource"}, status=404)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        store = self.store
+        if path == "/series":
+            return self.answer(list(store.series))
+        match = re.fullmatch(r"/series/([^/]+)(/instances-tags)?", path)
+        if match:
+            series = store.series.get(match.group(1))
+            if series is None:
+                return self.not_found()
+            if match.group(2):
+                return self.answer(
+                    {
+                        instance: store.instances[instance]["tags"]
+                        for instance in series["Instances"]
+                    }
+                )
+            return self.answer({"ID": match.group(1), **series})
+        match = re.fullmatch(r"/instances/([^/]+)(/.*)?", path)
+        instance = store.instances.get(match.group(1)) if match else None
+        if instance is None:
+            return self.not_found()
+        resource = match.group(2) or ""
+        if resource in ("/tags", "/simplified-tags"):
+            return self.answer(instance["tags"])
+        if resource == "/file":
+            return self.answer(instance["dicom"], "application/dicom")
+        if resource == "/content/7fe0-0010/1":
+            return self.answer(instance["frame"], "application/octet-stream")
+        if resource == "/attachments":
+            return self.answer(["dicom", *instance["attachments"]])
+        match = re.fullmatch(r"/attachments/([^/]+)/(md5|data)", resource)
+        if match:
+            name, what = match.groups()
+            data = instance["dicom"] if name == "dicom" else None
+            data = instance["attachments"].get(name, data)
+            if data is None:
+                return self.not_found()
+            if what == "md5":
+                return self.answer(hashlib.md5(data).hexdigest().encode(), "text/plain")
+            return self.answer(data, "application/octet-stream")
+        self.not_found()
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path == "/instances":
+            return self.answer(self.store.add(body))
+        if self.path == "/tools/find":
+            query = json.loads(body)
+            uid = query["Query"].get("SeriesInstanceUID")
+            found = [
+                {"ID": instance_id, "MainDicomTags": instance["tags"]}
+                for instance_id, instance in list(self.store.instances.items())
+                if instance["tags"].get("SeriesInstanceUID") == uid
+            ]
+            return self.answer(found)
+        self.not_found()
+
+    def do_PUT(self):
+        body = self.read_body()
+        match = re.fullmatch(r"/instances/([^/]+)/attachments/([^/]+)", self.path)
+        instance = self.store.instances.get(match.group(1)) if match else None
+        if instance is None:
+            return self.not_found()
+        instance["attachments"][match.group(2)] = body
+        self.answer({})
+
+    def do_DELETE(self):
+        match = re.fullmatch(r"/instances/([^/]+)", self.path)
+        if not match or match.group(1) not in self.store.instances:
+            return self.not_found()
+        self.store.delete(match.group(1))
+        self.answer({})
+
+
+def preload(store, path):
+    """Store a project as the dicomizer would, without going through HTTP."""
+    project_dir, spectral_dict = dicomizer.load_project(path)
+    ledger = dicomizer.IngestLedger(project_dir)
+    for job in dicomizer.create_jobs(project_dir, spectral_dict, ledger):
+        encoded = dicomizer.encode_instance(job)
+        stored = store.add(encoded["dicom"])
+        if encoded["thumbnail"]:
+            store.instances[stored["ID"]]["attachments"]["thumbnail"] = encoded[
+                "thumbnail"
+            ]
+    return stored["ParentSeries"]
+
+
+def serve(port=8042, latency=0.0, projects=()) -> ThreadingHTTPServer:
+    """Start a fake Orthanc in a background thread."""
+    store = Store()
+    for project in projects:
+        print(f"{project}: series {preload(store, project)}")
+    handler = type("Handler", (Handler,), {"store": store, "latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-memory stand-in of Orthanc")
+    parser.add_argument("--port", type=int, default=8042, help="(default: 8042)")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="simulated processing time of every request, in ms (default: 0)",
+    )
+    parser.add_argument(
+        "--preload",
+        nargs="*",
+        default=[],
+        help="project directories to store before serving",
+    )
+    args = parser.parse_args()
+
+    server = serve(args.port, args.latency / 1000, args.preload)
+    print(f"Fake Orthanc listening on http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
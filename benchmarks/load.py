@@ -0,0 +1,331 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Load scenarios against the gateway, or against Orthanc with the plugin, and
+against the dicomizer upload path. Every scenario reports the p50/p95/p99
+latencies, the throughput and the peak memory of the server under test, given
+the PID of its worker process:
+
+    python -m benchmarks.fake_orthanc --preload /tmp/bench/project_000 &
+    ORTHANC_SERVER=http://127.0.0.1:8042 python app.py --bind 127.0.0.1:5000 \\
+        --workers 1 &
+    python -m benchmarks.load --target gateway --url http://127.0.0.1:5000 \\
+        --orthanc http://127.0.0.1:8042 --pid $(pgrep -f app.py | tail -1) \\
+        --project /tmp/bench/project_000 --json results.json
+
+Give the results of a previous run with --baseline to fail on regressions.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+import requests
+
+import DicomizeSpectralopticaFiles as dicomizer
+
+# paths of the scenarios, by target, given a series and one of its instances
+ROUTES = {
+    "gateway": {
+        "images": "/{series}/images",
+        "full-image": "/{series}/{instance}/full-image",
+        "thumbnail": "/{series}/{instance}/thumbnail",
+        "position": "/{series}/position?x={x}&y={y}",
+    },
+    "plugin": {
+        "images": "/spectraloptica/{series}/images",
+        "full-image": "/spectraloptica/{instance}/full-image",
+        "thumbnail": "/spectraloptica/{instance}/thumbnail",
+        "position": "/spectraloptica/{instance}/position?x={x}&y={y}",
+    },
+}
+
+
+class PeakMemory:
+    """Sample the resident memory of a process until stopped, keeping the peak."""
+
+    def __init__(self, pid, interval=0.05):
+        self.path = f"/proc/{pid}/status" if pid else None
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def read(self) -> int:
+        with open(self.path) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def sample(self):
+        while not self.stopped.is_set():
+            try:
+                self.peak = max(self.peak, self.read())
+            except OSError:
+                return
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        if self.path and os.path.exists(self.path):
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+
+
+def summarize(name, latencies, errors, transferred, elapsed, peak_memory) -> dict:
+    count = len(latencies)
+    latencies = np.array(latencies or [np.nan]) * 1000
+    return {
+        "scenario": name,
+        "requests": count,
+        "errors": errors,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "throughput_rps": count / elapsed,
+        "throughput_mbps": transferred / 1e6 / elapsed,
+        "peak_memory_mb": peak_memory / 1e6,
+    }
+
+
+def run_http(name, url, paths, count, concurrency, warmup, pid) -> dict:
+    """Send `count` GET requests to paths drawn from `paths`, `concurrency` at once."""
+    local = threading.local()
+
+    def get(path):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        response = local.session.get(url + path)
+        return time.perf_counter() - start, response.ok, len(response.content)
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(get, [random.choice(paths) for _ in range(warmup)]))
+        with PeakMemory(pid) as memory:
+            start = time.perf_counter()
+            results = list(pool.map(get, [random.choice(paths) for _ in range(count)]))
+            elapsed = time.perf_counter() - start
+
+    return summarize(
+        name,
+        [seconds for seconds, _, _ in results],
+        sum(1 for _, ok, _ in results if not ok),
+        sum(size for _, _, size in results),
+        elapsed,
+        memory.peak,
+    )
+
+
+def run_dicomize(project, orthanc_url, bulk, workers, concurrency) -> dict:
+    """Ingest a fresh copy of a project, timing every request to Orthanc."""
+    directory = tempfile.mkdtemp()
+    # a new project name means new UIDs: nothing is found already stored
+    copy = os.path.join(directory, f"{os.path.basename(project)}-{uuid.uuid4().hex}")
+    shutil.copytree(project, copy)
+    latencies = []
+    session = dicomizer.create_session(concurrency if bulk else 1)
+    session.hooks["response"].append(
+        lambda response, *args, **kwargs: latencies.append(
+            response.elapsed.total_seconds()
+        )
+    )
+    try:
+        project_dir, spectral_dict = dicomizer.load_project(copy)
+        ledger = dicomizer.IngestLedger(project_dir)
+        jobs = dicomizer.create_jobs(project_dir, spectral_dict, ledger)
+        with PeakMemory(os.getpid()) as memory:
+            start = time.perf_counter()
+            if bulk:
+                progress = dicomizer.dicomize_bulk(
+                    jobs,
+                    session,
+                    orthanc_url,
+                    workers,
+                    concurrency,
+                    0,
+                    lambda job, uuid: None,
+                )
+            else:
+                progress = dicomizer.dicomize(
+                    jobs, session, orthanc_url, 0, lambda job, uuid: None
+                )
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+    # the encoding processes of the bulk mode are children of this one
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return summarize(
+        "dicomize-bulk" if bulk else "dicomize",
+        latencies,
+        progress.failed,
+        progress.bytes,
+        elapsed,
+        max(memory.peak, children),
+    )
+
+
+def find_regressions(results, baseline, tolerance) -> list:
+    """Describe the scenarios slower than their baseline by more than `tolerance`."""
+    previous = {result["scenario"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result["scenario"])
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{result['scenario']}: p95 {before['p95_ms']:.1f} ms "
+                f"-> {result['p95_ms']:.1f} ms"
+            )
+        if result["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{result['scenario']}: throughput {before['throughput_rps']:.1f}/s "
+                f"-> {result['throughput_rps']:.1f}/s"
+            )
+    return regressions
+
+
+def print_results(results):
+    print(
+        f"{'scenario':<16}{'requests':>9}{'errors':>7}{'p50 ms':>9}{'p95 ms':>9}"
+        f"{'p99 ms':>9}{'req/s':>9}{'MB/s':>8}{'peak MB':>9}"
+    )
+    for r in results:
+        print(
+            f"{r['scenario']:<16}{r['requests']:>9}{r['errors']:>7}"
+            f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+            f"{r['throughput_rps']:>9.1f}{r['throughput_mbps']:>8.1f}"
+            f"{r['peak_memory_mb']:>9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spectraloptica load scenarios")
+    parser.add_argument(
+        "--target",
+        choices=ROUTES,
+        default="gateway",
+        help="routes to load: the gateway, or Orthanc with the plugin",
+    )
+    parser.add_argument(
+        "--url", default="http://127.0.0.1:5000", help="URL of the target"
+    )
+    parser.add_argument(
+        "--orthanc",
+        default=dicomizer.DEFAULT_ORTHANC_URL,
+        help="URL of the (fake) Orthanc, to list the series and upload to",
+    )
+    parser.add_argument("--series", help="Orthanc ID of the series to load")
+    parser.add_argument(
+        "--scenarios",
+        nargs="*",
+        default=[*ROUTES["gateway"], "dicomize"],
+        help="scenarios to run (default: all)",
+    )
+    parser.add_argument("--requests", type=int, default=500, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="(default: 16)")
+    parser.add_argument("--warmup", type=int, default=20, help="(default: 20)")
+    parser.add_argument("--pid", type=int, help="process of the target, for memory")
+    parser.add_argument("--project", help="project to ingest in dicomize scenarios")
+    parser.add_argument("--bulk", action="store_true", help="dicomize in bulk mode")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--baseline", help="results of a previous run to compare to")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown reported as a regression (default: 0.2)",
+    )
+    args = parser.parse_args()
+
+    url = args.url.rstrip("/")
+    orthanc_url = args.orthanc.rstrip("/")
+    results = []
+    http_scenarios = [s for s in args.scenarios if s in ROUTES[args.target]]
+    if http_scenarios:
+        series = args.series or requests.get(f"{orthanc_url}/series").json()[0]
+        instances = requests.get(f"{orthanc_url}/series/{series}").json()["Instances"]
+        for scenario in http_scenarios:
+            paths = [
+                ROUTES[args.target][scenario].format(
+                    series=series,
+                    instance=instance,
+                    x=random.randint(0, 1000),
+                    y=random.randint(0, 1000),
+                )
+                for instance in instances
+            ]
+            results.append(
+                run_http(
+                    scenario,
+                    url,
+                    paths,
+                    args.requests,
+                    args.concurrency,
+                    args.warmup,
+                    args.pid,
+                )
+            )
+    if "dicomize" in args.scenarios and args.project:
+        results.append(
+            run_dicomize(
+                args.project, orthanc_url, args.bulk, args.workers, args.concurrency
+            )
+        )
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
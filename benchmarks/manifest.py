@@ -0,0 +1,87 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Time the transform of the tags of large series into their manifest.
+
+    python -m benchmarks.manifest --instances 10000
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+import spectraloptica
+
+
+def synthetic_tags(count, seed=0) -> dict:
+    """Simplified tags of a series, mixing spectral and individual images."""
+    rng = random.Random(seed)
+    tags = dict()
+    for index in range(count):
+        spectral = rng.random() < 0.9
+        wavelength = rng.choice([None, "", str(rng.randint(300, 1100))])
+        tags[f"{index:08x}-instance"] = {
+            "Rows": "3000",
+            "Columns": "4000",
+            "UserContentLabel": f"image {index}",
+            "ImageType": (
+                "ORIGINAL\\PRIMARY\\\\WAVELENGTH" if spectral else "ORIGINAL\\PRIMARY"
+            ),
+            "ImagePathFilterPassThroughWavelength": rng.choice([None, "365", "800"]),
+            **({} if wavelength is None else {"IlluminationWaveLength": wavelength}),
+        }
+    return tags
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the manifest transform")
+    parser.add_argument("--instances", type=int, default=10000, help="(default: 10000)")
+    parser.add_argument("--repeat", type=int, default=20, help="(default: 20)")
+    args = parser.parse_args()
+
+    tags = synthetic_tags(args.instances)
+    durations = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        spectraloptica.build_manifest(tags)
+        durations.append(time.perf_counter() - start)
+    durations = np.array(durations) * 1000
+    print(
+        f"{args.instances} instances: "
+        f"median {np.median(durations):.1f} ms, best {durations.min():.1f} ms, "
+        f"{np.median(durations) * 1000 / args.instances:.2f} us per instance"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -28,10 +28,28 @@
 
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
+import functools
+from collections import OrderedDict
+import hashlib
+from io import BytesIO
 import json
+import math
 import numpy as np
+import os
+import queue
+import tempfile
+import threading
+import time
 
 import orthanc
+import spectraloptica
+
+try:
+    # only needed to encode WebP previews
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
 
 ##############################################################################
 #                                                                            #
@@ -40,46 +58,965 @@ import orthanc
 ##############################################################################
 
 
-def compute_landmark(output, uri, **request):
-    if request["method"] == "GET":
-        instanceId = request["groups"][0]
-        x = float(request["get"]["x"])
-        y = float(request["get"]["y"])
-        orthanc.LogWarning(f"Compute position of ({x};{y}) at {instanceId}")
+orthanc_configuration = json.loads(orthanc.GetConfiguration())
+configuration = orthanc_configuration.get("Spectraloptica", {})
+
+CACHE_DIRECTORY = configuration.get(
+    "CacheDirectory", os.path.join(tempfile.gettempdir(), "spectraloptica")
+)
+MEGABYTE = 1024 * 1024
+
+
+class Metrics:
+    """Counters and gauges published as Orthanc metrics, for /tools/metrics-prometheus.
+
+    Orthanc metrics have no labels, so the name of every value spells them out,
+    e.g. `spectraloptica_tile_requests` or `spectraloptica_tile_duration_le_0_1`.
+    """
+
+    # upper bounds, in seconds, of the buckets of the latency histograms
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def set(self, name, value, type=orthanc.MetricsType.DEFAULT):
+        orthanc.SetMetricsValue(f"{self.prefix}_{name}", value, type)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            value = self.values[name] = self.values.get(name, 0) + amount
+        self.set(name, value)
+
+    def observe(self, endpoint, seconds, cpu_seconds, sent):
+        """Record a request, its wall-clock and CPU durations and the bytes it sent."""
+        self.increment(f"{endpoint}_requests")
+        self.increment(f"{endpoint}_duration_sum", seconds)
+        self.increment(f"{endpoint}_cpu_seconds", cpu_seconds)
+        self.increment(f"{endpoint}_bytes_sent", sent)
+        # cumulative buckets, as in Prometheus histograms
+        for bound in self.LATENCY_BUCKETS:
+            if seconds <= bound:
+                self.increment(f"{endpoint}_duration_le_{bound:g}".replace(".", "_"))
+        # Orthanc keeps the maximum of a TIMER over the last ten seconds
+        self.set(f"{endpoint}_duration_ms", seconds * 1000, orthanc.MetricsType.TIMER)
+
+    def lookup(self, cache, hit):
+        self.increment(f"{cache}_cache_{'hits' if hit else 'misses'}")
+
+
+metrics = Metrics("spectraloptica")
+# requests slower than this are logged, to tell which resources are costly
+SLOW_REQUEST_SECONDS = configuration.get("SlowRequestThreshold", 1.0)
+
+
+class CountingOutput:
+    """Proxy of the output of a REST callback, counting the bytes it sends."""
+
+    def __init__(self, output):
+        self.output = output
+        self.sent = 0
+
+    def AnswerBuffer(self, answer, mime_type):
+        self.sent += len(answer)
+        self.output.AnswerBuffer(answer, mime_type)
+
+    def SendMultipartItem(self, answer):
+        self.sent += len(answer)
+        self.output.SendMultipartItem(answer)
+
+    def __getattr__(self, name):
+        return getattr(self.output, name)
+
+
+class Counter:
+    """Thread-safe count of things in progress."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.value += 1
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.value -= 1
+
+
+# REST requests being answered, which background jobs make way for
+active_requests = Counter()
+
+
+class Flight:
+    """A computation in progress, see SingleFlight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Share a computation between the concurrent callers of a same key: the first
+    caller computes it, the others wait for its result, or its exception.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.flights = dict()
+
+    def do(self, key, function, *args):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            metrics.increment(f"{self.name}_coalesced")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function(*args)
+            return flight.result
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+
+class KeyedLocks:
+    """
+    A lock per key being worked on, e.g. per level being decoded, forgotten
+    once no thread holds it or waits for it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [lock, number of threads holding it or waiting for it]
+        self.locks = dict()
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        with self.lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
+
+
+class RecordingOutput:
+    """
+    Proxy of the output of a REST callback, recording the answer to replay it
+    to the identical requests received meanwhile. Multipart answers are streamed
+    part by part, and are never recorded.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.output, name)
+
+        def record(*args):
+            self.calls.append((name, args))
+            return method(*args)
+
+        return record
+
+    def replay(self, output):
+        for name, args in self.calls:
+            getattr(output, name)(*args)
+
+
+class Overloaded(Exception):
+    """Too many requests of an endpoint are waiting for their turn."""
+
+
+class Admission:
+    """
+    Bound the requests of an endpoint computed at once, and those waiting for
+    their turn, which are refused beyond `max_queued` or after `timeout` seconds.
+    """
+
+    def __init__(self, name, concurrency, max_queued, timeout):
+        self.name = name
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.running = 0
+        self.queued = 0
+
+    def count(self, running=0, queued=0):
+        with self.lock:
+            self.running += running
+            self.queued += queued
+            metrics.set(f"{self.name}_running", self.running)
+            metrics.set(f"{self.name}_queued", self.queued)
+
+    def __enter__(self):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                full = self.queued >= self.max_queued
+            if full:
+                metrics.increment(f"{self.name}_rejected")
+                raise Overloaded(f"Too many {self.name} requests are waiting")
+            self.count(queued=1)
+            start = time.perf_counter()
+            try:
+                admitted = self.slots.acquire(timeout=self.timeout)
+            finally:
+                self.count(queued=-1)
+                metrics.increment(
+                    f"{self.name}_queue_seconds", time.perf_counter() - start
+                )
+            if not admitted:
+                metrics.increment(f"{self.name}_rejected")
+                raise Overloaded(f"The {self.name} request waited too long")
+        self.count(running=1)
+
+    def __exit__(self, *exc_info):
+        self.count(running=-1)
+        self.slots.release()
+
+
+# Requests of the heavy endpoints computed at once, and waiting for their turn.
+# Beyond that, or after waiting QueueTimeout seconds, they are answered 503 with
+# a Retry-After header, instead of holding all the HTTP threads of Orthanc while
+# their latency grows. Overridden by endpoint, e.g.
+# "Admission": {"tile": {"Concurrency": 16, "MaxQueued": 64}}
+#
+# The Python SDK cannot answer in chunks: a full image is held once in memory,
+# as the bytes returned by RestApiGet, which AnswerBuffer sends without copy.
+# Bounding the concurrent full images bounds the memory they use, whatever the
+# number of viewers.
+ADMISSION = {
+    "full_image": {
+        "Concurrency": configuration.get("FullImageConcurrency", 4),
+        "MaxQueued": 8,
+    },
+    "images": {"Concurrency": 4, "MaxQueued": 16},
+    "band_set": {"Concurrency": 2, "MaxQueued": 4},
+    "tile": {"Concurrency": 8, "MaxQueued": 24},
+    "preview": {"Concurrency": 4, "MaxQueued": 12},
+    "composite": {"Concurrency": 2, "MaxQueued": 4},
+    "spectrum": {"Concurrency": 4, "MaxQueued": 8},
+    "pca": {"Concurrency": 1, "MaxQueued": 2},
+    "pca_tile": {"Concurrency": 4, "MaxQueued": 8},
+    "pca_preview": {"Concurrency": 2, "MaxQueued": 4},
+}
+for endpoint, limits in configuration.get("Admission", {}).items():
+    ADMISSION[endpoint] = {
+        **ADMISSION.get(endpoint, {"Concurrency": 4, "MaxQueued": 16}),
+        **limits,
+    }
+# the endpoints whose identical concurrent GET requests are answered once: the
+# expensive ones answering in one buffer, unlike the streamed band sets
+COALESCED_ENDPOINTS = {"full_image", "tile", "pca", "pca_tile", "pca_preview"}
+QUEUE_TIMEOUT = configuration.get("QueueTimeout", 10)
+RETRY_AFTER = configuration.get("RetryAfter", 1)
+
+admissions = {
+    endpoint: Admission(
+        endpoint, limits["Concurrency"], limits["MaxQueued"], QUEUE_TIMEOUT
+    )
+    for endpoint, limits in ADMISSION.items()
+}
+
+
+def instrumented(endpoint):
+    """
+    Decorate a REST callback to publish its metrics under `endpoint`, bound its
+    concurrency, and answer identical concurrent GET requests of the
+    COALESCED_ENDPOINTS once.
+    """
+    flights = SingleFlight(endpoint) if endpoint in COALESCED_ENDPOINTS else None
+    admission = admissions.get(endpoint)
+
+    def decorator(callback):
+        def admit(output, uri, request):
+            if admission is None:
+                callback(output, uri, **request)
+                return
+            try:
+                with admission:
+                    callback(output, uri, **request)
+            except Overloaded as error:
+                output.SetHttpHeader("Retry-After", str(RETRY_AFTER))
+                output.SendHttpStatus(503, str(error).encode())
+
+        def answer(output, uri, request) -> RecordingOutput:
+            output = RecordingOutput(output)
+            admit(output, uri, request)
+            return output
+
+        @functools.wraps(callback)
+        def wrapper(output, uri, **request):
+            output = CountingOutput(output)
+            start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                with active_requests:
+                    if flights is not None and request["method"] == "GET":
+                        key = (
+                            uri,
+                            tuple(sorted(request["get"].items())),
+                            request["headers"].get("if-none-match"),
+                        )
+                        answered = flights.do(key, answer, output, uri, request)
+                        if answered.output is not output:
+                            answered.replay(output)
+                    else:
+                        admit(output, uri, request)
+            finally:
+                seconds = time.perf_counter() - start
+                metrics.observe(
+                    endpoint, seconds, time.thread_time() - cpu_start, output.sent
+                )
+                if seconds > SLOW_REQUEST_SECONDS:
+                    orthanc.LogWarning(f"Slow request {uri} took {seconds:.3f}s")
+
+        return wrapper
+
+    return decorator
+
+
+def rest_api_get(uri):
+    """Call the REST API of Orthanc from within the plugin, counting the calls."""
+    metrics.increment("rest_api_get_calls")
+    return orthanc.RestApiGet(uri)
+
+
+class LRUCache:
+    """Thread-safe mapping bounded by the total size of its values."""
+
+    def __init__(self, name, max_size, sizeof=len):
+        self.name = name
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            hit = key in self.entries
+            if hit:
+                self.entries.move_to_end(key)
+                value = self.entries[key][0]
+        metrics.lookup(self.name, hit)
+        return value if hit else None
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+            size = self.size
+        metrics.set(f"{self.name}_cache_bytes", size)
+
+    def invalidate(self, predicate):
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.size -= self.entries.pop(key)[1]
+
+
+class DiskCache:
+    """Size-bounded directory of files, evicting the least recently used ones."""
+
+    def __init__(self, name, directory, max_size):
+        self.name = name
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+        # resume the cache left by a previous run, oldest files first
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                key = os.path.relpath(path, directory).replace(os.sep, "/")
+                files.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        self.remove(self.evict())
+
+    def get(self, key) -> bytes:
+        with self.lock:
+            hit = key in self.entries
+            if hit:
+                self.entries.move_to_end(key)
+        if hit:
+            try:
+                with open(os.path.join(self.directory, key), "rb") as f:
+                    data = f.read()
+            except OSError:
+                self.invalidate(lambda k: k == key)
+                hit = False
+        metrics.lookup(self.name, hit)
+        return data if hit else None
+
+    def put(self, key, data):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write aside then rename, so that readers never see a partial file
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)
+            self.entries[key] = len(data)
+            self.size += len(data)
+            evicted = self.evict()
+            size = self.size
+        self.remove(evicted)
+        metrics.set(f"{self.name}_cache_bytes", size)
+
+    def invalidate(self, predicate):
+        with self.lock:
+            evicted = [key for key in self.entries if predicate(key)]
+            for key in evicted:
+                self.size -= self.entries.pop(key)
+        self.remove(evicted)
+
+    def evict(self) -> list:
+        evicted = []
+        while self.size > self.max_size and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            evicted.append(key)
+        return evicted
+
+    def remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except OSError:
+                pass
+
+
+class InvalidRequest(Exception):
+    """Raised on invalid parameters, answered with a 400 Bad Request."""
+
+
+def get_int_parameter(parameters, name, default=None) -> int:
+    if name not in parameters:
+        return default
+    try:
+        return int(parameters[name])
+    except ValueError:
+        raise InvalidRequest(f"Invalid {name}: {parameters[name]}")
+
+
+def get_bool_parameter(parameters, name, default=False) -> bool:
+    if name not in parameters:
+        return default
+    value = parameters[name].lower()
+    if value in ("1", "true", "yes"):
+        return True
+    if value in ("0", "false", "no"):
+        return False
+    raise InvalidRequest(f"Invalid {name}: {parameters[name]}")
+
+
+def get_json_body(request):
+    try:
+        return json.loads(request["body"])
+    except ValueError:
+        raise InvalidRequest("The body must be JSON")
+
+
+PIXEL_FORMATS = {
+    1: orthanc.PixelFormat.GRAYSCALE8,
+    3: orthanc.PixelFormat.RGB24,
+}
+
+
+def image_to_array(image) -> np.ndarray:
+    """
+    View an orthanc.Image as a (rows, columns, channels) array, of uint16 for
+    16-bit grayscale images and of uint8 otherwise.
+    """
+    pixel_format = image.GetImagePixelFormat()
+    if pixel_format == orthanc.PixelFormat.GRAYSCALE16:
+        dtype, channels = np.uint16, 1
+    else:
+        if pixel_format not in PIXEL_FORMATS.values():
+            image = image.ConvertPixelFormat(orthanc.PixelFormat.RGB24)
+            pixel_format = orthanc.PixelFormat.RGB24
+        dtype = np.uint8
+        channels = 1 if pixel_format == orthanc.PixelFormat.GRAYSCALE8 else 3
+    width = image.GetImageWidth()
+    height = image.GetImageHeight()
+    rows = np.frombuffer(image.GetImageBuffer(), dtype=np.uint8).reshape(
+        height, image.GetImagePitch()
+    )
+    row_size = width * channels * np.dtype(dtype).itemsize
+    return rows[:, :row_size].view(dtype).reshape(height, width, channels)
+
+
+# decodes of the same image by concurrent requests and jobs, shared
+decodes = SingleFlight("decodes")
+
+
+def decode_raw_frame(band) -> np.ndarray:
+    """Decode an image, or a frame of a multi-frame instance, at its bit depth."""
+    return decodes.do(band, read_raw_frame, band)
+
+
+def read_raw_frame(band) -> np.ndarray:
+    instance, frame = spectraloptica.parse_band(band)
+    if frame is not None and get_transfer_syntax(instance) in BROWSER_TRANSFER_SYNTAXES:
+        # the JPEG fragment of the frame, instead of the whole instance
+        image = orthanc.UncompressImage(
+            get_response_image(band), orthanc.ImageFormat.JPEG
+        )
+    else:
+        dicom = orthanc.GetDicomForInstance(instance)
+        image = orthanc.DecodeDicomImage(dicom, frame or 0)
+    return image_to_array(image)
+
+
+def decode_frame(band) -> np.ndarray:
+    """Decode an image to 8 bits, high bit depths through their default window."""
+    array = decode_raw_frame(band)
+    if array.dtype != np.uint8:
+        array = apply_window(array, *get_default_window(band))
+    return array
+
+
+# instance ID -> (low, high) pixel values shown from black to white
+default_windows = dict()
+
+
+def get_default_window(band) -> tuple:
+    """
+    The window of the instance if it has one, or the whole range of its stored
+    bits otherwise, the same for all the bands of a camera.
+    """
+    instance = spectraloptica.parse_band(band)[0]
+    window = default_windows.get(instance)
+    if window is None:
+        tags = json.loads(rest_api_get(f"/instances/{instance}/simplified-tags"))
+        try:
+            # the first of the windows of a multi-valued WindowCenter
+            center = float(tags["WindowCenter"].split("\\")[0])
+            width = float(tags["WindowWidth"].split("\\")[0])
+            window = (center - width / 2, center + width / 2)
+        except (KeyError, ValueError):
+            window = (0, 2 ** int(tags.get("BitsStored", 16)) - 1)
+        default_windows[instance] = window
+    return window
+
+
+def apply_window(array, low, high, maximum=255) -> np.ndarray:
+    """Map the [low, high] values of an image to [0, maximum], clipping the rest."""
+    scale = maximum / (high - low) if high > low else 0.0
+    values = (array.astype(np.float32) - low) * scale
+    dtype = np.uint8 if maximum <= 255 else np.uint16
+    return np.clip(values + 0.5, 0, maximum).astype(dtype)
+
+
+def encode_jpeg(array, quality=90) -> bytes:
+    array = np.ascontiguousarray(array)
+    height, width, channels = array.shape
+    return orthanc.CompressJpegImage(
+        PIXEL_FORMATS[channels],
+        width,
+        height,
+        width * channels,
+        array.tobytes(),
+        quality,
+    )
+
 
-        tags = json.loads(
-            orthanc.RestApiGet(f"/instances/{instanceId}/simplified-tags")
+def encode_png(array) -> bytes:
+    array = np.ascontiguousarray(array)
+    height, width, channels = array.shape
+    if array.dtype == np.uint16:
+        pixel_format = orthanc.PixelFormat.GRAYSCALE16
+    else:
+        pixel_format = PIXEL_FORMATS[channels]
+    return orthanc.CompressPngImage(
+        pixel_format, width, height, width * channels * array.itemsize, array.tobytes()
+    )
+
+
+def halve(array) -> np.ndarray:
+    """Downscale an image by 2 with a box filter, rounding odd sizes up."""
+    height, width = array.shape[:2]
+    if height % 2 or width % 2:
+        array = np.pad(array, ((0, height % 2), (0, width % 2), (0, 0)), mode="edge")
+    total = array[0::2, 0::2].astype(np.uint16)
+    total += array[1::2, 0::2]
+    total += array[0::2, 1::2]
+    total += array[1::2, 1::2]
+    total += 2
+    total >>= 2
+    return total.astype(np.uint8)
+
+
+# (x, y) pixel spacing of the instances, read once from their tags
+pixel_spacings = dict()
+# series -> (number of changes, instances) of the series whose pixel spacings
+# are known
+series_instances = dict()
+
+
+def get_pixel_spacing(band) -> np.ndarray:
+    instance = spectraloptica.parse_band(band)[0]
+    spacing = pixel_spacings.get(instance)
+    if spacing is None:
+        tags = json.loads(rest_api_get(f"/instances/{instance}/simplified-tags"))
+        spacing = pixel_spacings[instance] = spectraloptica.parse_pixel_spacing(
+            tags["PixelSpacing"]
         )
+    return spacing
+
 
-        pixel_spacing = [float(x) for x in tags["PixelSpacing"].split("\\")]
+def get_series_pixel_spacings(seriesId) -> dict:
+    """Return the pixel spacing of every instance of a series, in one lookup."""
+    changes = series_changes.get(seriesId, 0)
+    changes_and_instances = series_instances.get(seriesId)
+    if changes_and_instances is not None and changes_and_instances[0] == changes:
+        instances = changes_and_instances[1]
+    else:
+        all_tags = json.loads(
+            rest_api_get(f"/series/{seriesId}/instances-tags?simplify")
+        )
+        for instance, tags in all_tags.items():
+            if "PixelSpacing" in tags:
+                pixel_spacings[instance] = spectraloptica.parse_pixel_spacing(
+                    tags["PixelSpacing"]
+                )
+        instances = list(all_tags)
+        series_instances[seriesId] = (changes, instances)
+    return {
+        instance: pixel_spacings[instance]
+        for instance in instances
+        if instance in pixel_spacings
+    }
 
-        position = {"x": x * pixel_spacing[0], "y": y * pixel_spacing[1]}
 
-        output.AnswerBuffer(json.dumps(position, indent=3), "application/json")
+@instrumented("position")
+def compute_landmark(output, uri, **request):
+    if request["method"] == "GET":
+        instanceId = request["groups"][0]
+        orthanc.LogInfo(f"Compute position of {request['get']} at {instanceId}")
+        try:
+            x = float(request["get"]["x"])
+            y = float(request["get"]["y"])
+            pixel_spacing = get_pixel_spacing(instanceId)
+            position = {"x": x * pixel_spacing[0], "y": y * pixel_spacing[1]}
+            output.AnswerBuffer(json.dumps(position, indent=3), "application/json")
+        except (KeyError, ValueError) as error:
+            output.SendHttpStatus(400, str(error).encode())
     else:
         output.SendMethodNotAllowed("GET")
 
 
+# measure a batch of points, distances, polylines and polygons drawn on the
+# images of a series, e.g. {"instance": id, "points": [[x, y]],
+# "distances": [[[x, y], [x, y]]], "polylines": [...], "polygons": [...]}
+@instrumented("measurements")
+def measurements(output, uri, **request):
+    if request["method"] == "POST":
+        seriesId = request["groups"][0]
+        orthanc.LogInfo(f"Measure shapes on {seriesId}")
+        try:
+            body = get_json_body(request)
+            if not isinstance(body, dict):
+                raise InvalidRequest("The body must be a JSON object")
+            spacings = get_series_pixel_spacings(seriesId)
+            if not spacings:
+                raise InvalidRequest(f"No pixel spacing in {seriesId}")
+            # the images of a series usually share their spacing
+            instance = body.get("instance", next(iter(spacings)))
+            # the frames of an instance share its spacing
+            instance = spectraloptica.parse_band(instance)[0]
+            if instance not in spacings:
+                raise InvalidRequest(f"No pixel spacing for {instance}")
+            try:
+                result = spectraloptica.measure(body, spacings[instance])
+            except ValueError as error:
+                raise InvalidRequest(str(error))
+            output.AnswerBuffer(json.dumps(result), "application/json")
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("POST")
+
+
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/measurements", measurements)
 orthanc.RegisterRestCallback("/spectraloptica/(.*)/position", compute_landmark)
 
 
-def get_response_image(instance) -> bytearray:
-    return orthanc.RestApiGet(f"/instances/{instance}/content/7fe0-0010/1")
+def get_response_image(band) -> bytearray:
+    instance, frame = spectraloptica.parse_band(band)
+    # the first fragment is the offset table, then every frame has its own
+    fragment = 1 if frame is None else frame + 1
+    return rest_api_get(f"/instances/{instance}/content/7fe0-0010/{fragment}")
 
 
-def get_response_thumbnail(instance) -> bytearray:
-    return orthanc.RestApiGet(f"/instances/{instance}/attachments/thumbnail/data")
+def get_response_thumbnail(band) -> bytearray:
+    instance, frame = spectraloptica.parse_band(band)
+    if frame is not None:
+        raise ValueError("No thumbnail is stored for the frames of an instance")
+    return rest_api_get(f"/instances/{instance}/attachments/thumbnail/data")
 
 
-# send single image
+# DICOM instances never change once stored, so browsers may keep their images
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# (image name, attachment name) -> MD5 of the attachment of its instance
+attachment_md5s = dict()
+
+
+def is_of_instances(band, instances) -> bool:
+    """Whether an image is one of some instances, or one of their frames."""
+    return spectraloptica.parse_band(band)[0] in instances
+
+
+def get_attachment_md5(band, attachment) -> str:
+    key = (band, attachment)
+    md5 = attachment_md5s.get(key)
+    if md5 is None:
+        instance = spectraloptica.parse_band(band)[0]
+        try:
+            md5 = rest_api_get(
+                f"/instances/{instance}/attachments/{attachment}/md5"
+            ).decode()
+        except ValueError:
+            # Orthanc may be configured not to store the MD5 of attachments
+            md5 = ""
+        attachment_md5s[key] = md5
+    return md5
+
+
+def get_etag(instance, attachment) -> str:
+    return '"%s-%s"' % (instance, get_attachment_md5(instance, attachment))
+
+
+def get_thumbnail_etag(band) -> str:
+    """
+    The ETag of the thumbnail of an image, or None if nothing tells whether it
+    changed, e.g. after the instance was stored again with other pixels.
+    """
+    if spectraloptica.parse_band(band)[1] is None:
+        md5 = get_attachment_md5(band, "thumbnail")
+        if md5:
+            return '"%s-%s"' % (band, md5)
+    # rendered from the pixel data instead, see get_thumbnail()
+    md5 = get_attachment_md5(band, "dicom")
+    if md5:
+        return '"%s-%s-preview"' % (band, md5)
+    return None
+
+
+def invalidate_attachments(instances):
+    for key in [
+        key for key in list(attachment_md5s) if is_of_instances(key[0], instances)
+    ]:
+        attachment_md5s.pop(key, None)
+
+
+def answer_not_modified(output, request, etag, cache_control) -> bool:
+    """Set the validators of an answer, and send a 304 if the client is up to date."""
+    output.SetHttpHeader("ETag", etag)
+    output.SetHttpHeader("Cache-Control", cache_control)
+    if is_not_modified(request, etag):
+        output.SendHttpStatusCode(304)
+        return True
+    return False
+
+
+def is_not_modified(request, etag) -> bool:
+    header = request["headers"].get("if-none-match")
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+# Instances stored losslessly, e.g. 16-bit bands in JPEG-LS, JPEG 2000 or RLE,
+# are transcoded to a format browsers can show, at a window of their values.
+# JPEG baseline, which the dicomizer stores by default, is sent as it is.
+BROWSER_TRANSFER_SYNTAXES = {"1.2.840.10008.1.2.4.50"}
+TRANSCODED_FORMATS = {"jpeg": "image/jpeg", "png": "image/png"}
+
+transcoded_cache = DiskCache(
+    "transcoded",
+    os.path.join(CACHE_DIRECTORY, "transcoded"),
+    configuration.get("TranscodedCacheSize", 1024) * MEGABYTE,
+)
+# instance ID -> UID of the transfer syntax of its pixel data
+transfer_syntaxes = dict()
+
+
+def get_transfer_syntax(band) -> str:
+    instance = spectraloptica.parse_band(band)[0]
+    transfer_syntax = transfer_syntaxes.get(instance)
+    if transfer_syntax is None:
+        transfer_syntax = rest_api_get(
+            f"/instances/{instance}/metadata/TransferSyntax"
+        ).decode()
+        transfer_syntaxes[instance] = transfer_syntax
+    return transfer_syntax
+
+
+def get_window_parameter(parameters) -> tuple:
+    if "window" not in parameters:
+        return None
+    try:
+        low, high = [float(value) for value in parameters["window"].split(",")]
+    except ValueError:
+        raise InvalidRequest(f"Invalid window: {parameters['window']}")
+    if high <= low:
+        raise InvalidRequest("The window must be low,high with low < high")
+    return low, high
+
+
+def transcode(instance, window, image_format, depth, quality, rendering=None) -> bytes:
+    """
+    Render an image in a browser format, mapping the `window` of its values,
+    or its default window, to 8 bits, or to 16 bits for PNG. A contrast
+    enhancement applies to the image at its default window.
+    """
+    key = "%s/%s_%d_%d%s.%s" % (
+        instance,
+        "default" if window is None else "%g_%g" % window,
+        depth,
+        quality,
+        "" if rendering is None else f"_{get_rendering_key(rendering)}",
+        image_format,
+    )
+    data = transcoded_cache.get(key)
+    if data is None:
+        array = decode_raw_frame(instance)
+        if rendering is not None:
+            if array.dtype != np.uint8:
+                array = apply_window(array, *get_default_window(instance))
+            array = render(array, instance, rendering)
+        elif depth == 16:
+            if array.dtype != np.uint16:
+                raise InvalidRequest("Only 16-bit grayscale images have 16-bit PNG")
+            if window is not None:
+                array = apply_window(array, *window, maximum=0xFFFF)
+        elif array.dtype != np.uint8 or window is not None:
+            array = apply_window(array, *(window or get_default_window(instance)))
+        if image_format == "png":
+            data = encode_png(array)
+        else:
+            data = encode_jpeg(array, quality)
+        transcoded_cache.put(key, data)
+    return data
+
+
+def invalidate_transcoded(instances):
+    transcoded_cache.invalidate(lambda key: key.split("/", 1)[0] in instances)
+    for instance in instances:
+        transfer_syntaxes.pop(instance, None)
+        default_windows.pop(instance, None)
+
+
+# send single image, as stored or transcoded to a ?format=jpeg|png at a
+# ?window=low,high of its values, or to a ?depth=16 PNG of 16-bit grayscale, or
+# enhanced by ?stretch=, ?gamma= and ?clahe=
+@instrumented("full_image")
 def image(output, uri, **request):
     if request["method"] == "GET":
         instanceId = request["groups"][0]
-        orthanc.LogWarning(f"Request full image of {instanceId}")
+        orthanc.LogInfo(f"Request full image of {instanceId}")
         try:
             instanceId = request["groups"][0]
-            image_binary = get_response_image(instanceId)
-            output.AnswerBuffer(image_binary, "image/jpeg")
+            parameters = request["get"]
+            window = get_window_parameter(parameters)
+            depth = get_int_parameter(parameters, "depth", 8)
+            if depth not in (8, 16):
+                raise InvalidRequest(f"Invalid depth: {depth}")
+            image_format = parameters.get("format", "png" if depth == 16 else "jpeg")
+            if image_format not in TRANSCODED_FORMATS or (
+                depth == 16 and image_format != "png"
+            ):
+                raise InvalidRequest(f"Invalid format: {image_format}")
+            quality = get_int_parameter(parameters, "quality", 90)
+            if not 1 <= quality <= 100:
+                raise InvalidRequest(f"Invalid quality: {quality}")
+            rendering = get_rendering(parameters)
+            if rendering is not None and (window is not None or depth != 8):
+                raise InvalidRequest(
+                    "Contrast enhancements apply at 8 bits, unwindowed"
+                )
+            transcoded = (
+                window is not None
+                or depth != 8
+                or image_format != "jpeg"
+                or rendering is not None
+                or get_transfer_syntax(instanceId) not in BROWSER_TRANSFER_SYNTAXES
+            )
+            etag = get_etag(instanceId, "dicom")
+            if transcoded:
+                etag = '%s-%s-%d-%d%s-%s"' % (
+                    etag[:-1],
+                    "default" if window is None else "%g-%g" % window,
+                    depth,
+                    quality,
+                    "" if rendering is None else f"-{get_rendering_key(rendering)}",
+                    image_format,
+                )
+            if answer_not_modified(output, request, etag, IMMUTABLE_CACHE_CONTROL):
+                return
+            if transcoded:
+                output.AnswerBuffer(
+                    transcode(
+                        instanceId,
+                        window,
+                        image_format,
+                        depth,
+                        quality,
+                        rendering,
+                    ),
+                    TRANSCODED_FORMATS[image_format],
+                )
+            else:
+                output.AnswerBuffer(get_response_image(instanceId), "image/jpeg")
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
         except Exception as error:
             orthanc.LogError(error)
     else:
@@ -90,14 +1027,19 @@ orthanc.RegisterRestCallback("/spectraloptica/(.*)/full-image", image)
 
 
 # send single image
+@instrumented("thumbnail")
 def thumbnail(output, uri, **request):
     if request["method"] == "GET":
         instanceId = request["groups"][0]
-        orthanc.LogWarning(f"Request thumbnail image of {instanceId}")
+        orthanc.LogInfo(f"Request thumbnail image of {instanceId}")
         try:
             instanceId = request["groups"][0]
-            image_binary = get_response_thumbnail(instanceId)
-            output.AnswerBuffer(image_binary, "image/jpeg")
+            etag = get_thumbnail_etag(instanceId)
+            if etag is None:
+                output.SetHttpHeader("Cache-Control", "no-cache")
+            elif answer_not_modified(output, request, etag, IMMUTABLE_CACHE_CONTROL):
+                return
+            output.AnswerBuffer(get_thumbnail(instanceId), "image/jpeg")
         except Exception as error:
             orthanc.LogError(error)
     else:
@@ -107,121 +1049,2248 @@ def thumbnail(output, uri, **request):
 orthanc.RegisterRestCallback("/spectraloptica/(.*)/thumbnail", thumbnail)
 
 
-# send images
-def images(output, uri, **request):
-    if request["method"] == "GET":
-        seriesId = request["groups"][0]
-        orthanc.LogWarning(f"Request Spectraloptica camera images of {seriesId}")
-        try:
-            orthanc_dict = json.loads(
-                orthanc.RestApiGet(f"/series/{seriesId}/instances-tags?simplify")
-            )
+# Multi-resolution tile pyramid, with DeepZoom conventions: level `max_level`
+# is the full resolution image and every level below halves it, down to 1x1.
+TILE_SIZE = configuration.get("TileSize", 256)
+TILE_QUALITY = configuration.get("TileQuality", 85)
+
+# downscaled levels of recently tiled instances, keyed by (instance, level),
+# or by (instance, level, digest of the transform) once aligned
+decoded_levels = LRUCache(
+    "decoded_levels",
+    configuration.get("DecodedCacheSize", 1024) * MEGABYTE,
+    sizeof=lambda array: array.nbytes,
+)
+tiles_cache = DiskCache(
+    "tiles",
+    os.path.join(CACHE_DIRECTORY, "tiles"),
+    configuration.get("TilesCacheSize", 2048) * MEGABYTE,
+)
+# serializes the decoding of a given level, so that concurrent requests for
+# the tiles of a level not decoded yet do not all decode it
+level_locks = KeyedLocks()
+# instance ID -> (width, height), shared by its frames
+image_sizes = dict()
+
+
+def get_image_size(band):
+    instance = spectraloptica.parse_band(band)[0]
+    size = image_sizes.get(instance)
+    if size is None:
+        tags = json.loads(rest_api_get(f"/instances/{instance}/simplified-tags"))
+        size = (int(tags["Columns"]), int(tags["Rows"]))
+        image_sizes[instance] = size
+    return size
+
+
+def get_max_level(width, height) -> int:
+    return math.ceil(math.log2(max(width, height, 1)))
+
 
-            to_jsonify = {}
-            encoded_images = []
-            individual_images = dict()
-            height = 0
-            width = 0
-            thumbnail = False
-            for instance, tags in orthanc_dict.items():
-                attachments = json.loads(
-                    orthanc.RestApiGet(f"/instances/{instance}/attachments")
+def get_level(instance, level, aligned=False) -> np.ndarray:
+    """Return a level of an image, moved onto its reference band if `aligned`."""
+    matrix, digest = get_transform(instance) if aligned else (None, None)
+    key = (instance, level) if digest is None else (instance, level, digest)
+    array = decoded_levels.get(key)
+    if array is not None:
+        return array
+    with level_locks.hold(key):
+        array = decoded_levels.get(key)
+        if array is None:
+            width, height = get_image_size(instance)
+            max_level = get_max_level(width, height)
+            if digest is not None:
+                array = spectraloptica.registration.warp(
+                    get_level(instance, level),
+                    spectraloptica.registration.scale_transform(
+                        matrix, 2.0 ** (min(level, max_level) - max_level)
+                    ),
                 )
-                thumbnail = "thumbnail" in attachments
-                try:
-                    width = tags["Columns"]
-                    height = tags["Rows"]
-                    image = {
-                        "name": instance,
-                        "label": tags["UserContentLabel"],
-                        "filter": {
-                            "type": (
-                                "VIS"
-                                if not "ImagePathFilterPassThroughWavelength" in tags
-                                or not tags["ImagePathFilterPassThroughWavelength"]
-                                else (
-                                    "UV"
-                                    if float(
-                                        tags["ImagePathFilterPassThroughWavelength"]
-                                    )
-                                    < 400
-                                    else "IR"
-                                )
-                            ),
-                            "description": "",
-                        },
-                        "wavelength": {
-                            "type": (
-                                "VIS"
-                                if not "IlluminationWaveLength" in tags
-                                or not tags["IlluminationWaveLength"]
-                                or (
-                                    float(tags["IlluminationWaveLength"]) >= 400
-                                    and float(tags["IlluminationWaveLength"]) <= 700
-                                )
-                                else (
-                                    "UV"
-                                    if float(tags["IlluminationWaveLength"]) < 400
-                                    else "IR"
-                                )
-                            ),
-                            "value": (
-                                float(tags["IlluminationWaveLength"])
-                                if "IlluminationWaveLength" in tags
-                                else None
-                            ),
-                        },
-                    }
-                    if "WAVELENGTH" in tags["ImageType"]:
-                        encoded_images.append(image)
-                    else:
-                        individual_images[tags["UserContentLabel"]] = image
-                except Exception as error:
-                    print(error)
-                    continue
+            elif level >= max_level:
+                array = decode_frame(instance)
+            else:
+                array = halve(get_level(instance, level + 1))
+            decoded_levels.put(key, array)
+    return array
 
-            to_jsonify = {
-                "spectralImages": sorted(
-                    encoded_images, key=lambda image: image["wavelength"]["value"]
-                ),
-                "individualImages": individual_images,
-                "size": {"height": height, "width": width},
-                "thumbnails": thumbnail,
+
+def get_tile(instance, level, x, y, aligned=False, rendering=None) -> bytes:
+    digest = get_transform(instance)[1] if aligned else None
+    if digest is None:
+        key = f"{instance}/{level}/{x}_{y}"
+    else:
+        key = f"{instance}/{digest}/{level}/{x}_{y}"
+    if rendering is not None:
+        key += f"_{get_rendering_key(rendering)}"
+    key += ".jpg"
+    tile = tiles_cache.get(key)
+    if tile is None:
+        array = get_level(instance, level, aligned)
+        region = array[
+            y * TILE_SIZE : (y + 1) * TILE_SIZE,
+            x * TILE_SIZE : (x + 1) * TILE_SIZE,
+        ]
+        if rendering is not None:
+            tables = None
+            if rendering["clahe"] is not None:
+                tables = get_equalization_tables(instance, level, aligned, rendering)
+            region = render(
+                region,
+                instance,
+                rendering,
+                tables,
+                x * TILE_SIZE,
+                y * TILE_SIZE,
+                array.shape[1],
+                array.shape[0],
+            )
+        tile = encode_jpeg(region, TILE_QUALITY)
+        tiles_cache.put(key, tile)
+    return tile
+
+
+def invalidate_tiles(instances):
+    decoded_levels.invalidate(lambda key: is_of_instances(key[0], instances))
+    band_arrays.invalidate(lambda key: is_of_instances(key[0], instances))
+    tiles_cache.invalidate(lambda key: key.split("/", 1)[0] in instances)
+    for instance in instances:
+        image_sizes.pop(instance, None)
+
+
+# send the description of the pyramid of an image
+@instrumented("tiles")
+def tiles(output, uri, **request):
+    if request["method"] == "GET":
+        instanceId = request["groups"][0]
+        try:
+            width, height = get_image_size(instanceId)
+            description = {
+                "width": width,
+                "height": height,
+                "tileSize": TILE_SIZE,
+                "overlap": 0,
+                "format": "jpg",
+                "minLevel": 0,
+                "maxLevel": get_max_level(width, height),
             }
-            output.AnswerBuffer(json.dumps(to_jsonify), "application/json")
+            output.AnswerBuffer(json.dumps(description), "application/json")
         except ValueError as e:
             orthanc.LogError(e)
     else:
         output.SendMethodNotAllowed("GET")
 
 
-orthanc.RegisterRestCallback("/spectraloptica/(.*)/images", images)
-extension = """
-    const SPECTRALOPTICA_PLUGIN_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.77.1.4'
-    $('#series').live('pagebeforeshow', function() {
-      var seriesId = $.mobile.pageData.uuid;
-    
-      GetResource('/series/' + seriesId, function(series) {
-        GetResource('/instances/' + series['Instances'][0] + '/tags?simplify', function(instance) {
-
-          if (instance['SOPClassUID'] == SPECTRALOPTICA_PLUGIN_SOP_CLASS_UID) {
-            $('#spectraloptica-button').remove();
-
-            var b = $('<a>')
-                .attr('id', 'spectraloptica-button')
-                .attr('data-role', 'button')
-                .attr('href', '#')
-                .attr('data-icon', 'search')
-                .attr('data-theme', 'e')
-                .text('Spectraloptica Viewer')
-                .button();
-
-            b.insertAfter($('#series-info'));
-            b.click(function(e) {
-              window.open('../spectraloptica/ui/index.html?series=' + seriesId);
-            })
-          }
-        });
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/tiles", tiles)
+
+
+# send a single tile of the pyramid of an image, moved onto the reference band
+# of its series with ?align=1
+@instrumented("tile")
+def tile(output, uri, **request):
+    if request["method"] == "GET":
+        instanceId, level, x, y = request["groups"]
+        level, x, y = int(level), int(x), int(y)
+        orthanc.LogInfo(f"Request tile {level}/{x}/{y} of {instanceId}")
+        try:
+            width, height = get_image_size(instanceId)
+            max_level = get_max_level(width, height)
+            scale = 2 ** (max_level - level)
+            if (
+                level > max_level
+                or x * TILE_SIZE >= math.ceil(width / scale)
+                or y * TILE_SIZE >= math.ceil(height / scale)
+            ):
+                output.SendHttpStatusCode(404)
+                return
+            aligned = get_bool_parameter(request["get"], "align")
+            rendering = get_rendering(request["get"])
+            etag = '"%s-%s-%d-%d-%d%s%s"' % (
+                instanceId,
+                get_attachment_md5(instanceId, "dicom"),
+                level,
+                x,
+                y,
+                # the alignment changes with the series, unlike the instance
+                f"-{get_transform(instanceId)[1] or 'identity'}" if aligned else "",
+                "" if rendering is None else f"-{get_rendering_key(rendering)}",
+            )
+            if answer_not_modified(output, request, etag, IMMUTABLE_CACHE_CONTROL):
+                return
+            output.AnswerBuffer(
+                get_tile(instanceId, level, x, y, aligned, rendering), "image/jpeg"
+            )
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+orthanc.RegisterRestCallback(
+    "/spectraloptica/(.*)/tiles/([0-9]+)/([0-9]+)/([0-9]+)", tile
+)
+
+
+# Resized renditions of the images, for the band strip and mid-zoom views
+PREVIEW_FORMATS = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+# largest side of the previews generated when a series becomes stable
+PREVIEW_SIZES = configuration.get("PreviewSizes", [256, 1024])
+# largest side of the thumbnails generated when the dicomizer stored none
+THUMBNAIL_SIZE = configuration.get("ThumbnailSize", 256)
+
+previews_cache = DiskCache(
+    "previews",
+    os.path.join(CACHE_DIRECTORY, "previews"),
+    configuration.get("PreviewsCacheSize", 1024) * MEGABYTE,
+)
+
+
+def fit(width, height, max_width, max_height):
+    """Size of an image scaled down to fit in a box, keeping its aspect ratio."""
+    scale = min(max_width / width, max_height / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def resize(array, width, height) -> np.ndarray:
+    """Downscale an image, averaging the source pixels covered by each pixel."""
+    source_height, source_width = array.shape[:2]
+    if (source_width, source_height) == (width, height):
+        return array
+    rows = np.linspace(0, source_height, height + 1).astype(np.intp)
+    columns = np.linspace(0, source_width, width + 1).astype(np.intp)
+    total = np.add.reduceat(array.astype(np.uint32), rows[:-1], axis=0)
+    total = np.add.reduceat(total, columns[:-1], axis=1)
+    area = np.diff(rows)[:, np.newaxis, np.newaxis] * np.diff(columns)[:, np.newaxis]
+    return ((total + area // 2) // area).astype(np.uint8)
+
+
+def encode(array, image_format, quality) -> bytes:
+    if image_format == "jpeg":
+        return encode_jpeg(array, quality)
+    if image_format == "png":
+        return encode_png(array)
+    # Orthanc has no WebP encoder
+    if PILImage is None:
+        raise InvalidRequest("WebP previews need Pillow to be installed")
+    buffer = BytesIO()
+    PILImage.fromarray(array[:, :, 0] if array.shape[2] == 1 else array).save(
+        buffer, format="WEBP", quality=quality
+    )
+    return buffer.getvalue()
+
+
+def get_preview(
+    instance, max_width, max_height, image_format="jpeg", quality=85, rendering=None
+):
+    image_width, image_height = get_image_size(instance)
+    width, height = fit(image_width, image_height, max_width, max_height)
+    key = f"{instance}/{width}x{height}_q{quality}"
+    if rendering is not None:
+        key += f"_{get_rendering_key(rendering)}"
+    key += f".{image_format}"
+    preview = previews_cache.get(key)
+    if preview is None:
+        # resample the smallest level of the pyramid still larger than the preview
+        max_level = level = get_max_level(image_width, image_height)
+        while level > 0 and max(image_width, image_height) >= 2 ** (
+            max_level - level + 1
+        ) * max(width, height):
+            level -= 1
+        array = resize(get_level(instance, level), width, height)
+        preview = encode(render(array, instance, rendering), image_format, quality)
+        previews_cache.put(key, preview)
+    return preview
+
+
+def get_thumbnail(instance):
+    try:
+        return get_response_thumbnail(instance)
+    except ValueError:
+        # no thumbnail was stored along with the instance
+        return get_preview(instance, THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+
+
+def precompute_previews(instance):
+    get_preview(instance, THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+    for size in PREVIEW_SIZES:
+        get_preview(instance, size, size)
+
+
+def invalidate_previews(instances):
+    previews_cache.invalidate(lambda key: key.split("/", 1)[0] in instances)
+
+
+# send a resized rendition of an image
+@instrumented("preview")
+def preview(output, uri, **request):
+    if request["method"] == "GET":
+        instanceId = request["groups"][0]
+        parameters = request["get"]
+        orthanc.LogInfo(f"Request preview {parameters} of {instanceId}")
+        try:
+            width, height = get_image_size(instanceId)
+            max_width = get_int_parameter(parameters, "w", width)
+            max_height = get_int_parameter(parameters, "h", height)
+            quality = get_int_parameter(parameters, "q", 85)
+            image_format = parameters.get("format", "jpeg")
+            if max_width < 1 or max_height < 1:
+                raise InvalidRequest("The size of a preview must be positive")
+            if not 1 <= quality <= 100:
+                raise InvalidRequest(f"Invalid quality: {quality}")
+            if image_format not in PREVIEW_FORMATS:
+                raise InvalidRequest(f"Invalid format: {image_format}")
+            rendering = get_rendering(parameters)
+            etag = '"%s-%s-%dx%d-q%d%s.%s"' % (
+                instanceId,
+                get_attachment_md5(instanceId, "dicom"),
+                *fit(width, height, max_width, max_height),
+                quality,
+                "" if rendering is None else f"-{get_rendering_key(rendering)}",
+                image_format,
+            )
+            if answer_not_modified(output, request, etag, IMMUTABLE_CACHE_CONTROL):
+                return
+            output.AnswerBuffer(
+                get_preview(
+                    instanceId,
+                    max_width,
+                    max_height,
+                    image_format,
+                    quality,
+                    rendering,
+                ),
+                PREVIEW_FORMATS[image_format],
+            )
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/preview", preview)
+
+
+# Contrast enhancement of the dark or flat UV and IR bands, on the server. The
+# statistics of every image are computed once and listed in the manifest, and
+# the full image, previews and tiles take ?stretch=auto|pLOW-HIGH, ?gamma= and
+# ?clahe=<clip limit> (over a ?clahe-grid= of regions) to be sent enhanced.
+MAX_GAMMA = 10.0
+DEFAULT_CLAHE_GRID = 8
+MAX_CLAHE_GRID = 64
+
+statistics_cache = DiskCache(
+    "statistics",
+    os.path.join(CACHE_DIRECTORY, "statistics"),
+    configuration.get("StatisticsCacheSize", 64) * MEGABYTE,
+)
+# image name -> statistics of its luminance, see spectraloptica.contrast.describe()
+image_statistics = dict()
+# equalization tables of whole levels, shared by their tiles, keyed by
+# (instance, level, digest of the transform, stretch, CLAHE parameters)
+equalization_tables = LRUCache(
+    "equalization_tables", 64 * MEGABYTE, sizeof=lambda tables: tables.nbytes
+)
+
+
+def load_statistics(band) -> dict:
+    """Return the statistics of an image if they were computed, or None."""
+    statistics = image_statistics.get(band)
+    if statistics is None:
+        data = statistics_cache.get(f"{band}.json")
+        if data is not None:
+            statistics = json.loads(data)
+            image_statistics[band] = statistics
+    return statistics
+
+
+def get_statistics(band) -> dict:
+    """Return the statistics of an image, computing them once."""
+    statistics = load_statistics(band)
+    if statistics is None:
+        level = get_max_level(*get_image_size(band))
+        statistics = spectraloptica.contrast.describe(
+            spectraloptica.contrast.histogram(to_luminance(get_level(band, level)))
+        )
+        statistics_cache.put(f"{band}.json", json.dumps(statistics).encode())
+        image_statistics[band] = statistics
+    return statistics
+
+
+def invalidate_statistics(instances):
+    for band in [
+        band for band in list(image_statistics) if is_of_instances(band, instances)
+    ]:
+        image_statistics.pop(band, None)
+    statistics_cache.invalidate(
+        lambda key: is_of_instances(key[: -len(".json")], instances)
+    )
+    equalization_tables.invalidate(lambda key: is_of_instances(key[0], instances))
+
+
+def add_statistics_to_manifest(seriesId):
+    """Rebuild the manifest of a series once the statistics of its images are known."""
+    manifest = get_manifest(seriesId)[0]
+    if any("statistics" not in image for image in get_manifest_images(manifest)):
+        invalidate_manifest(seriesId)
+
+
+def get_rendering(parameters) -> dict:
+    """Return the contrast enhancement asked by a request, or None."""
+    try:
+        stretch = spectraloptica.contrast.parse_stretch(
+            parameters.get("stretch", "none")
+        )
+    except ValueError as error:
+        raise InvalidRequest(str(error))
+    try:
+        gamma = float(parameters.get("gamma", 1))
+        clip_limit = float(parameters.get("clahe", 0))
+    except ValueError:
+        raise InvalidRequest("gamma and clahe must be numbers")
+    if not 0 < gamma <= MAX_GAMMA:
+        raise InvalidRequest(f"Invalid gamma: {gamma}")
+    if clip_limit and not 1 <= clip_limit < math.inf:
+        raise InvalidRequest(f"Invalid clip limit of CLAHE: {clip_limit}")
+    grid = get_int_parameter(parameters, "clahe-grid", DEFAULT_CLAHE_GRID)
+    if not 1 <= grid <= MAX_CLAHE_GRID:
+        raise InvalidRequest(f"Invalid grid of CLAHE: {grid}")
+    if stretch is None and gamma == 1 and not clip_limit:
+        return None
+    return {
+        "stretch": stretch,
+        "gamma": gamma,
+        "clahe": (grid, clip_limit) if clip_limit else None,
+    }
+
+
+def get_rendering_key(rendering) -> str:
+    """Identify a contrast enhancement in cache keys and ETags."""
+    parts = []
+    if rendering["stretch"] is not None:
+        parts.append("p%g-%g" % rendering["stretch"])
+    if rendering["gamma"] != 1:
+        parts.append("g%g" % rendering["gamma"])
+    if rendering["clahe"] is not None:
+        parts.append("clahe%d-%g" % rendering["clahe"])
+    return "_".join(parts)
+
+
+def render(array, band, rendering, tables=None, x=0, y=0, width=None, height=None):
+    """
+    Enhance an image, or the region at (x, y) of a level of (width, height) given
+    the equalization tables of the level, stretched by the statistics of `band`.
+    """
+    if rendering is None:
+        return array
+    if rendering["stretch"] is not None:
+        histogram = get_statistics(band)["histogram"]
+        low, high = [
+            spectraloptica.contrast.percentile(histogram, q)
+            for q in rendering["stretch"]
+        ]
+        array = spectraloptica.contrast.stretch_table(low, high)[array]
+    if rendering["clahe"] is not None:
+        if tables is None:
+            tables = spectraloptica.contrast.clahe_tables(
+                to_luminance(array), *rendering["clahe"]
+            )
+        array = spectraloptica.contrast.apply_clahe(array, tables, x, y, width, height)
+    if rendering["gamma"] != 1:
+        array = spectraloptica.contrast.gamma_table(rendering["gamma"])[array]
+    return array
+
+
+def get_equalization_tables(instance, level, aligned, rendering) -> np.ndarray:
+    """Equalization tables of a whole level, so that its tiles match at the seams."""
+    digest = get_transform(instance)[1] if aligned else None
+    key = (instance, level, digest, rendering["stretch"], rendering["clahe"])
+    tables = equalization_tables.get(key)
+    if tables is None:
+        stretched = render(
+            get_level(instance, level, aligned),
+            instance,
+            {"stretch": rendering["stretch"], "gamma": 1.0, "clahe": None},
+        )
+        tables = spectraloptica.contrast.clahe_tables(
+            to_luminance(stretched), *rendering["clahe"]
+        )
+        equalization_tables.put(key, tables)
+    return tables
+
+
+# wavelengths, in nm, below which light is UV and above which it is IR
+BAND_BOUNDARIES = configuration.get(
+    "BandBoundaries", spectraloptica.DEFAULT_BAND_BOUNDARIES
+)
+SPECTRALOPTICA_SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.77.1.4"
+
+# Series manifests served by images(), keyed by series ID. Each entry holds the
+# serialized JSON and its ETag so that the viewer opening a series costs one
+# dictionary lookup instead of N+1 internal REST calls.
+manifest_lock = threading.Lock()
+manifest_cache = dict()
+# Bumped on every invalidation, so that a manifest built concurrently with a
+# change of its series is never stored.
+manifest_generations = dict()
+# instance ID -> series ID of the instances listed in manifests, needed to
+# invalidate a series when one of its instances is deleted (its parent is then
+# unknown). An instance never changes of series, so this is never outdated.
+series_of_instances = dict()
+manifest_builds = SingleFlight("manifests")
+
+
+def build_manifest(seriesId) -> dict:
+    manifest = spectraloptica.build_manifest(
+        json.loads(rest_api_get(f"/series/{seriesId}/instances-tags?simplify")),
+        BAND_BOUNDARIES,
+        # thumbnails are generated for the instances stored without one
+        thumbnails=True,
+        warn=orthanc.LogWarning,
+    )
+    # the statistics computed so far, the background job adds the others
+    for image in get_manifest_images(manifest):
+        statistics = load_statistics(image["name"])
+        if statistics is not None:
+            image["statistics"] = statistics
+    return manifest
+
+
+def get_manifest(seriesId):
+    """Return the (manifest, body, etag) of a series, building them once."""
+    with manifest_lock:
+        cached = manifest_cache.get(seriesId)
+        generation = manifest_generations.get(seriesId, 0)
+    metrics.lookup("manifests", cached is not None)
+    if cached is not None:
+        return cached
+    # concurrent requests of the same version of the series build it once
+    return manifest_builds.do(
+        (seriesId, generation), cache_manifest, seriesId, generation
+    )
+
+
+def cache_manifest(seriesId, generation):
+    manifest = build_manifest(seriesId)
+    body = json.dumps(manifest)
+    etag = '"%s"' % hashlib.sha1(body.encode()).hexdigest()
+
+    with manifest_lock:
+        if manifest_generations.get(seriesId, 0) == generation:
+            manifest_cache[seriesId] = (manifest, body, etag)
+            for image in get_manifest_images(manifest):
+                series_of_instances[image["name"]] = seriesId
+                # multi-frame instances are deleted by ID, not by frame
+                instance = spectraloptica.parse_band(image["name"])[0]
+                series_of_instances[instance] = seriesId
+    return manifest, body, etag
+
+
+def invalidate_manifest(seriesId):
+    with manifest_lock:
+        manifest_generations[seriesId] = manifest_generations.get(seriesId, 0) + 1
+        manifest_cache.pop(seriesId, None)
+
+
+def is_spectraloptica_series(seriesId) -> bool:
+    series = json.loads(rest_api_get(f"/series/{seriesId}"))
+    if not series["Instances"]:
+        return False
+    tags = json.loads(
+        rest_api_get(f"/instances/{series['Instances'][0]}/tags?simplify")
+    )
+    return tags.get("SOPClassUID") == SPECTRALOPTICA_SOP_CLASS_UID
+
+
+# send images
+@instrumented("images")
+def images(output, uri, **request):
+    if request["method"] == "GET":
+        seriesId = request["groups"][0]
+        orthanc.LogInfo(f"Request Spectraloptica camera images of {seriesId}")
+        try:
+            # somebody opens the series: its precomputation cannot wait
+            background_jobs.prioritize(seriesId)
+            _, body, etag = get_manifest(seriesId)
+            # the manifest changes whenever the series does: always revalidate
+            if not answer_not_modified(output, request, etag, "no-cache"):
+                output.AnswerBuffer(body, "application/json")
+        except ValueError as e:
+            orthanc.LogError(e)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/images", images)
+
+
+# send the thumbnails, or the previews of a given size, of all the images of a
+# series in a single multipart answer: spectral images by wavelength, then the
+# individual images. The `X-Spectraloptica-Instances` header lists the
+# instance of every part, in order.
+@instrumented("band_set")
+def band_set(output, uri, **request):
+    if request["method"] == "GET":
+        seriesId = request["groups"][0]
+        parameters = request["get"]
+        orthanc.LogInfo(f"Request band set {parameters} of {seriesId}")
+        try:
+            size = get_int_parameter(parameters, "size")
+            quality = get_int_parameter(parameters, "q", 85)
+            image_format = parameters.get("format", "jpeg")
+            if size is not None and size < 1:
+                raise InvalidRequest("The size of a preview must be positive")
+            if not 1 <= quality <= 100:
+                raise InvalidRequest(f"Invalid quality: {quality}")
+            if image_format not in PREVIEW_FORMATS:
+                raise InvalidRequest(f"Invalid format: {image_format}")
+            if size is None and image_format != "jpeg":
+                raise InvalidRequest("Thumbnails are only available as JPEG")
+
+            manifest, _, manifest_etag = get_manifest(seriesId)
+            instances = [image["name"] for image in manifest["spectralImages"]] + [
+                image["name"] for image in manifest["individualImages"].values()
+            ]
+            etag = (
+                '"%s"'
+                % hashlib.sha1(
+                    f"{manifest_etag}{size}{quality}{image_format}".encode()
+                ).hexdigest()
+            )
+            if answer_not_modified(output, request, etag, "no-cache"):
+                return
+            output.SetHttpHeader("X-Spectraloptica-Instances", ",".join(instances))
+            output.StartMultipartAnswer("mixed", PREVIEW_FORMATS[image_format])
+            # every image is sent as soon as it is read or rendered
+            for instance in instances:
+                if size is None:
+                    output.SendMultipartItem(get_thumbnail(instance))
+                else:
+                    output.SendMultipartItem(
+                        get_preview(instance, size, size, image_format, quality)
+                    )
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/band-set", band_set)
+
+
+# Index of the Spectraloptica series, with a summary of each, so that they are
+# listed without scanning the archive and told apart from other series without
+# reading their instances. It follows the changes of Orthanc and persists in
+# the cache directory; the series changed while Orthanc was down are caught up
+# with once it starts.
+SERIES_PAGE_SIZE = configuration.get("SeriesPageSize", 100)
+MAX_SERIES_PAGE_SIZE = 1000
+
+
+def summarize_series(seriesId) -> dict:
+    series = json.loads(rest_api_get(f"/series/{seriesId}"))
+    study = json.loads(rest_api_get(f"/studies/{series['ParentStudy']}"))
+    manifest = get_manifest(seriesId)[0]
+    wavelengths = [
+        image["wavelength"]["value"]
+        for image in manifest["spectralImages"]
+        if image["wavelength"]["value"] is not None
+    ]
+    instances = {
+        spectraloptica.parse_band(image["name"])[0]
+        for image in get_manifest_images(manifest)
+    }
+    return {
+        "id": seriesId,
+        "study": series["ParentStudy"],
+        "patientName": study["PatientMainDicomTags"].get("PatientName", ""),
+        "studyDescription": study["MainDicomTags"].get("StudyDescription", ""),
+        "seriesDescription": series["MainDicomTags"].get("SeriesDescription", ""),
+        "lastUpdate": series["LastUpdate"],
+        "bands": len(manifest["spectralImages"]),
+        "individualImages": len(manifest["individualImages"]),
+        "wavelengths": (
+            {"min": min(wavelengths), "max": max(wavelengths)} if wavelengths else None
+        ),
+        "size": {
+            "width": int(manifest["size"]["width"]),
+            "height": int(manifest["size"]["height"]),
+        },
+        # stored by the dicomizer, the others are rendered on demand
+        "thumbnails": all(
+            "thumbnail"
+            in json.loads(rest_api_get(f"/instances/{instance}/attachments"))
+            for instance in instances
+        ),
+    }
+
+
+class SeriesIndex:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # series ID -> summary of the Spectraloptica series
+        self.series = dict()
+        # IDs of the series known not to be Spectraloptica ones
+        self.others = set()
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            self.series = saved["series"]
+            self.others = set(saved["others"])
+        except (OSError, ValueError, KeyError):
+            pass
+        metrics.set("indexed_series", len(self.series))
+
+    def save(self):
+        with self.lock:
+            saved = json.dumps({"series": self.series, "others": list(self.others)})
+            metrics.set("indexed_series", len(self.series))
+        temporary = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(temporary, "w") as f:
+            f.write(saved)
+        os.replace(temporary, self.path)
+
+    def update(self, seriesId) -> bool:
+        """Index a series again, returning whether it is a Spectraloptica one."""
+        spectral = is_spectraloptica_series(seriesId)
+        summary = summarize_series(seriesId) if spectral else None
+        with self.lock:
+            if spectral:
+                self.series[seriesId] = summary
+                self.others.discard(seriesId)
+            else:
+                self.series.pop(seriesId, None)
+                self.others.add(seriesId)
+        self.save()
+        return spectral
+
+    def is_spectral(self, seriesId) -> bool:
+        with self.lock:
+            if seriesId in self.series:
+                return True
+            if seriesId in self.others:
+                return False
+        return self.update(seriesId)
+
+    def changed(self, seriesId):
+        # a new instance may make a Spectraloptica series of any series, which
+        # is indexed once stable
+        with self.lock:
+            self.others.discard(seriesId)
+
+    def forget(self, seriesId):
+        with self.lock:
+            known = seriesId in self.series or seriesId in self.others
+            self.series.pop(seriesId, None)
+            self.others.discard(seriesId)
+        if known:
+            self.save()
+
+    def query(self, match=None) -> list:
+        """The summaries satisfying `match`, most recently updated first."""
+        with self.lock:
+            summaries = list(self.series.values())
+        if match is not None:
+            summaries = [summary for summary in summaries if match(summary)]
+        summaries.sort(key=lambda summary: (summary["lastUpdate"], summary["id"]))
+        summaries.reverse()
+        return summaries
+
+    def catch_up(self):
+        """Index the series stored or deleted while the plugin was not running."""
+        # the dicomizer stores external-camera photographs, a main DICOM tag
+        # of the series that Orthanc finds in its database
+        query = {"Level": "Series", "Query": {"Modality": "XC"}}
+        candidates = set(
+            json.loads(orthanc.RestApiPost("/tools/find", json.dumps(query)))
+        )
+        with self.lock:
+            deleted = [
+                seriesId for seriesId in self.series if seriesId not in candidates
+            ]
+            unknown = candidates - set(self.series) - self.others
+        for seriesId in deleted:
+            self.forget(seriesId)
+        for seriesId in unknown:
+            try:
+                self.update(seriesId)
+            except Exception as error:
+                orthanc.LogWarning(f"Cannot index series {seriesId}: {error}")
+        orthanc.LogInfo(
+            f"Series index caught up: {len(unknown)} new, {len(deleted)} deleted"
+        )
+
+
+series_index = SeriesIndex(os.path.join(CACHE_DIRECTORY, "series-index.json"))
+
+
+def get_series_filter(parameters):
+    """Match the summaries of series against the filters of a query."""
+    text = parameters.get("q", "").lower()
+    wavelength = parameters.get("wavelength")
+    try:
+        wavelength = None if wavelength is None else float(wavelength)
+    except ValueError:
+        raise InvalidRequest(f"Invalid wavelength: {wavelength}")
+    min_bands = get_int_parameter(parameters, "min-bands", 0)
+    thumbnails = (
+        get_bool_parameter(parameters, "thumbnails")
+        if "thumbnails" in parameters
+        else None
+    )
+    study = parameters.get("study")
+
+    def match(summary) -> bool:
+        if text and not any(
+            text in summary[field].lower()
+            for field in ("patientName", "studyDescription", "seriesDescription")
+        ):
+            return False
+        if wavelength is not None and not (
+            summary["wavelengths"]
+            and summary["wavelengths"]["min"]
+            <= wavelength
+            <= summary["wavelengths"]["max"]
+        ):
+            return False
+        if summary["bands"] < min_bands:
+            return False
+        if thumbnails is not None and summary["thumbnails"] != thumbnails:
+            return False
+        return study is None or summary["study"] == study
+
+    return match
+
+
+# list the Spectraloptica series, most recently updated first, by pages of
+# ?limit= from ?offset=, matching ?q= (patient or descriptions), ?wavelength=
+# (nm, within their range), ?min-bands=, ?thumbnails=0|1 or ?study=
+@instrumented("series")
+def series_listing(output, uri, **request):
+    if request["method"] == "GET":
+        parameters = request["get"]
+        try:
+            offset = get_int_parameter(parameters, "offset", 0)
+            limit = get_int_parameter(parameters, "limit", SERIES_PAGE_SIZE)
+            if offset < 0 or not 1 <= limit <= MAX_SERIES_PAGE_SIZE:
+                raise InvalidRequest(
+                    f"The offset must be positive and the limit within "
+                    f"1-{MAX_SERIES_PAGE_SIZE}"
+                )
+            summaries = series_index.query(get_series_filter(parameters))
+            answer = {
+                "total": len(summaries),
+                "offset": offset,
+                "limit": limit,
+                "series": summaries[offset : offset + limit],
+            }
+            output.AnswerBuffer(json.dumps(answer), "application/json")
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+# tell whether a series is a Spectraloptica one, for the Orthanc Explorer
+@instrumented("is_spectral")
+def is_spectral(output, uri, **request):
+    if request["method"] == "GET":
+        seriesId = request["groups"][0]
+        try:
+            spectral = series_index.is_spectral(seriesId)
+            output.AnswerBuffer(json.dumps({"spectral": spectral}), "application/json")
+        except ValueError:
+            # unknown series
+            output.SendHttpStatusCode(404)
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+orthanc.RegisterRestCallback("/spectraloptica/series", series_listing)
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/is-spectral", is_spectral)
+
+
+# grayscale versions of the pyramid levels, shared by the band-math endpoints
+# and keyed like decoded_levels by (instance, level[, digest of the transform])
+band_arrays = LRUCache(
+    "bands",
+    configuration.get("BandsCacheSize", 512) * MEGABYTE,
+    sizeof=lambda array: array.nbytes,
+)
+
+
+def to_luminance(array) -> np.ndarray:
+    """Convert a (rows, columns, channels) image to a 2D uint8 array."""
+    if array.shape[2] == 1:
+        return array[:, :, 0]
+    # ITU-R BT.601 luma, in fixed point
+    luma = array[:, :, 0].astype(np.uint16) * 77
+    luma += array[:, :, 1].astype(np.uint16) * 150
+    luma += array[:, :, 2].astype(np.uint16) * 29
+    luma >>= 8
+    return luma.astype(np.uint8)
+
+
+def get_band(instance, level, aligned=False) -> np.ndarray:
+    """Return the luminance of a level of an image, as a 2D uint8 array."""
+    digest = get_transform(instance)[1] if aligned else None
+    key = (instance, level) if digest is None else (instance, level, digest)
+    band = band_arrays.get(key)
+    if band is None:
+        band = to_luminance(get_level(instance, level, aligned))
+        band_arrays.put(key, band)
+    return band
+
+
+def to_uint8(values, stretch) -> np.ndarray:
+    values = np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+    if stretch == "minmax":
+        low, high = float(values.min()), float(values.max())
+        values = (values - low) * (255.0 / (high - low) if high > low else 0.0)
+    return np.clip(values, 0, 255).astype(np.uint8)
+
+
+def render_composite(manifest, parameters):
+    level = get_int_parameter(parameters, "level")
+    aligned = get_bool_parameter(parameters, "align")
+    stretch = parameters.get("stretch", "auto")
+    if stretch not in ("auto", "minmax", "none"):
+        raise InvalidRequest(f"Invalid stretch: {stretch}")
+
+    if "expr" not in parameters and not any(
+        channel in parameters for channel in ("r", "g", "b")
+    ):
+        raise InvalidRequest("Either expr or a r/g/b channel mapping is required")
+    try:
+        if "expr" in parameters:
+            channels = [spectraloptica.BandExpression(parameters["expr"], manifest)]
+        else:
+            channels = [
+                (
+                    spectraloptica.BandExpression(parameters[channel], manifest)
+                    if channel in parameters
+                    else None
+                )
+                for channel in ("r", "g", "b")
+            ]
+    except ValueError as error:
+        raise InvalidRequest(str(error))
+
+    def get_level_band(instance):
+        width, height = get_image_size(instance)
+        max_level = get_max_level(width, height)
+        return get_band(
+            instance, max_level if level is None else min(level, max_level), aligned
+        )
+
+    shape = None
+    planes = []
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for expression in channels:
+            if expression is None:
+                planes.append(None)
+                continue
+            try:
+                values = expression.evaluate(get_level_band)
+            except ValueError:
+                # broadcasting error of NumPy
+                raise InvalidRequest("Bands of different sizes cannot be combined")
+            if shape is not None and values.shape != shape:
+                raise InvalidRequest("Bands of different sizes cannot be combined")
+            shape = values.shape
+            if stretch == "auto":
+                # raw bands keep their values, computed ones are rescaled
+                planes.append(
+                    to_uint8(values, "none" if expression.is_band else "minmax")
+                )
+            else:
+                planes.append(to_uint8(values, stretch))
+
+    planes = [np.zeros(shape, np.uint8) if plane is None else plane for plane in planes]
+    return np.stack(planes, axis=2)
+
+
+# send the combination of several bands of a series, computed server-side
+@instrumented("composite")
+def composite(output, uri, **request):
+    if request["method"] == "GET":
+        seriesId = request["groups"][0]
+        parameters = request["get"]
+        orthanc.LogInfo(f"Request composite {parameters} of {seriesId}")
+        try:
+            image_format = parameters.get("format", "jpeg")
+            if image_format not in ("jpeg", "png"):
+                raise InvalidRequest(f"Invalid format: {image_format}")
+            quality = get_int_parameter(parameters, "quality", 90)
+            if not 1 <= quality <= 100:
+                raise InvalidRequest(f"Invalid quality: {quality}")
+            manifest, _, manifest_etag = get_manifest(seriesId)
+            # composites only depend on the bands of the series, their alignment
+            # and on the query
+            if get_bool_parameter(parameters, "align"):
+                manifest_etag += get_alignment(seriesId)["digest"]
+            etag = (
+                '"%s"'
+                % hashlib.sha1(
+                    (manifest_etag + json.dumps(sorted(parameters.items()))).encode()
+                ).hexdigest()
+            )
+            if answer_not_modified(output, request, etag, "no-cache"):
+                return
+            array = render_composite(manifest, parameters)
+            if image_format == "png":
+                output.AnswerBuffer(encode_png(array), "image/png")
+            else:
+                output.AnswerBuffer(encode_jpeg(array, quality), "image/jpeg")
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/composite", composite)
+
+
+# Co-registration of the bands of a series: the transform of every image onto
+# a reference band, estimated once per series on a downsampled level and kept
+# in the metadata of the series, or in the cache directory if Orthanc does not
+# declare the metadata in its "UserMetadata" configuration.
+ALIGNMENT_METADATA = configuration.get("AlignmentMetadata", "SpectralopticaAlignment")
+# largest side of the levels the transforms are estimated on
+REGISTRATION_SIZE = configuration.get("RegistrationSize", 1024)
+# bands correlating less than this with the reference are left untouched
+REGISTRATION_MIN_CONFIDENCE = configuration.get("RegistrationMinConfidence", 0.05)
+# the reference is the spectral image illuminated closest to this, in nm
+REGISTRATION_REFERENCE_WAVELENGTH = configuration.get(
+    "RegistrationReferenceWavelength", 550
+)
+
+alignments_directory = os.path.join(CACHE_DIRECTORY, "alignments")
+os.makedirs(alignments_directory, exist_ok=True)
+# series ID -> alignment, see compute_alignment()
+alignments = dict()
+alignment_locks = KeyedLocks()
+
+
+def get_fingerprint(manifest) -> str:
+    """Identify the images of a series, to tell whether an alignment still applies."""
+    names = sorted(image["name"] for image in get_manifest_images(manifest))
+    return hashlib.sha1(",".join(names).encode()).hexdigest()
+
+
+def get_manifest_images(manifest) -> list:
+    return manifest["spectralImages"] + list(manifest["individualImages"].values())
+
+
+def compute_alignment(manifest) -> dict:
+    images = get_manifest_images(manifest)
+    if not images:
+        raise InvalidRequest("No image to align")
+    with_wavelength = [
+        image for image in manifest["spectralImages"] if image["wavelength"]["value"]
+    ]
+    reference = min(
+        with_wavelength or images,
+        key=lambda image: abs(
+            (image["wavelength"]["value"] or 0) - REGISTRATION_REFERENCE_WAVELENGTH
+        ),
+    )["name"]
+
+    width, height = get_image_size(reference)
+    max_level = get_max_level(width, height)
+    level = max(
+        0,
+        max_level
+        - max(0, math.ceil(math.log2(max(width, height) / REGISTRATION_SIZE))),
+    )
+    scale = 2 ** (max_level - level)
+    reference_band = get_band(reference, level)
+    transforms = dict()
+    for image in images:
+        if image["name"] == reference:
+            matrix, confidence = spectraloptica.registration.IDENTITY, 1.0
+        else:
+            matrix, confidence = spectraloptica.registration.estimate_transform(
+                reference_band, get_band(image["name"], level)
+            )
+            if confidence < REGISTRATION_MIN_CONFIDENCE:
+                matrix = spectraloptica.registration.IDENTITY
+        transforms[image["name"]] = {
+            "matrix": spectraloptica.registration.scale_transform(
+                matrix, scale
+            ).tolist(),
+            "confidence": confidence,
+        }
+    return {
+        "reference": reference,
+        "fingerprint": get_fingerprint(manifest),
+        # identifies the transforms, for the ETags of aligned images
+        "digest": hashlib.sha1(
+            json.dumps(transforms, sort_keys=True).encode()
+        ).hexdigest()[:12],
+        "transforms": transforms,
+    }
+
+
+def load_alignment(seriesId) -> dict:
+    try:
+        return json.loads(
+            rest_api_get(f"/series/{seriesId}/metadata/{ALIGNMENT_METADATA}")
+        )
+    except ValueError:
+        pass
+    try:
+        with open(os.path.join(alignments_directory, f"{seriesId}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def store_alignment(seriesId, alignment):
+    body = json.dumps(alignment)
+    try:
+        orthanc.RestApiPut(
+            f"/series/{seriesId}/metadata/{ALIGNMENT_METADATA}", body.encode()
+        )
+        return
+    except ValueError:
+        pass
+    path = os.path.join(alignments_directory, f"{seriesId}.json")
+    temporary = f"{path}.{threading.get_ident()}.tmp"
+    with open(temporary, "w") as f:
+        f.write(body)
+    os.replace(temporary, path)
+
+
+def get_alignment(seriesId, recompute=False) -> dict:
+    """Return the alignment of a series, estimating it once."""
+    manifest = get_manifest(seriesId)[0]
+    fingerprint = get_fingerprint(manifest)
+    alignment = alignments.get(seriesId)
+    if not recompute and alignment and alignment["fingerprint"] == fingerprint:
+        return alignment
+    with alignment_locks.hold(seriesId):
+        alignment = None if recompute else load_alignment(seriesId)
+        if alignment is None or alignment.get("fingerprint") != fingerprint:
+            # overwrites the stored alignment, outdated by its fingerprint
+            alignment = compute_alignment(manifest)
+            store_alignment(seriesId, alignment)
+        alignments[seriesId] = alignment
+    return alignment
+
+
+def get_series_of_instance(band) -> str:
+    seriesId = series_of_instances.get(band)
+    if seriesId is None:
+        instance = spectraloptica.parse_band(band)[0]
+        seriesId = json.loads(rest_api_get(f"/instances/{instance}"))["ParentSeries"]
+    return seriesId
+
+
+def get_transform(instance):
+    """Return the transform of an image onto its reference band, and its digest."""
+    alignment = get_alignment(get_series_of_instance(instance))
+    transform = alignment["transforms"].get(instance)
+    if transform is None:
+        return spectraloptica.registration.IDENTITY, None
+    matrix = np.array(transform["matrix"])
+    if np.allclose(matrix, spectraloptica.registration.IDENTITY):
+        return matrix, None
+    return matrix, hashlib.sha1(matrix.tobytes()).hexdigest()[:12]
+
+
+def invalidate_alignment(seriesId):
+    # aligned levels, tiles and cubes are keyed by their transform, and the
+    # stored alignment by its fingerprint: it is estimated again and overwritten
+    # by the next get_alignment(), e.g. by the job of the stable series
+    alignments.pop(seriesId, None)
+
+
+def forget_alignment(seriesId):
+    """Forget the alignment of a deleted series, whose metadata went with it."""
+    alignments.pop(seriesId, None)
+    try:
+        os.remove(os.path.join(alignments_directory, f"{seriesId}.json"))
+    except OSError:
+        pass
+
+
+# GET the transforms of the images of a series onto its reference band, or
+# POST to estimate them again
+@instrumented("alignment")
+def alignment(output, uri, **request):
+    if request["method"] in ("GET", "POST"):
+        seriesId = request["groups"][0]
+        try:
+            answer = get_alignment(seriesId, recompute=request["method"] == "POST")
+            output.AnswerBuffer(json.dumps(answer), "application/json")
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET,POST")
+
+
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/alignment", alignment)
+
+
+# Band-stacked luminance of the spectral images of a series, as a memory-mapped
+# (bands, rows, columns) uint8 array: the spectrum of a pixel is a strided read
+# of a few bytes instead of one JPEG decode per band.
+cubes_directory = os.path.join(CACHE_DIRECTORY, "cubes")
+os.makedirs(cubes_directory, exist_ok=True)
+# cubes left half-written by a previous run, which stopped while building them
+for file_name in os.listdir(cubes_directory):
+    if file_name.endswith(".tmp"):
+        os.remove(os.path.join(cubes_directory, file_name))
+# cube name -> (memory-mapped cube, spectral images of its bands, source), the
+# cube of the aligned bands of a series being named "<series ID>-aligned"
+cubes = dict()
+cube_locks = KeyedLocks()
+
+
+def get_cube_name(seriesId, aligned) -> str:
+    return f"{seriesId}-aligned" if aligned else seriesId
+
+
+def get_cube_source(seriesId, manifest, aligned) -> dict:
+    """
+    What the cube of a series is made of: its spectral images, and the
+    alignment of their bands. A cube made of something else is outdated.
+    """
+    return {
+        "images": [image["name"] for image in manifest["spectralImages"]],
+        "alignment": get_alignment(seriesId)["digest"] if aligned else None,
+    }
+
+
+def build_cube(seriesId, spectral_images, source, aligned=False):
+    width, height = get_image_size(spectral_images[0]["name"])
+    name = get_cube_name(seriesId, aligned)
+    path = os.path.join(cubes_directory, f"{name}.npy")
+    temporary = f"{path}.{threading.get_ident()}.tmp"
+    cube = np.lib.format.open_memmap(
+        temporary,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(spectral_images), height, width),
+    )
+    try:
+        for index, image in enumerate(spectral_images):
+            # decoded directly, not to evict the bands cached for interactive use
+            band = to_luminance(decode_frame(image["name"]))
+            if band.shape != (height, width):
+                raise InvalidRequest("Bands of different sizes cannot be stacked")
+            if aligned:
+                band = spectraloptica.registration.warp(
+                    band, get_transform(image["name"])[0]
+                )
+            cube[index] = band
+        cube.flush()
+    except BaseException:
+        # a cube is as large as all the bands of its series together
+        del cube
+        os.remove(temporary)
+        raise
+    del cube
+    os.replace(temporary, path)
+    with open(os.path.join(cubes_directory, f"{name}.json"), "w") as f:
+        json.dump({"source": source, "spectralImages": spectral_images}, f)
+
+
+def load_cube(name, source):
+    """Return the (cube, spectral images) stored for `source`, or None."""
+    try:
+        with open(os.path.join(cubes_directory, f"{name}.json")) as f:
+            description = json.load(f)
+        if description["source"] != source:
+            return None
+        cube = np.load(os.path.join(cubes_directory, f"{name}.npy"), mmap_mode="r")
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+    return cube, description["spectralImages"]
+
+
+def get_cube(seriesId, aligned=False):
+    """Return the (cube, spectral images) of a series."""
+    return get_cube_entry(seriesId, aligned)[:2]
+
+
+def get_cube_entry(seriesId, aligned=False):
+    """
+    Return the (cube, spectral images, source) of a series, building the cube
+    once. An outdated cube is replaced when next asked for, not when its series
+    changes.
+    """
+    name = get_cube_name(seriesId, aligned)
+    manifest = get_manifest(seriesId)[0]
+    source = get_cube_source(seriesId, manifest, aligned)
+    cube = cubes.get(name)
+    hit = cube is not None and cube[2] == source
+    metrics.lookup("cubes", hit)
+    if hit:
+        return cube
+    with cube_locks.hold(name):
+        cube = cubes.get(name)
+        if cube is None or cube[2] != source:
+            loaded = load_cube(name, source)
+            if loaded is None:
+                if not manifest["spectralImages"]:
+                    raise InvalidRequest(f"No spectral image in {seriesId}")
+                build_cube(seriesId, manifest["spectralImages"], source, aligned)
+                loaded = load_cube(name, source)
+            cube = cubes[name] = (*loaded, source)
+    return cube
+
+
+def invalidate_cube(seriesId, aligned=(False, True)):
+    for name in [get_cube_name(seriesId, flag) for flag in aligned]:
+        cubes.pop(name, None)
+        invalidate_decomposition(name)
+        for extension in ("npy", "json", "decomposition.json"):
+            try:
+                os.remove(os.path.join(cubes_directory, f"{name}.{extension}"))
+            except OSError:
+                pass
+
+
+def polygon_mask(polygon, x0, y0, x1, y1) -> np.ndarray:
+    """Rasterize a polygon over [x0, x1[ x [y0, y1[, by the even-odd rule."""
+    xs = np.arange(x0, x1, dtype=np.float64) + 0.5
+    ys = (np.arange(y0, y1, dtype=np.float64) + 0.5)[:, np.newaxis]
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    for (ax, ay), (bx, by) in zip(polygon, polygon[1:] + polygon[:1]):
+        if ay == by:
+            continue
+        # rows crossing the edge, and abscissa of the crossing
+        crosses = (ay > ys) != (by > ys)
+        x_crossing = ax + (ys - ay) * (bx - ax) / (by - ay)
+        mask ^= crosses & (xs < x_crossing)
+    return mask
+
+
+def get_region_statistics(cube, body) -> list:
+    bands, height, width = cube.shape
+    if "polygon" in body:
+        polygon = [(float(x), float(y)) for x, y in body["polygon"]]
+        if len(polygon) < 3:
+            raise InvalidRequest("A polygon needs at least 3 points")
+        xs, ys = zip(*polygon)
+        x0, y0 = max(int(min(xs)), 0), max(int(min(ys)), 0)
+        x1, y1 = min(math.ceil(max(xs)), width), min(math.ceil(max(ys)), height)
+        mask = polygon_mask(polygon, x0, y0, x1, y1) if x1 > x0 and y1 > y0 else None
+    elif "rectangle" in body:
+        x0, y0, x1, y1 = [int(value) for value in body["rectangle"]]
+        x0, y0 = max(min(x0, x1), 0), max(min(y0, y1), 0)
+        x1, y1 = min(max(x0, x1), width), min(max(y0, y1), height)
+        mask = None
+    else:
+        raise InvalidRequest("Either a polygon or a rectangle is required")
+    if x1 <= x0 or y1 <= y0 or (mask is not None and not mask.any()):
+        raise InvalidRequest("The region contains no pixel of the image")
+
+    statistics = []
+    # band by band, so that memory stays bounded by the size of the region
+    for index in range(bands):
+        values = cube[index, y0:y1, x0:x1]
+        values = values[mask] if mask is not None else values.ravel()
+        values = values.astype(np.float64)
+        statistics.append(
+            {
+                "mean": float(values.mean()),
+                "std": float(values.std()),
+                "pixels": int(values.size),
+            }
+        )
+    return statistics
+
+
+# send the spectrum of a pixel (GET) or the statistics of a region (POST), of
+# the bands moved onto their reference with ?align=1
+@instrumented("spectrum")
+def spectrum(output, uri, **request):
+    if request["method"] in ("GET", "POST"):
+        seriesId = request["groups"][0]
+        try:
+            aligned = get_bool_parameter(request["get"], "align")
+            cube, spectral_images = get_cube(seriesId, aligned)
+            bands = [
+                {
+                    "name": image["name"],
+                    "label": image["label"],
+                    "wavelength": image["wavelength"]["value"],
+                }
+                for image in spectral_images
+            ]
+            if request["method"] == "GET":
+                x = get_int_parameter(request["get"], "x")
+                y = get_int_parameter(request["get"], "y")
+                if x is None or y is None:
+                    raise InvalidRequest("Both x and y are required")
+                if not (0 <= x < cube.shape[2] and 0 <= y < cube.shape[1]):
+                    raise InvalidRequest(f"({x};{y}) is outside of the image")
+                for band, value in zip(bands, cube[:, y, x].tolist()):
+                    band["value"] = value
+                answer = {"x": x, "y": y, "bands": bands}
+            else:
+                try:
+                    body = json.loads(request["body"])
+                    statistics = get_region_statistics(cube, body)
+                except (TypeError, ValueError, KeyError):
+                    raise InvalidRequest("Invalid region")
+                for band, band_statistics in zip(bands, statistics):
+                    band.update(band_statistics)
+                answer = {"bands": bands}
+            output.AnswerBuffer(json.dumps(answer), "application/json")
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET,POST")
+
+
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/spectrum", spectrum)
+
+
+# Principal components (PCA) and minimum noise fraction (MNF) of the cube of a
+# series. The statistics of the bands are accumulated over chunks of rows of the
+# memory-mapped cube, the basis being kept next to the cube it was computed on.
+DECOMPOSITION_METHODS = ("pca", "mnf")
+# bytes of the cube converted to floats at once, by the statistics and the
+# rendering of the components
+DECOMPOSITION_CHUNK_SIZE = configuration.get("DecompositionChunkSize", 64) * MEGABYTE
+DEFAULT_COMPONENTS = 3
+
+# cube name -> decomposition, see compute_decomposition()
+decompositions = dict()
+decomposition_locks = KeyedLocks()
+
+
+def get_chunk_rows(cube) -> int:
+    bands, _, columns = cube.shape
+    return max(1, DECOMPOSITION_CHUNK_SIZE // (bands * columns * 8))
+
+
+def iterate_chunks(cube):
+    chunk_rows = get_chunk_rows(cube)
+    for row in range(0, cube.shape[1], chunk_rows):
+        yield cube[:, row : row + chunk_rows, :]
+
+
+def compute_decomposition(cube) -> dict:
+    mean, covariance, noise_covariance = spectraloptica.decomposition.band_statistics(
+        iterate_chunks(cube)
+    )
+    decomposition = {"mean": mean.tolist()}
+    for method, (eigenvalues, transform) in (
+        ("pca", spectraloptica.decomposition.pca(covariance)),
+        ("mnf", spectraloptica.decomposition.mnf(covariance, noise_covariance)),
+    ):
+        decomposition[method] = {
+            "eigenvalues": eigenvalues.tolist(),
+            "transform": transform.tolist(),
+        }
+    decomposition["digest"] = hashlib.sha1(
+        json.dumps(decomposition, sort_keys=True).encode()
+    ).hexdigest()[:12]
+    return decomposition
+
+
+def get_decomposition(seriesId, aligned=False):
+    """
+    Return the (decomposition, cube, spectral images) of a series, the
+    decomposition being computed again once its cube is.
+    """
+    cube, spectral_images, source = get_cube_entry(seriesId, aligned)
+    name = get_cube_name(seriesId, aligned)
+    decomposition = decompositions.get(name)
+    hit = decomposition is not None and decomposition["source"] == source
+    metrics.lookup("decompositions", hit)
+    if hit:
+        return decomposition, cube, spectral_images
+    with decomposition_locks.hold(name):
+        decomposition = decompositions.get(name)
+        if decomposition is None or decomposition["source"] != source:
+            path = os.path.join(cubes_directory, f"{name}.decomposition.json")
+            try:
+                with open(path) as f:
+                    decomposition = json.load(f)
+            except (OSError, ValueError):
+                decomposition = None
+            if decomposition is None or decomposition.get("source") != source:
+                decomposition = {**compute_decomposition(cube), "source": source}
+                temporary = f"{path}.{threading.get_ident()}.tmp"
+                with open(temporary, "w") as f:
+                    json.dump(decomposition, f)
+                os.replace(temporary, path)
+            decompositions[name] = decomposition
+    return decomposition, cube, spectral_images
+
+
+def invalidate_decomposition(name):
+    decompositions.pop(name, None)
+    decoded_levels.invalidate(lambda key: key[0] == name)
+    tiles_cache.invalidate(lambda key: key.startswith(f"{name}/"))
+    previews_cache.invalidate(lambda key: key.startswith(f"{name}/"))
+
+
+def get_component_parameters(seriesId, parameters) -> tuple:
+    """Return the (cube name, method, component, aligned) of a request."""
+    method = parameters.get("method", "pca")
+    if method not in DECOMPOSITION_METHODS:
+        raise InvalidRequest(f"Invalid method: {method}")
+    component = get_int_parameter(parameters, "component", 0)
+    aligned = get_bool_parameter(parameters, "align")
+    return get_cube_name(seriesId, aligned), method, component, aligned
+
+
+def get_component(seriesId, method, component, aligned=False):
+    """Return the (mean, vector, eigenvalue, digest) of a component."""
+    decomposition, cube, _ = get_decomposition(seriesId, aligned)
+    eigenvalues = decomposition[method]["eigenvalues"]
+    if not 0 <= component < len(eigenvalues):
+        raise InvalidRequest(
+            f"Invalid component: {component}, the series has {len(eigenvalues)}"
+        )
+    vector = np.array(decomposition[method]["transform"])[:, component]
+    return (
+        np.array(decomposition["mean"]),
+        vector,
+        eigenvalues[component],
+        decomposition["digest"],
+    )
+
+
+def get_component_level(seriesId, method, component, level, aligned=False):
+    """Return a level of the image of a component, stretched over 3 sigmas."""
+    name = get_cube_name(seriesId, aligned)
+    # keyed by the decomposition, which changes along with its series
+    digest = get_decomposition(seriesId, aligned)[0]["digest"]
+    key = (name, method, component, level, digest)
+    array = decoded_levels.get(key)
+    if array is not None:
+        return array
+    with level_locks.hold(key):
+        array = decoded_levels.get(key)
+        if array is None:
+            cube, _ = get_cube(seriesId, aligned)
+            _, height, width = cube.shape
+            if level >= get_max_level(width, height):
+                mean, vector, eigenvalue, _ = get_component(
+                    seriesId, method, component, aligned
+                )
+                # the variance of a component is its eigenvalue
+                scale = 127.5 / (3 * math.sqrt(eigenvalue)) if eigenvalue > 0 else 0
+                array = np.empty((height, width, 1), np.uint8)
+                row = 0
+                for chunk in iterate_chunks(cube):
+                    values = spectraloptica.decomposition.project(chunk, mean, vector)
+                    array[row : row + chunk.shape[1], :, 0] = np.clip(
+                        values * scale + 127.5, 0, 255
+                    )
+                    row += chunk.shape[1]
+            else:
+                array = halve(
+                    get_component_level(seriesId, method, component, level + 1, aligned)
+                )
+            decoded_levels.put(key, array)
+    return array
+
+
+# send the eigenvalues and the loadings of the first ?components= of the PCA or
+# of the MNF (?method=mnf) of the bands of a series
+@instrumented("pca")
+def decomposition(output, uri, **request):
+    if request["method"] == "GET":
+        seriesId = request["groups"][0]
+        parameters = request["get"]
+        try:
+            _, method, _, aligned = get_component_parameters(seriesId, parameters)
+            decomposition, _, spectral_images = get_decomposition(seriesId, aligned)
+            eigenvalues = decomposition[method]["eigenvalues"]
+            count = get_int_parameter(parameters, "components", DEFAULT_COMPONENTS)
+            if count < 1:
+                raise InvalidRequest(f"Invalid number of components: {count}")
+            transform = np.array(decomposition[method]["transform"])
+            total = sum(eigenvalues)
+            answer = {
+                "method": method,
+                "bands": [
+                    {
+                        "name": image["name"],
+                        "label": image["label"],
+                        "wavelength": image["wavelength"]["value"],
+                        "mean": mean,
+                    }
+                    for image, mean in zip(spectral_images, decomposition["mean"])
+                ],
+                "components": [
+                    {
+                        "index": index,
+                        "eigenvalue": eigenvalue,
+                        "fraction": eigenvalue / total if total > 0 else 0.0,
+                        "loadings": transform[:, index].tolist(),
+                    }
+                    for index, eigenvalue in enumerate(eigenvalues[:count])
+                ],
+            }
+            etag = '"%s"' % decomposition["digest"]
+            if answer_not_modified(output, request, etag, "no-cache"):
+                return
+            output.AnswerBuffer(json.dumps(answer), "application/json")
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+# send the description of the pyramid of a ?component=
+@instrumented("pca_tiles")
+def component_tiles(output, uri, **request):
+    if request["method"] == "GET":
+        seriesId = request["groups"][0]
+        try:
+            _, _, _, aligned = get_component_parameters(seriesId, request["get"])
+            _, height, width = get_cube(seriesId, aligned)[0].shape
+            description = {
+                "width": width,
+                "height": height,
+                "tileSize": TILE_SIZE,
+                "overlap": 0,
+                "format": "jpg",
+                "minLevel": 0,
+                "maxLevel": get_max_level(width, height),
+            }
+            output.AnswerBuffer(json.dumps(description), "application/json")
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+# send a single tile of the pyramid of a ?component=
+@instrumented("pca_tile")
+def component_tile(output, uri, **request):
+    if request["method"] == "GET":
+        seriesId, level, x, y = request["groups"]
+        level, x, y = int(level), int(x), int(y)
+        try:
+            name, method, component, aligned = get_component_parameters(
+                seriesId, request["get"]
+            )
+            _, height, width = get_cube(seriesId, aligned)[0].shape
+            max_level = get_max_level(width, height)
+            scale = 2 ** (max_level - level)
+            if (
+                level > max_level
+                or x * TILE_SIZE >= math.ceil(width / scale)
+                or y * TILE_SIZE >= math.ceil(height / scale)
+            ):
+                output.SendHttpStatusCode(404)
+                return
+            digest = get_component(seriesId, method, component, aligned)[3]
+            etag = '"%s-%s-%d-%s-%d-%d-%d"' % (
+                name,
+                method,
+                component,
+                digest,
+                level,
+                x,
+                y,
+            )
+            if answer_not_modified(output, request, etag, "no-cache"):
+                return
+            key = f"{name}/{method}/{component}/{digest}/{level}/{x}_{y}.jpg"
+            tile = tiles_cache.get(key)
+            if tile is None:
+                array = get_component_level(seriesId, method, component, level, aligned)
+                tile = encode_jpeg(
+                    array[
+                        y * TILE_SIZE : (y + 1) * TILE_SIZE,
+                        x * TILE_SIZE : (x + 1) * TILE_SIZE,
+                    ],
+                    TILE_QUALITY,
+                )
+                tiles_cache.put(key, tile)
+            output.AnswerBuffer(tile, "image/jpeg")
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+# send a resized rendition of a ?component=
+@instrumented("pca_preview")
+def component_preview(output, uri, **request):
+    if request["method"] == "GET":
+        seriesId = request["groups"][0]
+        parameters = request["get"]
+        try:
+            name, method, component, aligned = get_component_parameters(
+                seriesId, parameters
+            )
+            _, image_height, image_width = get_cube(seriesId, aligned)[0].shape
+            max_width = get_int_parameter(parameters, "w", image_width)
+            max_height = get_int_parameter(parameters, "h", image_height)
+            quality = get_int_parameter(parameters, "q", 85)
+            image_format = parameters.get("format", "jpeg")
+            if max_width < 1 or max_height < 1:
+                raise InvalidRequest("The size of a preview must be positive")
+            if not 1 <= quality <= 100:
+                raise InvalidRequest(f"Invalid quality: {quality}")
+            if image_format not in PREVIEW_FORMATS:
+                raise InvalidRequest(f"Invalid format: {image_format}")
+            width, height = fit(image_width, image_height, max_width, max_height)
+            digest = get_component(seriesId, method, component, aligned)[3]
+            etag = '"%s-%s-%d-%s-%dx%d-q%d.%s"' % (
+                name,
+                method,
+                component,
+                digest,
+                width,
+                height,
+                quality,
+                image_format,
+            )
+            if answer_not_modified(output, request, etag, "no-cache"):
+                return
+            key = (
+                f"{name}/{method}/{component}/{digest}/"
+                f"{width}x{height}_q{quality}.{image_format}"
+            )
+            preview = previews_cache.get(key)
+            if preview is None:
+                # resample the smallest level still larger than the preview
+                max_level = level = get_max_level(image_width, image_height)
+                while level > 0 and max(image_width, image_height) >= 2 ** (
+                    max_level - level + 1
+                ) * max(width, height):
+                    level -= 1
+                array = get_component_level(seriesId, method, component, level, aligned)
+                preview = encode(resize(array, width, height), image_format, quality)
+                previews_cache.put(key, preview)
+            output.AnswerBuffer(preview, PREVIEW_FORMATS[image_format])
+        except InvalidRequest as error:
+            output.SendHttpStatus(400, str(error).encode())
+        except Exception as error:
+            orthanc.LogError(error)
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+# the pyramids and previews of the components are not under "<series>/pca/", as
+# the routes of the images would catch them
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/pca", decomposition)
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/pca-tiles", component_tiles)
+orthanc.RegisterRestCallback(
+    "/spectraloptica/(.*)/pca-tiles/([0-9]+)/([0-9]+)/([0-9]+)", component_tile
+)
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/pca-preview", component_preview)
+
+
+# Annotations of the series, persisted along with the Orthanc storage
+annotations = spectraloptica.AnnotationStore(
+    configuration.get(
+        "AnnotationsDatabase",
+        os.path.join(
+            orthanc_configuration.get("StorageDirectory", "OrthancStorage"),
+            "spectraloptica-annotations.sqlite",
+        ),
+    )
+)
+
+
+def get_bbox_parameter(parameters) -> tuple:
+    if "bbox" not in parameters:
+        return None
+    try:
+        min_x, min_y, max_x, max_y = map(float, parameters["bbox"].split(","))
+    except ValueError:
+        raise InvalidRequest(f"Invalid bbox: {parameters['bbox']}")
+    return min_x, min_y, max_x, max_y
+
+
+# GET the annotations of a series, in a ?bbox=min_x,min_y,max_x,max_y viewport,
+# on a ?band=instance, or changed ?since=revision along with the IDs of those
+# deleted or moved out of the viewport; POST new annotations, as a single object
+# or a list
+@instrumented("annotations")
+def series_annotations(output, uri, **request):
+    seriesId = request["groups"][0]
+    try:
+        if request["method"] == "GET":
+            parameters = request["get"]
+            answer = annotations.query(
+                seriesId,
+                bbox=get_bbox_parameter(parameters),
+                band=parameters.get("band"),
+                since=get_int_parameter(parameters, "since"),
+            )
+        elif request["method"] == "POST":
+            body = get_json_body(request)
+            try:
+                answer = annotations.create(
+                    seriesId, body if isinstance(body, list) else [body]
+                )
+            except ValueError as error:
+                raise InvalidRequest(str(error))
+        else:
+            output.SendMethodNotAllowed("GET,POST")
+            return
+        output.AnswerBuffer(json.dumps(answer), "application/json")
+    except InvalidRequest as error:
+        output.SendHttpStatus(400, str(error).encode())
+    except Exception as error:
+        orthanc.LogError(error)
+
+
+# GET, PUT or DELETE an annotation. PUT and DELETE only apply if the annotation
+# is still at the ?revision given, if any, and answer 409 Conflict otherwise.
+@instrumented("annotation")
+def series_annotation(output, uri, **request):
+    seriesId, id = request["groups"][0], int(request["groups"][1])
+    try:
+        revision = get_int_parameter(request["get"], "revision")
+        if request["method"] == "GET":
+            answer = annotations.get(seriesId, id)
+            if answer is None:
+                raise KeyError(id)
+        elif request["method"] == "PUT":
+            try:
+                answer = annotations.update(
+                    seriesId, id, get_json_body(request), revision
+                )
+            except ValueError as error:
+                raise InvalidRequest(str(error))
+        elif request["method"] == "DELETE":
+            annotations.delete(seriesId, id, revision)
+            answer = {}
+        else:
+            output.SendMethodNotAllowed("GET,PUT,DELETE")
+            return
+        output.AnswerBuffer(json.dumps(answer), "application/json")
+    except KeyError:
+        output.SendHttpStatus(404, f"No annotation {id} in {seriesId}".encode())
+    except spectraloptica.Conflict as error:
+        output.SendHttpStatus(409, str(error).encode())
+    except InvalidRequest as error:
+        output.SendHttpStatus(400, str(error).encode())
+    except Exception as error:
+        orthanc.LogError(error)
+
+
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/annotations", series_annotations)
+orthanc.RegisterRestCallback(
+    "/spectraloptica/(.*)/annotations/([0-9]+)", series_annotation
+)
+
+
+# Background precomputation of the derived images of the series, when they
+# become stable, so that their first viewers do not wait for them.
+BACKGROUND_WORKERS = configuration.get("BackgroundWorkers", 2)
+# jobs waiting beyond this are dropped: their results are computed on demand
+MAX_QUEUED_JOBS = configuration.get("MaxQueuedJobs", 1000)
+# full resolution tiles are the most numerous and the cheapest to compute
+PRECOMPUTE_FULL_RESOLUTION_TILES = configuration.get(
+    "PrecomputeFullResolutionTiles", False
+)
+# longest pause of a background job between two steps, in seconds, while
+# interactive requests are being answered
+MAX_YIELD_SECONDS = configuration.get("BackgroundYieldTime", 1.0)
+# pause of the deletions after which the deleted instances are swept, in seconds
+DELETIONS_DELAY = configuration.get("DeletionsDelay", 2.0)
+
+# lower first: a job of a series being viewed jumps ahead of the ingest backlog
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+class Job:
+    """Precomputation of a series, a sequence of named steps."""
+
+    def __init__(self, seriesId, priority):
+        self.series = seriesId
+        self.priority = priority
+        self.state = "queued"
+        self.steps_done = 0
+        self.steps = None
+        self.error = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_json(self) -> dict:
+        return {
+            "series": self.series,
+            "state": self.state,
+            "priority": self.priority,
+            "progress": {"done": self.steps_done, "total": self.steps},
+            "error": self.error,
+            "queued": self.queued,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class WorkerPool:
+    """Bounded pool of threads running the jobs of a priority queue.
+
+    Jobs are deduplicated by series, and every series keeps its latest job
+    for status queries, the oldest ones being forgotten beyond `history`.
+    """
+
+    def __init__(self, workers, max_queued, history=1000):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.history = history
+        self.lock = threading.Lock()
+        self.queue = queue.PriorityQueue()
+        self.jobs = OrderedDict()
+        self.queued = 0
+        self.sequence = 0
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def submit(self, seriesId, priority=PRIORITY_BACKGROUND) -> Job:
+        with self.lock:
+            job = self.jobs.get(seriesId)
+            if job is not None and job.state == "queued":
+                if priority < job.priority:
+                    # the previous entry of the queue is skipped as stale
+                    job.priority = priority
+                    self.put(job)
+                return job
+            job = Job(seriesId, priority)
+            self.jobs.pop(seriesId, None)
+            self.jobs[seriesId] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+            if self.queued >= self.max_queued:
+                job.state = "rejected"
+                orthanc.LogWarning(f"Too many background jobs, skipping {seriesId}")
+                return job
+            self.queued += 1
+            self.put(job)
+        metrics.set("background_jobs_queued", self.queued)
+        return job
+
+    def put(self, job):
+        self.sequence += 1
+        self.queue.put((job.priority, self.sequence, job))
+
+    def prioritize(self, seriesId):
+        """Move the queued job of a series ahead, as somebody is viewing it."""
+        with self.lock:
+            job = self.jobs.get(seriesId)
+            if job is None or job.state != "queued":
+                return
+        self.submit(seriesId, PRIORITY_INTERACTIVE)
+
+    def get(self, seriesId) -> Job:
+        with self.lock:
+            return self.jobs.get(seriesId)
+
+    def list(self) -> list:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def start(self):
+        self.stopping.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self.work, name=f"spectraloptica-worker-{index}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=10):
+        self.stopping.set()
+        for _ in self.threads:
+            self.queue.put((-1, 0, None))
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def work(self):
+        while not self.stopping.is_set():
+            priority, _, job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                if job.state != "queued" or priority != job.priority:
+                    continue
+                job.state = "running"
+                self.queued -= 1
+            metrics.set("background_jobs_queued", self.queued)
+            job.started = time.time()
+            try:
+                run_job(job, self.stopping)
+                job.state = "done"
+                metrics.increment("background_jobs_done")
+            except Exception as error:
+                job.state = "failed"
+                job.error = str(error)
+                metrics.increment("background_jobs_failed")
+                orthanc.LogError(f"Precomputation of {job.series} failed: {error}")
+            job.finished = time.time()
+
+
+def yield_to_requests():
+    """Pause while interactive requests are answered, for a bounded time."""
+    deadline = time.monotonic() + MAX_YIELD_SECONDS
+    while active_requests.value > 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def precompute_tiles(instance):
+    width, height = get_image_size(instance)
+    max_level = get_max_level(width, height)
+    last_level = max_level if PRECOMPUTE_FULL_RESOLUTION_TILES else max_level - 1
+    for level in range(last_level + 1):
+        rows, columns = get_level(instance, level).shape[:2]
+        for y in range(math.ceil(rows / TILE_SIZE)):
+            for x in range(math.ceil(columns / TILE_SIZE)):
+                get_tile(instance, level, x, y)
+
+
+def run_job(job, stopping):
+    if not series_index.update(job.series):
+        job.steps = 0
+        return
+    sweep_series(job.series)
+    manifest = get_manifest(job.series)[0]
+    instances = [image["name"] for image in manifest["spectralImages"]] + [
+        image["name"] for image in manifest["individualImages"].values()
+    ]
+    steps = [("previews", precompute_previews, instance) for instance in instances]
+    steps += [("statistics", get_statistics, instance) for instance in instances]
+    if instances:
+        steps.append(("manifest", add_statistics_to_manifest, job.series))
+    steps += [("tiles", precompute_tiles, instance) for instance in instances]
+    if instances:
+        steps.append(("alignment", get_alignment, job.series))
+    if manifest["spectralImages"]:
+        steps.append(("cube", get_cube, job.series))
+    job.steps = len(steps) + 1
+    job.steps_done = 1
+    for _, step, argument in steps:
+        if stopping.is_set():
+            raise RuntimeError("Orthanc is stopping")
+        yield_to_requests()
+        step(argument)
+        job.steps_done += 1
+
+
+background_jobs = WorkerPool(BACKGROUND_WORKERS, MAX_QUEUED_JOBS)
+
+
+# GET the background job of a series, POST to queue one with ?priority=
+@instrumented("job")
+def series_job(output, uri, **request):
+    seriesId = request["groups"][0]
+    try:
+        if request["method"] == "GET":
+            job = background_jobs.get(seriesId)
+            if job is None:
+                output.SendHttpStatus(404, f"No job for {seriesId}".encode())
+                return
+        elif request["method"] == "POST":
+            priority = get_int_parameter(
+                request["get"], "priority", PRIORITY_INTERACTIVE
+            )
+            job = background_jobs.submit(seriesId, priority)
+        else:
+            output.SendMethodNotAllowed("GET,POST")
+            return
+        output.AnswerBuffer(json.dumps(job.to_json()), "application/json")
+    except InvalidRequest as error:
+        output.SendHttpStatus(400, str(error).encode())
+
+
+# list the background jobs, most recent last, e.g. ?state=queued
+@instrumented("jobs")
+def jobs(output, uri, **request):
+    if request["method"] == "GET":
+        state = request["get"].get("state")
+        answer = [
+            job.to_json()
+            for job in background_jobs.list()
+            if state is None or job.state == state
+        ]
+        output.AnswerBuffer(json.dumps(answer), "application/json")
+    else:
+        output.SendMethodNotAllowed("GET")
+
+
+orthanc.RegisterRestCallback("/spectraloptica/(.*)/job", series_job)
+orthanc.RegisterRestCallback("/spectraloptica/jobs", jobs)
+
+
+# series -> number of changes to its instances, and the number of changes
+# swept by the last job of the series
+series_changes = dict()
+swept_changes = dict()
+
+
+def series_changed(seriesId):
+    """
+    Mark what is derived from a series as outdated. Called for every instance
+    from the change thread, it only counts the change: the lookups compare
+    their source, and the job of the series sweeps the rest.
+    """
+    series_changes[seriesId] = series_changes.get(seriesId, 0) + 1
+    invalidate_manifest(seriesId)
+
+
+def sweep_series(seriesId):
+    """Drop what the earlier versions of a series left in the caches."""
+    changes = series_changes.get(seriesId, 0)
+    if swept_changes.get(seriesId, 0) != changes:
+        invalidate_series(seriesId)
+        swept_changes[seriesId] = changes
+
+
+def invalidate_series(seriesId):
+    """Forget everything derived from the instances of a series."""
+    invalidate_cube(seriesId)
+    invalidate_alignment(seriesId)
+    series_instances.pop(seriesId, None)
+
+
+def invalidate_instances(instances):
+    """Forget everything derived from some instances, sweeping each cache once."""
+    invalidate_attachments(instances)
+    invalidate_tiles(instances)
+    invalidate_previews(instances)
+    invalidate_transcoded(instances)
+    invalidate_statistics(instances)
+    for instance in instances:
+        pixel_spacings.pop(instance, None)
+
+
+# instances deleted lately, and their series: deleting a series signals the
+# deletion of every instance, whose caches are swept and series updated at once
+# when the deletions pause
+deletions_lock = threading.Lock()
+deleted_instances = set()
+series_of_deleted_instances = set()
+deletions_timer = None
+
+
+def instance_deleted(instanceId):
+    global deletions_timer
+    seriesId = series_of_instances.pop(instanceId, None)
+    if seriesId is not None:
+        series_changed(seriesId)
+    with deletions_lock:
+        deleted_instances.add(instanceId)
+        if seriesId is not None:
+            series_of_deleted_instances.add(seriesId)
+        if deletions_timer is not None:
+            deletions_timer.cancel()
+        deletions_timer = threading.Timer(DELETIONS_DELAY, sweep_deletions)
+        deletions_timer.daemon = True
+        deletions_timer.start()
+
+
+def sweep_deletions():
+    global deleted_instances, series_of_deleted_instances
+    with deletions_lock:
+        instances, deleted_instances = deleted_instances, set()
+        series, series_of_deleted_instances = series_of_deleted_instances, set()
+    invalidate_instances(instances)
+    for seriesId in series:
+        try:
+            rest_api_get(f"/series/{seriesId}")
+        except ValueError:
+            # deleted along with its instances
+            continue
+        # its summary is updated along with the derived images
+        background_jobs.submit(seriesId)
+
+
+def OnChange(changeType, level, resourceId):
+    # NEW_CHILD_INSTANCE is signaled on the parent series of every NEW_INSTANCE,
+    # which spares a lookup of the parent of the new instance
+    if (
+        changeType == orthanc.ChangeType.NEW_CHILD_INSTANCE
+        and level == orthanc.ResourceType.SERIES
+    ):
+        series_changed(resourceId)
+        series_index.changed(resourceId)
+    elif changeType == orthanc.ChangeType.STABLE_SERIES:
+        invalidate_manifest(resourceId)
+        background_jobs.submit(resourceId)
+    elif changeType == orthanc.ChangeType.ORTHANC_STARTED:
+        background_jobs.start()
+        threading.Thread(target=series_index.catch_up, daemon=True).start()
+    elif changeType == orthanc.ChangeType.ORTHANC_STOPPED:
+        with deletions_lock:
+            if deletions_timer is not None:
+                deletions_timer.cancel()
+        background_jobs.stop()
+    elif changeType == orthanc.ChangeType.DELETED:
+        if level == orthanc.ResourceType.SERIES:
+            invalidate_manifest(resourceId)
+            invalidate_series(resourceId)
+            forget_alignment(resourceId)
+            series_changes.pop(resourceId, None)
+            swept_changes.pop(resourceId, None)
+            annotations.delete_series(resourceId)
+            series_index.forget(resourceId)
+        elif level == orthanc.ResourceType.INSTANCE:
+            instance_deleted(resourceId)
+    elif (
+        changeType == orthanc.ChangeType.UPDATED_ATTACHMENT
+        and level == orthanc.ResourceType.INSTANCE
+    ):
+        # e.g. the thumbnail uploaded by the dicomizer after the instance
+        invalidate_attachments({resourceId})
+
+
+orthanc.RegisterOnChangeCallback(OnChange)
+extension = """
+    $('#series').live('pagebeforeshow', function() {
+      var seriesId = $.mobile.pageData.uuid;
+    
+      GetResource('/spectraloptica/' + seriesId + '/is-spectral', function(answer) {
+
+        if (answer['spectral']) {
+          $('#spectraloptica-button').remove();
+
+          var b = $('<a>')
+              .attr('id', 'spectraloptica-button')
+              .attr('data-role', 'button')
+              .attr('href', '#')
+              .attr('data-icon', 'search')
+              .attr('data-theme', 'e')
+              .text('Spectraloptica Viewer')
+              .button();
+
+          b.insertAfter($('#series-info'));
+          b.click(function(e) {
+            window.open('../spectraloptica/ui/index.html?series=' + seriesId);
+          })
+        }
       });
     });
     """
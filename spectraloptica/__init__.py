@@ -0,0 +1,43 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Code shared by the Orthanc plugin and the gateway."""
+
+from . import contrast, decomposition, registration
+from .annotations import AnnotationStore, Conflict
+from .expression import BandExpression
+from .geometry import measure, parse_pixel_spacing
+from .manifest import (
+    DEFAULT_BAND_BOUNDARIES,
+    band_name,
+    build_manifest,
+    classify,
+    parse_band,
+)
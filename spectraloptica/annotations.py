@@ -0,0 +1,336 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Annotations drawn on the images of a series, kept in a SQLite database with an
+R-tree index of their bounding boxes.
+
+An annotation is a JSON object such as
+
+    {"geometry": {"type": "polygon", "points": [[x, y], ...]},
+     "band": "<instance ID>", "properties": {"label": "ink"}}
+
+in pixel coordinates. Without a band, it applies to all the images of its series.
+Every change to a series increments its revision, and the annotations carry the
+revision of their last change, so that clients fetch only what changed since the
+revision they know. Deleted annotations are kept as tombstones for that purpose,
+and are listed along with the annotations that changed out of the viewport of
+the client.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+GEOMETRY_TYPES = {"point": 1, "polyline": 2, "polygon": 3, "rectangle": 2}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    id INTEGER PRIMARY KEY,
+    series TEXT NOT NULL,
+    band TEXT,
+    geometry TEXT NOT NULL,
+    properties TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS annotations_revision ON annotations (series, revision);
+CREATE VIRTUAL TABLE IF NOT EXISTS annotations_bbox
+    USING rtree(id, min_x, max_x, min_y, max_y);
+CREATE TABLE IF NOT EXISTS series_revisions (
+    series TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL
+);
+"""
+
+
+class Conflict(Exception):
+    """An annotation changed since the revision its client knows."""
+
+
+def validate(annotation) -> tuple:
+    """Return the (band, geometry, properties, bounding box) of an annotation."""
+    if not isinstance(annotation, dict):
+        raise ValueError("An annotation must be a JSON object")
+    geometry = annotation.get("geometry")
+    if not isinstance(geometry, dict) or geometry.get("type") not in GEOMETRY_TYPES:
+        raise ValueError(
+            f"The geometry type must be one of {', '.join(GEOMETRY_TYPES)}"
+        )
+    points = geometry.get("points")
+    try:
+        points = [(float(x), float(y)) for x, y in points]
+    except (TypeError, ValueError):
+        raise ValueError("The geometry points must be [x, y] pairs")
+    if len(points) < GEOMETRY_TYPES[geometry["type"]]:
+        raise ValueError(f"Too few points for a {geometry['type']}")
+    band = annotation.get("band")
+    if band is not None and not isinstance(band, str):
+        raise ValueError("The band must be an instance ID")
+    properties = annotation.get("properties", {})
+    if not isinstance(properties, dict):
+        raise ValueError("The properties must be a JSON object")
+    xs, ys = zip(*points)
+    bbox = (min(xs), max(xs), min(ys), max(ys))
+    geometry = {"type": geometry["type"], "points": [list(p) for p in points]}
+    return band, geometry, properties, bbox
+
+
+class AnnotationStore:
+    """Thread-safe store of the annotations of all the series."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # a connection per thread, SQLite connections cannot be shared
+        if not hasattr(self.local, "db"):
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return self.local.db
+
+    def transaction(self, mode="IMMEDIATE"):
+        return Transaction(self.db, mode)
+
+    @staticmethod
+    def next_revision(db, series) -> int:
+        db.execute(
+            "INSERT INTO series_revisions VALUES (?, 1) ON CONFLICT (series) "
+            "DO UPDATE SET revision = revision + 1",
+            (series,),
+        )
+        return db.execute(
+            "SELECT revision FROM series_revisions WHERE series = ?", (series,)
+        ).fetchone()[0]
+
+    def revision(self, series) -> int:
+        row = self.db.execute(
+            "SELECT revision FROM series_revisions WHERE series = ?", (series,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def to_json(row) -> dict:
+        return {
+            "id": row["id"],
+            "band": row["band"],
+            "geometry": json.loads(row["geometry"]),
+            "properties": json.loads(row["properties"]),
+            "revision": row["revision"],
+            "updated": row["updated"],
+        }
+
+    def create(self, series, annotations) -> list:
+        """Store new annotations, all with the same revision."""
+        validated = [validate(annotation) for annotation in annotations]
+        with self.transaction() as db:
+            revision = self.next_revision(db, series)
+            ids = []
+            for band, geometry, properties, bbox in validated:
+                cursor = db.execute(
+                    "INSERT INTO annotations "
+                    "(series, band, geometry, properties, revision, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        series,
+                        band,
+                        json.dumps(geometry),
+                        json.dumps(properties),
+                        revision,
+                        time.time(),
+                    ),
+                )
+                db.execute(
+                    "INSERT INTO annotations_bbox VALUES (?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, *bbox),
+                )
+                ids.append(cursor.lastrowid)
+        return [self.get(series, id) for id in ids]
+
+    def get(self, series, id) -> dict:
+        row = self.db.execute(
+            "SELECT * FROM annotations WHERE series = ? AND id = ? AND NOT deleted",
+            (series, id),
+        ).fetchone()
+        return self.to_json(row) if row else None
+
+    def check_revision(self, db, series, id, revision):
+        row = db.execute(
+            "SELECT revision FROM annotations "
+            "WHERE series = ? AND id = ? AND NOT deleted",
+            (series, id),
+        ).fetchone()
+        if row is None:
+            raise KeyError(id)
+        if revision is not None and row[0] != revision:
+            raise Conflict(f"Annotation {id} changed at revision {row[0]}")
+
+    def update(self, series, id, annotation, revision=None) -> dict:
+        """Replace an annotation, if its revision is still `revision` when given."""
+        band, geometry, properties, bbox = validate(annotation)
+        with self.transaction() as db:
+            self.check_revision(db, series, id, revision)
+            db.execute(
+                "UPDATE annotations SET band = ?, geometry = ?, properties = ?, "
+                "revision = ?, updated = ? WHERE id = ?",
+                (
+                    band,
+                    json.dumps(geometry),
+                    json.dumps(properties),
+                    self.next_revision(db, series),
+                    time.time(),
+                    id,
+                ),
+            )
+            db.execute(
+                "UPDATE annotations_bbox SET min_x = ?, max_x = ?, min_y = ?, "
+                "max_y = ? WHERE id = ?",
+                (*bbox, id),
+            )
+        return self.get(series, id)
+
+    def delete(self, series, id, revision=None):
+        with self.transaction() as db:
+            self.check_revision(db, series, id, revision)
+            # a tombstone tells the clients in sync that the annotation is gone
+            db.execute(
+                "UPDATE annotations SET deleted = 1, revision = ?, updated = ? "
+                "WHERE id = ?",
+                (self.next_revision(db, series), time.time(), id),
+            )
+            db.execute("DELETE FROM annotations_bbox WHERE id = ?", (id,))
+
+    def query(self, series, bbox=None, band=None, since=None) -> dict:
+        """
+        List the annotations of a series intersecting a (min_x, min_y, max_x,
+        max_y) box and shown on a band. Since a revision, list those that changed
+        and the IDs of those deleted or changed out of the box or the band.
+        """
+        if since is not None:
+            return self.query_changes(series, bbox, band, since)
+        conditions = ["a.series = ?", "NOT a.deleted"]
+        parameters = [series]
+        if band is not None:
+            conditions.append("(a.band IS NULL OR a.band = ?)")
+            parameters.append(band)
+        if bbox is None:
+            sql = "SELECT a.* FROM annotations a"
+        else:
+            sql = "SELECT a.* FROM annotations_bbox b JOIN annotations a USING (id)"
+            min_x, min_y, max_x, max_y = bbox
+            conditions.append(
+                "b.min_x <= ? AND b.max_x >= ? AND b.min_y <= ? AND b.max_y >= ?"
+            )
+            parameters.extend([max_x, min_x, max_y, min_y])
+        with self.transaction("DEFERRED") as db:
+            # the revision and the rows are read from the same snapshot
+            revision = self.revision(series)
+            rows = db.execute(
+                f"{sql} WHERE {' AND '.join(conditions)} ORDER BY a.id", parameters
+            ).fetchall()
+        return {
+            "revision": revision,
+            "annotations": [self.to_json(row) for row in rows],
+        }
+
+    def query_changes(self, series, bbox, band, since) -> dict:
+        # tombstones have no bounding box, and an annotation moved out of the
+        # box must be reported too: the changes are read by revision, and only
+        # then filtered
+        with self.transaction("DEFERRED") as db:
+            revision = self.revision(series)
+            rows = db.execute(
+                "SELECT a.*, b.min_x, b.max_x, b.min_y, b.max_y FROM annotations a "
+                "LEFT JOIN annotations_bbox b USING (id) "
+                "WHERE a.series = ? AND a.revision > ? ORDER BY a.id",
+                (series, since),
+            ).fetchall()
+        result = {"revision": revision, "annotations": [], "deleted": []}
+        for row in rows:
+            if row["deleted"]:
+                shown = False
+            elif band is not None and row["band"] not in (None, band):
+                shown = False
+            elif bbox is not None:
+                min_x, min_y, max_x, max_y = bbox
+                shown = (
+                    row["min_x"] <= max_x
+                    and row["max_x"] >= min_x
+                    and row["min_y"] <= max_y
+                    and row["max_y"] >= min_y
+                )
+            else:
+                shown = True
+            if shown:
+                result["annotations"].append(self.to_json(row))
+            else:
+                result["deleted"].append(row["id"])
+        return result
+
+    def delete_series(self, series):
+        with self.transaction() as db:
+            db.execute(
+                "DELETE FROM annotations_bbox WHERE id IN "
+                "(SELECT id FROM annotations WHERE series = ?)",
+                (series,),
+            )
+            db.execute("DELETE FROM annotations WHERE series = ?", (series,))
+            db.execute("DELETE FROM series_revisions WHERE series = ?", (series,))
+
+
+class Transaction:
+    """Context manager of a transaction, rolled back on errors.
+
+    IMMEDIATE transactions take the write lock at once, so that concurrent
+    writers wait for each other instead of failing to upgrade their lock.
+    """
+
+    def __init__(self, db, mode):
+        self.db = db
+        self.mode = mode
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.db.execute(f"BEGIN {self.mode}")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
@@ -0,0 +1,166 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Contrast enhancement of 8-bit images: percentile stretches and gamma, both as
+lookup tables of the 256 values, and contrast limited adaptive histogram
+equalization (CLAHE).
+
+A stretch is given as "pLOW-HIGH", e.g. "p2-98", mapping the LOW and HIGH
+percentiles of the histogram of an image to black and white, or as "auto".
+"""
+
+import re
+
+import numpy as np
+
+# percentiles listed in the statistics of an image
+PERCENTILES = (0.5, 1, 2, 5, 25, 50, 75, 95, 98, 99, 99.5)
+
+AUTO_STRETCH = (1.0, 99.0)
+
+STRETCH_PATTERN = re.compile(r"p([0-9]+(?:\.[0-9]*)?)-([0-9]+(?:\.[0-9]*)?)")
+
+
+def histogram(array) -> np.ndarray:
+    """The 256 counts of the values of a uint8 image."""
+    return np.bincount(array.ravel(), minlength=256)
+
+
+def percentile(counts, q) -> int:
+    """The value below which `q` percent of the pixels of a histogram fall."""
+    cumulative = np.cumsum(counts)
+    return int(np.searchsorted(cumulative, cumulative[-1] * q / 100))
+
+
+def describe(counts) -> dict:
+    """Statistics of an image, from its histogram."""
+    counts = np.asarray(counts)
+    values = np.flatnonzero(counts)
+    total = int(counts.sum())
+    return {
+        "histogram": counts.tolist(),
+        "percentiles": {f"{q:g}": percentile(counts, q) for q in PERCENTILES},
+        "min": int(values[0]) if total else 0,
+        "max": int(values[-1]) if total else 0,
+        "mean": float(np.dot(counts, np.arange(256)) / total) if total else 0.0,
+    }
+
+
+def parse_stretch(value) -> tuple:
+    """The (low, high) percentiles of a stretch, or None for "none"."""
+    if value == "none":
+        return None
+    if value == "auto":
+        return AUTO_STRETCH
+    match = STRETCH_PATTERN.fullmatch(value)
+    if match is None:
+        raise ValueError(f"Invalid stretch: {value}")
+    low, high = float(match[1]), float(match[2])
+    if not 0 <= low < high <= 100:
+        raise ValueError(f"Invalid stretch: {value}")
+    return low, high
+
+
+def stretch_table(low, high) -> np.ndarray:
+    """Lookup table mapping the values from `low` to `high` to 0 to 255."""
+    scale = 255.0 / (high - low) if high > low else 0.0
+    values = (np.arange(256, dtype=np.float64) - low) * scale
+    return np.clip(np.round(values), 0, 255).astype(np.uint8)
+
+
+def gamma_table(gamma) -> np.ndarray:
+    """Lookup table of a gamma correction, brightening dark tones above 1."""
+    values = 255.0 * (np.arange(256) / 255.0) ** (1.0 / gamma)
+    return np.clip(np.round(values), 0, 255).astype(np.uint8)
+
+
+def grid(size, tiles) -> np.ndarray:
+    """Bounds of `tiles` contextual regions along a side of `size` pixels."""
+    return np.linspace(0, size, tiles + 1).round().astype(np.intp)
+
+
+def clahe_tables(array, tiles=8, clip_limit=2.0) -> np.ndarray:
+    """
+    Equalization tables of the (tiles, tiles) contextual regions of a 2D uint8
+    image, as a (tiles, tiles, 256) array. Histograms are clipped at
+    `clip_limit` times their mean count, the excess spread over all values.
+    """
+    height, width = array.shape
+    rows, columns = grid(height, tiles), grid(width, tiles)
+    tables = np.empty((tiles, tiles, 256), np.uint8)
+    for i in range(tiles):
+        for j in range(tiles):
+            region = array[rows[i] : rows[i + 1], columns[j] : columns[j + 1]]
+            counts = histogram(region).astype(np.float64)
+            total = max(region.size, 1)
+            limit = max(clip_limit * total / 256, 1.0)
+            excess = np.maximum(counts - limit, 0).sum()
+            counts = np.minimum(counts, limit) + excess / 256
+            values = np.cumsum(counts) * (255.0 / total)
+            tables[i, j] = np.clip(np.round(values), 0, 255)
+    return tables
+
+
+def apply_clahe(
+    array, tables, x=0, y=0, width=None, height=None, chunk_rows=256
+) -> np.ndarray:
+    """
+    Equalize an image, or the region of an image of (width, height) at (x, y),
+    interpolating bilinearly between the tables of the nearest regions. The
+    channels of color images are all mapped by the tables of the luminance.
+    """
+    rows, columns = array.shape[:2]
+    width = columns if width is None else width
+    height = rows if height is None else height
+    tiles = tables.shape[0]
+
+    def neighbours(start, count, size):
+        # the two regions around each pixel, and the weight of the second one
+        position = (np.arange(start, start + count) + 0.5) * tiles / size - 0.5
+        first = np.clip(np.floor(position), 0, tiles - 1).astype(np.intp)
+        second = np.minimum(first + 1, tiles - 1)
+        return first, second, np.clip(position - first, 0, 1).astype(np.float32)
+
+    left, right, wx = neighbours(x, columns, width)
+    if array.ndim == 3:
+        left, right, wx = left[:, None], right[:, None], wx[:, None]
+    result = np.empty_like(array)
+    for row in range(0, rows, chunk_rows):
+        values = array[row : row + chunk_rows]
+        top, bottom, wy = neighbours(y + row, len(values), height)
+        shape = (-1,) + (1,) * (array.ndim - 1)
+        top, bottom, wy = top.reshape(shape), bottom.reshape(shape), wy.reshape(shape)
+        upper = tables[top, left, values] * (1 - wx) + tables[top, right, values] * wx
+        lower = (
+            tables[bottom, left, values] * (1 - wx) + tables[bottom, right, values] * wx
+        )
+        result[row : row + chunk_rows] = np.round(upper * (1 - wy) + lower * wy)
+    return result
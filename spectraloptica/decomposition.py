@@ -0,0 +1,109 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Principal component analysis (PCA) and minimum noise fraction (MNF) of a stack
+of bands, which bring out faded inks and underdrawings.
+
+The statistics of the stack are accumulated chunk by chunk, so that memory
+stays bounded whatever its size. Transforms are (bands, components) matrices,
+whose columns project the bands, minus their mean, onto a component. The
+eigenvalue of a component is its variance, in units of noise for MNF.
+"""
+
+import numpy as np
+
+# subtracted from uint8 values before accumulating their products, which
+# keeps the sums small enough not to lose precision
+OFFSET = 128.0
+
+
+def band_statistics(chunks) -> tuple:
+    """
+    Return the (mean, covariance, noise covariance) of the bands of a stack,
+    given as (bands, rows, columns) chunks. The noise is estimated from the
+    differences between neighbouring pixels of a row.
+    """
+    count = noise_count = 0
+    for chunk in chunks:
+        values = chunk.reshape(chunk.shape[0], -1).astype(np.float64) - OFFSET
+        if not count:
+            sums = np.zeros(values.shape[0])
+            products = np.zeros((values.shape[0], values.shape[0]))
+            noise_products = np.zeros_like(products)
+        count += values.shape[1]
+        sums += values.sum(axis=1)
+        products += values @ values.T
+        differences = np.diff(chunk.astype(np.float64), axis=2)
+        differences = differences.reshape(chunk.shape[0], -1)
+        noise_count += differences.shape[1]
+        noise_products += differences @ differences.T
+    if not count:
+        raise ValueError("The stack is empty")
+    mean = sums / count
+    covariance = products / count - np.outer(mean, mean)
+    # the difference of two pixels has twice the variance of their noise
+    noise_covariance = noise_products / (2 * max(noise_count, 1))
+    return mean + OFFSET, covariance, noise_covariance
+
+
+def orient(transform) -> np.ndarray:
+    """Make the largest coefficient of every component positive, for stable signs."""
+    rows = np.argmax(np.abs(transform), axis=0)
+    signs = np.sign(transform[rows, np.arange(transform.shape[1])])
+    return transform * np.where(signs == 0, 1, signs)
+
+
+def pca(covariance) -> tuple:
+    """The (eigenvalues, transform) of the principal components, by variance."""
+    eigenvalues, vectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1]
+    return np.maximum(eigenvalues[order], 0), orient(vectors[:, order])
+
+
+def mnf(covariance, noise_covariance) -> tuple:
+    """
+    The (eigenvalues, transform) of the minimum noise fraction components, by
+    signal to noise ratio: PCA of the bands after whitening their noise.
+    """
+    # quantized bands may have no measurable noise at all
+    noise_covariance = noise_covariance + np.eye(len(noise_covariance)) * max(
+        np.trace(noise_covariance) / len(noise_covariance) * 1e-6, 1e-12
+    )
+    noise_eigenvalues, noise_vectors = np.linalg.eigh(noise_covariance)
+    whitening = noise_vectors / np.sqrt(np.maximum(noise_eigenvalues, 1e-12))
+    eigenvalues, vectors = pca(whitening.T @ covariance @ whitening)
+    return eigenvalues, orient(whitening @ vectors)
+
+
+def project(chunk, mean, vector) -> np.ndarray:
+    """Values of a component over a (bands, rows, columns) chunk of the stack."""
+    values = np.tensordot(vector.astype(np.float32), chunk, axes=(0, 0))
+    return values - np.float32(np.dot(vector, mean))
@@ -0,0 +1,181 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Arithmetic over the bands of a series, for composites such as `w940 / w550`.
+
+Expressions are parsed by the Python parser, but never evaluated by Python:
+only the numbers, bands, operators and functions listed here are accepted, and
+they are computed with numpy over float32 arrays.
+"""
+
+import ast
+import re
+
+import numpy as np
+
+# longest expression accepted, and deepest nesting of its operations
+MAX_LENGTH = 1000
+MAX_DEPTH = 100
+
+
+def find_band(manifest, reference):
+    """Find the manifest image of a band, from its instance ID or label."""
+    for image in manifest["spectralImages"]:
+        if reference in (image["name"], image["label"]):
+            return image
+    for image in manifest["individualImages"].values():
+        if reference in (image["name"], image["label"]):
+            return image
+    raise ValueError(f"Unknown band: {reference}")
+
+
+class BandExpression:
+    """
+    Arithmetic over the bands of a series, e.g. `w940 / w550` or `abs(b0 - b3)`.
+
+    Bands are named `w<nm>` by illumination wavelength (`w365_5` for 365.5 nm),
+    `b<index>` by position in spectralImages, or `band("<instance or label>")`.
+    """
+
+    # name -> (function, number of arguments)
+    FUNCTIONS = {
+        "abs": (np.abs, 1),
+        "sqrt": (np.sqrt, 1),
+        "log": (np.log, 1),
+        "min": (np.minimum, 2),
+        "max": (np.maximum, 2),
+    }
+    OPERATORS = {
+        ast.Add: np.add,
+        ast.Sub: np.subtract,
+        ast.Mult: np.multiply,
+        ast.Div: np.divide,
+        ast.Pow: np.power,
+    }
+
+    def __init__(self, source, manifest):
+        self.source = source
+        self.manifest = manifest
+        if len(source) > MAX_LENGTH:
+            raise ValueError(f"Expressions are limited to {MAX_LENGTH} characters")
+        try:
+            self.tree = ast.parse(source, mode="eval").body
+        except SyntaxError:
+            raise ValueError(f"Invalid expression: {source}")
+        self.bands = dict()
+        self.collect(self.tree)
+        if not self.bands:
+            raise ValueError(f"No band in expression: {source}")
+
+    @property
+    def is_band(self) -> bool:
+        return isinstance(self.tree, ast.Name) or self.is_band_call(self.tree)
+
+    def is_band_call(self, node) -> bool:
+        return (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id == "band"
+        )
+
+    def resolve(self, node) -> str:
+        if self.is_band_call(node):
+            if (
+                len(node.args) != 1
+                or not isinstance(node.args[0], ast.Constant)
+                or not isinstance(node.args[0].value, str)
+            ):
+                raise ValueError('band() takes a single string: band("<id>")')
+            return find_band(self.manifest, node.args[0].value)["name"]
+
+        name = node.id
+        spectral = self.manifest["spectralImages"]
+        if re.fullmatch(r"b[0-9]+", name):
+            index = int(name[1:])
+            if index >= len(spectral):
+                raise ValueError(f"Unknown band: {name}")
+            return spectral[index]["name"]
+        if re.fullmatch(r"w[0-9]+(_[0-9]+)?", name):
+            wavelength = float(name[1:].replace("_", "."))
+            for image in spectral:
+                if image["wavelength"]["value"] == wavelength:
+                    return image["name"]
+        raise ValueError(f"Unknown band: {name}")
+
+    def collect(self, node, depth=0):
+        if depth > MAX_DEPTH:
+            raise ValueError(
+                f"Expressions are limited to {MAX_DEPTH} nested operations"
+            )
+        if isinstance(node, ast.Name) or self.is_band_call(node):
+            self.bands[ast.dump(node)] = self.resolve(node)
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)):
+                raise ValueError(f"Invalid constant: {node.value!r}")
+        elif isinstance(node, ast.BinOp) and type(node.op) in self.OPERATORS:
+            self.collect(node.left, depth + 1)
+            self.collect(node.right, depth + 1)
+        elif isinstance(node, ast.UnaryOp) and isinstance(
+            node.op, (ast.USub, ast.UAdd)
+        ):
+            self.collect(node.operand, depth + 1)
+        elif (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in self.FUNCTIONS
+            and len(node.args) == self.FUNCTIONS[node.func.id][1]
+            and not node.keywords
+        ):
+            for argument in node.args:
+                self.collect(argument, depth + 1)
+        else:
+            raise ValueError(f"Unsupported expression: {ast.unparse(node)}")
+
+    def evaluate(self, get_band):
+        # overflows and divisions by zero give infinities or NaNs, not warnings
+        with np.errstate(all="ignore"):
+            return self.visit(self.tree, get_band)
+
+    def visit(self, node, get_band):
+        if isinstance(node, ast.Name) or self.is_band_call(node):
+            return get_band(self.bands[ast.dump(node)]).astype(np.float32)
+        if isinstance(node, ast.Constant):
+            return np.float32(node.value)
+        if isinstance(node, ast.BinOp):
+            return self.OPERATORS[type(node.op)](
+                self.visit(node.left, get_band), self.visit(node.right, get_band)
+            )
+        if isinstance(node, ast.UnaryOp):
+            operand = self.visit(node.operand, get_band)
+            return -operand if isinstance(node.op, ast.USub) else operand
+        return self.FUNCTIONS[node.func.id][0](
+            *[self.visit(argument, get_band) for argument in node.args]
+        )
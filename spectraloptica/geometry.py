@@ -0,0 +1,123 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Physical measurements on the images of a series, given their pixel spacing.
+
+Coordinates are in pixels, as (x, y) pairs. Like the position of a landmark,
+x is scaled by the first value of PixelSpacing and y by the second, giving
+millimeters. Every kind of shape of a batch is measured at once, the shapes of
+various lengths being concatenated in a single array.
+"""
+
+import numpy as np
+
+
+def parse_pixel_spacing(value) -> np.ndarray:
+    """The (x, y) spacing of a `PixelSpacing` simplified tag, e.g. "0.1\\0.1"."""
+    spacing = np.array([float(part) for part in value.split("\\")])
+    if spacing.shape != (2,):
+        raise ValueError(f"Invalid PixelSpacing: {value}")
+    return spacing
+
+
+def to_points(shape, name, minimum=1) -> np.ndarray:
+    """Validate a list of [x, y] pairs, returning them as a (n, 2) array."""
+    try:
+        points = np.array(shape, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {name}: expected [x, y] points")
+    if points.ndim != 2 or points.shape[1] != 2 or len(points) < minimum:
+        raise ValueError(f"Invalid {name}: expected at least {minimum} [x, y] points")
+    return points
+
+
+def concatenate(shapes, name, minimum):
+    """All the vertices of a list of shapes and the index of their first vertex."""
+    if not isinstance(shapes, list):
+        raise ValueError(f"Invalid {name}: expected a list of shapes")
+    arrays = [to_points(shape, name, minimum) for shape in shapes]
+    starts = np.cumsum([0] + [len(array) for array in arrays[:-1]])
+    return np.concatenate(arrays), starts
+
+
+def path_lengths(vertices, starts, closed) -> np.ndarray:
+    """Length of each path of a batch, closing them back to their start if asked."""
+    ends = np.append(starts[1:], len(vertices))
+    # the segment to the next vertex, or back to the first one of the shape
+    following = np.arange(1, len(vertices) + 1)
+    following[ends - 1] = starts if closed else ends - 1
+    segments = np.hypot(*(vertices[following] - vertices).T)
+    return np.add.reduceat(segments, starts)
+
+
+def polygon_areas(vertices, starts) -> np.ndarray:
+    """Area of each polygon of a batch, with the shoelace formula."""
+    ends = np.append(starts[1:], len(vertices))
+    following = np.arange(1, len(vertices) + 1)
+    following[ends - 1] = starts
+    x, y = vertices.T
+    cross = x * y[following] - x[following] * y
+    return np.abs(np.add.reduceat(cross, starts)) / 2
+
+
+def measure(body, pixel_spacing) -> dict:
+    """
+    Measure a batch of `points`, `distances` (pairs of points), `polylines` and
+    `polygons`, in millimeters given the (x, y) spacing of the pixels.
+    """
+    result = {"unit": "mm"}
+
+    points = body.get("points", [])
+    if points:
+        result["points"] = (to_points(points, "points") * pixel_spacing).tolist()
+
+    for name, minimum in (("distances", 2), ("polylines", 2)):
+        shapes = body.get(name, [])
+        if not shapes:
+            continue
+        vertices, starts = concatenate(shapes, name, minimum)
+        if name == "distances" and len(vertices) != 2 * len(starts):
+            raise ValueError("Invalid distances: expected pairs of [x, y] points")
+        lengths = path_lengths(vertices * pixel_spacing, starts, closed=False)
+        result[name] = lengths.tolist()
+
+    polygons = body.get("polygons", [])
+    if polygons:
+        vertices, starts = concatenate(polygons, "polygons", 3)
+        vertices = vertices * pixel_spacing
+        result["polygons"] = [
+            {"area": area, "perimeter": perimeter}
+            for area, perimeter in zip(
+                polygon_areas(vertices, starts).tolist(),
+                path_lengths(vertices, starts, closed=True).tolist(),
+            )
+        ]
+    return result
@@ -0,0 +1,174 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+The manifest of a series, listing its spectral images by wavelength and its
+individual images by label, built from the `instances-tags?simplify` of Orthanc.
+
+Images are named by their instance ID, or `<instance ID>/frames/<index>` for the
+frames of a multi-frame instance, whose band is described by its item of the
+PerFrameFunctionalGroupsSequence.
+"""
+
+import numpy as np
+
+# wavelengths, in nm, below which light is UV and above which it is IR
+DEFAULT_BAND_BOUNDARIES = (400.0, 700.0)
+
+BAND_TYPES = np.array(["UV", "VIS", "IR"])
+
+# tags without which an instance cannot be shown
+REQUIRED_TAGS = ("UserContentLabel", "ImageType", "Rows", "Columns")
+
+
+# tags describing the band of a frame, in its functional groups
+FRAME_TAGS = ("IlluminationWaveLength", "ImagePathFilterPassThroughWavelength")
+
+
+def band_name(instance, frame) -> str:
+    """Name of the image of a frame of a multi-frame instance."""
+    return f"{instance}/frames/{frame}"
+
+
+def parse_band(name) -> tuple:
+    """Return the (instance ID, frame index or None) of the name of an image."""
+    instance, separator, frame = name.partition("/frames/")
+    return (instance, int(frame)) if separator else (name, None)
+
+
+def expand_frames(instances_tags) -> dict:
+    """Tags of every image, the frames of multi-frame instances on their own."""
+    expanded = dict()
+    for instance, tags in instances_tags.items():
+        frames = tags.get("PerFrameFunctionalGroupsSequence")
+        if not frames:
+            expanded[instance] = tags
+            continue
+        shared = {
+            tag: value
+            for tag, value in tags.items()
+            if tag != "PerFrameFunctionalGroupsSequence" and tag not in FRAME_TAGS
+        }
+        for index, item in enumerate(frames):
+            frame_tags = dict(shared)
+            for tag in FRAME_TAGS:
+                if tag in item:
+                    frame_tags[tag] = item[tag]
+            content = item.get("FrameContentSequence")
+            if content and "FrameLabel" in content[0]:
+                frame_tags["UserContentLabel"] = content[0]["FrameLabel"]
+            expanded[band_name(instance, index)] = frame_tags
+    return expanded
+
+
+def to_floats(values) -> np.ndarray:
+    """Parse tag values, missing or malformed ones becoming NaN."""
+    try:
+        return np.array(values, dtype=np.float64)
+    except ValueError:
+        parsed = np.full(len(values), np.nan)
+        for index, value in enumerate(values):
+            try:
+                parsed[index] = float(value)
+            except ValueError:
+                pass
+        return parsed
+
+
+def classify(wavelengths, boundaries=DEFAULT_BAND_BOUNDARIES) -> np.ndarray:
+    """Type of light of an array of wavelengths in nm, VIS where they are NaN."""
+    low, high = boundaries
+    # NaN compares as False, which leaves it in the VIS band
+    return BAND_TYPES[1 - (wavelengths < low) + (wavelengths > high)]
+
+
+def build_manifest(
+    instances_tags, boundaries=DEFAULT_BAND_BOUNDARIES, thumbnails=True, warn=None
+) -> dict:
+    """
+    Build the manifest of a series from the simplified tags of its instances,
+    by Orthanc ID. Instances lacking required tags are skipped, and reported to
+    `warn` if given.
+    """
+    instances = []
+    for instance, tags in expand_frames(instances_tags).items():
+        missing = [tag for tag in REQUIRED_TAGS if tag not in tags]
+        if missing:
+            if warn is not None:
+                warn(f"Instance {instance} lacks {', '.join(missing)}")
+            continue
+        instances.append((instance, tags))
+    if not instances:
+        return {
+            "spectralImages": [],
+            "individualImages": {},
+            "size": {"height": 0, "width": 0},
+            "thumbnails": thumbnails,
+        }
+
+    # a single pass over the tags, extracting the columns of the manifest
+    names, labels, spectral, filters, wavelengths = zip(
+        *(
+            (
+                instance,
+                tags["UserContentLabel"],
+                "WAVELENGTH" in tags["ImageType"],
+                tags.get("ImagePathFilterPassThroughWavelength") or "nan",
+                tags.get("IlluminationWaveLength") or "nan",
+            )
+            for instance, tags in instances
+        )
+    )
+    wavelengths = to_floats(wavelengths)
+    filter_types = classify(to_floats(filters), boundaries).tolist()
+    wavelength_types = classify(wavelengths, boundaries).tolist()
+    values = [None if np.isnan(value) else value for value in wavelengths.tolist()]
+
+    def image(index):
+        return {
+            "name": names[index],
+            "label": labels[index],
+            "filter": {"type": filter_types[index], "description": ""},
+            "wavelength": {"type": wavelength_types[index], "value": values[index]},
+        }
+
+    spectral = np.array(spectral)
+    # stable sort by wavelength, the images without one last
+    order = np.flatnonzero(spectral)
+    order = order[np.argsort(wavelengths[order], kind="stable")]
+    _, last_tags = instances[-1]
+    return {
+        "spectralImages": [image(index) for index in order.tolist()],
+        "individualImages": {
+            labels[index]: image(index) for index in np.flatnonzero(~spectral).tolist()
+        },
+        "size": {"height": last_tags["Rows"], "width": last_tags["Columns"]},
+        "thumbnails": thumbnails,
+    }
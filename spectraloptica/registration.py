@@ -0,0 +1,150 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Co-registration of the bands of a series onto a reference band.
+
+Transforms are 2x3 affine matrices mapping the pixel coordinates (x, y) of a
+band to those of the reference band. Phase correlation only estimates their
+translation, which is what moves between captures on a fixed camera stand.
+"""
+
+import numpy as np
+
+IDENTITY = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+
+# rows of an image warped at once, bounding the memory of the coordinates
+WARP_CHUNK_ROWS = 256
+
+
+def phase_correlation(reference, moving) -> tuple:
+    """
+    Estimate the (dx, dy) translation of `moving` onto `reference`, two 2D
+    arrays of the same shape, with sub-pixel precision. Also return the height
+    of the correlation peak, from 0 to 1, as a confidence.
+    """
+    height, width = reference.shape
+    # a window hides the edges, which would otherwise correlate at no shift
+    window = np.outer(np.hanning(height), np.hanning(width))
+    reference = np.fft.rfft2((reference - reference.mean()) * window)
+    moving = np.fft.rfft2((moving - moving.mean()) * window)
+    cross_power = reference * np.conj(moving)
+    cross_power /= np.abs(cross_power) + 1e-12
+    correlation = np.fft.irfft2(cross_power, s=(height, width))
+
+    y, x = np.unravel_index(np.argmax(correlation), correlation.shape)
+    peak = correlation[y, x]
+
+    def refine(before, at, after):
+        # vertex of the parabola through the peak and its neighbours
+        denominator = before - 2 * at + after
+        return 0.0 if denominator == 0 else 0.5 * (before - after) / denominator
+
+    dy = y + refine(
+        correlation[(y - 1) % height, x], peak, correlation[(y + 1) % height, x]
+    )
+    dx = x + refine(
+        correlation[y, (x - 1) % width], peak, correlation[y, (x + 1) % width]
+    )
+    # shifts beyond half the size wrap around to negative ones
+    if dy > height / 2:
+        dy -= height
+    if dx > width / 2:
+        dx -= width
+    return float(dx), float(dy), float(peak)
+
+
+def estimate_transform(reference, moving) -> tuple:
+    """The affine transform of `moving` onto `reference`, and its confidence."""
+    height = min(reference.shape[0], moving.shape[0])
+    width = min(reference.shape[1], moving.shape[1])
+    dx, dy, confidence = phase_correlation(
+        reference[:height, :width].astype(np.float64),
+        moving[:height, :width].astype(np.float64),
+    )
+    matrix = IDENTITY.copy()
+    matrix[:, 2] = dx, dy
+    return matrix, confidence
+
+
+def scale_transform(matrix, scale) -> np.ndarray:
+    """The transform of the same images, resampled by `scale`."""
+    matrix = np.array(matrix, dtype=np.float64)
+    matrix[:, 2] *= scale
+    return matrix
+
+
+def shift(array, dx, dy) -> np.ndarray:
+    """Translate an image by whole pixels, filling the uncovered edges with 0."""
+    height, width = array.shape[:2]
+    result = np.zeros_like(array)
+    if abs(dx) >= width or abs(dy) >= height:
+        return result
+    result[max(dy, 0) : height + min(dy, 0), max(dx, 0) : width + min(dx, 0)] = array[
+        max(-dy, 0) : height - max(dy, 0), max(-dx, 0) : width - max(dx, 0)
+    ]
+    return result
+
+
+def warp(array, matrix) -> np.ndarray:
+    """
+    Resample an image into the frame of the reference band, given the transform
+    of its coordinates onto the reference. Pure translations move whole pixels;
+    other transforms are sampled bilinearly.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    linear, translation = matrix[:, :2], matrix[:, 2]
+    if np.allclose(linear, np.eye(2)):
+        dx, dy = np.round(translation).astype(int)
+        return array if dx == dy == 0 else shift(array, dx, dy)
+
+    # every pixel of the result is read from its antecedent in the band
+    inverse = np.linalg.inv(linear)
+    height, width = array.shape[:2]
+    squeeze = array.ndim == 2
+    source = array[:, :, np.newaxis] if squeeze else array
+    result = np.zeros_like(source)
+    xs = np.arange(width, dtype=np.float64)
+    for row in range(0, height, WARP_CHUNK_ROWS):
+        ys = np.arange(row, min(row + WARP_CHUNK_ROWS, height), dtype=np.float64)
+        x, y = np.meshgrid(xs - translation[0], ys - translation[1])
+        u = inverse[0, 0] * x + inverse[0, 1] * y
+        v = inverse[1, 0] * x + inverse[1, 1] * y
+        inside = (u >= 0) & (u <= width - 1) & (v >= 0) & (v <= height - 1)
+        u0 = np.clip(np.floor(u).astype(np.intp), 0, width - 2)
+        v0 = np.clip(np.floor(v).astype(np.intp), 0, height - 2)
+        fu = np.clip(u - u0, 0, 1)[:, :, np.newaxis]
+        fv = np.clip(v - v0, 0, 1)[:, :, np.newaxis]
+        top = source[v0, u0] * (1 - fu) + source[v0, u0 + 1] * fu
+        bottom = source[v0 + 1, u0] * (1 - fu) + source[v0 + 1, u0 + 1] * fu
+        values = top * (1 - fv) + bottom * fv
+        values[~inside] = 0
+        result[row : row + len(ys)] = np.round(values).astype(array.dtype)
+    return result[:, :, 0] if squeeze else result
@@ -0,0 +1,136 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Tests of the annotation store, and of the sync of the clients by revision."""
+
+import pytest
+
+from spectraloptica.annotations import AnnotationStore, Conflict
+
+
+def point(x, y, band=None):
+    annotation = {"geometry": {"type": "point", "points": [[x, y]]}}
+    if band is not None:
+        annotation["band"] = band
+    return annotation
+
+
+@pytest.fixture
+def store(tmp_path):
+    return AnnotationStore(str(tmp_path / "annotations.sqlite"))
+
+
+def ids(result):
+    return [annotation["id"] for annotation in result["annotations"]]
+
+
+def test_bbox_query(store):
+    inside, outside = store.create("S", [point(5, 5), point(500, 500)])
+    result = store.query("S", bbox=(0, 0, 100, 100))
+    assert ids(result) == [inside["id"]]
+    assert "deleted" not in result
+    assert ids(store.query("S")) == [inside["id"], outside["id"]]
+
+
+def test_band_query(store):
+    shared, on_b1, on_b2 = store.create(
+        "S", [point(1, 1), point(2, 2, "B1"), point(3, 3, "B2")]
+    )
+    assert ids(store.query("S", band="B1")) == [shared["id"], on_b1["id"]]
+
+
+def test_since_lists_changes_and_tombstones(store):
+    kept, deleted = store.create("S", [point(1, 1), point(2, 2)])
+    revision = store.revision("S")
+    added = store.create("S", [point(3, 3)])[0]
+    store.delete("S", deleted["id"])
+    result = store.query("S", since=revision)
+    assert ids(result) == [added["id"]]
+    assert result["deleted"] == [deleted["id"]]
+    assert result["revision"] == store.revision("S") == revision + 2
+    assert kept["id"] not in ids(result)
+
+
+def test_bbox_since_lists_tombstones(store):
+    deleted = store.create("S", [point(5, 5)])[0]
+    revision = store.revision("S")
+    store.delete("S", deleted["id"])
+    result = store.query("S", bbox=(0, 0, 100, 100), since=revision)
+    assert result["annotations"] == []
+    assert result["deleted"] == [deleted["id"]]
+
+
+def test_bbox_since_lists_annotations_moved_out(store):
+    moved, staying = store.create("S", [point(5, 5), point(6, 6)])
+    revision = store.revision("S")
+    store.update("S", moved["id"], point(500, 500))
+    store.update("S", staying["id"], point(7, 7))
+    result = store.query("S", bbox=(0, 0, 100, 100), since=revision)
+    assert ids(result) == [staying["id"]]
+    assert result["deleted"] == [moved["id"]]
+
+
+def test_band_since_lists_annotations_moved_to_another_band(store):
+    annotation = store.create("S", [point(5, 5, "B1")])[0]
+    revision = store.revision("S")
+    store.update("S", annotation["id"], point(5, 5, "B2"))
+    result = store.query("S", band="B1", since=revision)
+    assert result["annotations"] == []
+    assert result["deleted"] == [annotation["id"]]
+
+
+def test_stale_revision_conflicts(store):
+    annotation = store.create("S", [point(1, 1)])[0]
+    store.update("S", annotation["id"], point(2, 2), annotation["revision"])
+    with pytest.raises(Conflict):
+        store.update("S", annotation["id"], point(3, 3), annotation["revision"])
+    with pytest.raises(Conflict):
+        store.delete("S", annotation["id"], annotation["revision"])
+
+
+def test_invalid_annotations(store):
+    for annotation in (
+        [],
+        {"geometry": {"type": "circle", "points": [[0, 0]]}},
+        {"geometry": {"type": "polygon", "points": [[0, 0], [1, 1]]}},
+        {"geometry": {"type": "point", "points": [["x", 0]]}},
+        {"geometry": {"type": "point", "points": [[0, 0]]}, "band": 3},
+    ):
+        with pytest.raises(ValueError):
+            store.create("S", [annotation])
+
+
+def test_delete_series(store):
+    store.create("S", [point(1, 1)])
+    other = store.create("T", [point(1, 1)])[0]
+    store.delete_series("S")
+    assert store.query("S") == {"revision": 0, "annotations": []}
+    assert store.query("S", bbox=(0, 0, 10, 10))["annotations"] == []
+    assert ids(store.query("T", bbox=(0, 0, 10, 10))) == [other["id"]]
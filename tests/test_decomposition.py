@@ -0,0 +1,112 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Tests of the PCA and MNF of a synthetic stack of bands."""
+
+import numpy as np
+import pytest
+
+from spectraloptica.decomposition import band_statistics, mnf, pca, project
+
+BANDS, HEIGHT, WIDTH = 6, 64, 96
+
+
+@pytest.fixture(scope="module")
+def stack():
+    """Two smooth sources mixed into 6 bands, with noise growing by band."""
+    rng = np.random.default_rng(1)
+    y, x = np.mgrid[0:HEIGHT, 0:WIDTH]
+    sources = [
+        np.sin(x / 9.0) * np.cos(y / 13.0),
+        2 * np.exp(-((x - 50) ** 2 + (y - 30) ** 2) / 300.0),
+    ]
+    mixing = rng.random((BANDS, 2)) * 40 + 10
+    noise = rng.normal(0, 1, (BANDS, HEIGHT, WIDTH)) * np.array(
+        [0.5, 1, 2, 3, 4, 5]
+    ).reshape(-1, 1, 1)
+    cube = 120 + np.tensordot(mixing, sources, axes=(1, 0)) + noise
+    return np.clip(cube, 0, 255).astype(np.uint8), sources
+
+
+def chunks(cube, rows):
+    return [cube[:, row : row + rows] for row in range(0, cube.shape[1], rows)]
+
+
+def test_statistics_do_not_depend_on_chunks(stack):
+    cube, _ = stack
+    values = cube.reshape(BANDS, -1).astype(np.float64)
+    mean, covariance, _ = band_statistics(chunks(cube, 7))
+    assert np.allclose(mean, values.mean(axis=1))
+    assert np.allclose(covariance, np.cov(values, bias=True))
+    whole = band_statistics([cube])
+    assert np.allclose(band_statistics(chunks(cube, 10))[2], whole[2])
+
+
+def test_empty_stack():
+    with pytest.raises(ValueError):
+        band_statistics([])
+
+
+def test_pca(stack):
+    cube, _ = stack
+    mean, covariance, _ = band_statistics(chunks(cube, 16))
+    eigenvalues, transform = pca(covariance)
+    assert np.all(np.diff(eigenvalues) <= 0)
+    assert np.allclose(eigenvalues, np.linalg.eigvalsh(covariance)[::-1])
+    assert np.allclose(transform.T @ transform, np.eye(BANDS))
+    # the components are uncorrelated, with their eigenvalue as variance
+    components = np.stack(
+        [project(cube, mean, transform[:, k]).ravel() for k in range(BANDS)]
+    )
+    assert np.allclose(
+        np.cov(components, bias=True), np.diag(eigenvalues), atol=1e-3 * eigenvalues[0]
+    )
+    # signs are stable: the largest coefficient of every component is positive
+    rows = np.argmax(np.abs(transform), axis=0)
+    assert np.all(transform[rows, np.arange(BANDS)] > 0)
+
+
+def test_mnf_separates_signal_from_noise(stack):
+    cube, sources = stack
+    mean, covariance, noise_covariance = band_statistics(chunks(cube, 16))
+    eigenvalues, transform = mnf(covariance, noise_covariance)
+    assert np.all(np.diff(eigenvalues) <= 0)
+    # two sources: two components well above the noise, which has unit
+    # variance once whitened
+    assert eigenvalues[1] > 10
+    assert np.allclose(eigenvalues[2:], 1, atol=0.1)
+    components = np.stack(
+        [project(cube, mean, transform[:, k]).ravel() for k in range(2)], axis=1
+    )
+    design = np.column_stack([components, np.ones(len(components))])
+    for source in sources:
+        source = source.ravel()
+        _, residual, _, _ = np.linalg.lstsq(design, source, rcond=None)
+        assert 1 - residual[0] / ((source - source.mean()) ** 2).sum() > 0.95
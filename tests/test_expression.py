@@ -0,0 +1,129 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Tests of the band expressions of the composites, and of their whitelist."""
+
+import numpy as np
+import pytest
+
+from spectraloptica.expression import MAX_DEPTH, MAX_LENGTH, BandExpression
+
+MANIFEST = {
+    "spectralImages": [
+        {"name": "i0", "label": "uv", "wavelength": {"value": 365.0}},
+        {"name": "i1", "label": "green", "wavelength": {"value": 550.0}},
+        {"name": "i2", "label": "ir", "wavelength": {"value": 940.5}},
+    ],
+    "individualImages": {"color": {"name": "i3", "label": "color"}},
+}
+
+VALUES = {"i0": 2, "i1": 4, "i2": 8, "i3": 16}
+
+
+def evaluate(source):
+    expression = BandExpression(source, MANIFEST)
+    return expression.evaluate(lambda name: np.full((2, 2), VALUES[name], np.uint8))
+
+
+@pytest.mark.parametrize(
+    "source, value",
+    [
+        ("w550", 4),
+        ("b2", 8),
+        ("w940_5 / w365", 4),
+        ('band("color") - band("i1")', 12),
+        ("abs(b0 - b2)", 6),
+        ("max(b0, 3) * -1", -3),
+        ("sqrt(b1) + 0.5", 2.5),
+        ("b0 ** 2", 4),
+    ],
+)
+def test_evaluate(source, value):
+    result = evaluate(source)
+    assert result.dtype == np.float32
+    assert np.allclose(result, value)
+
+
+def test_bands_are_resolved_once():
+    expression = BandExpression("w550 + w550 * b1", MANIFEST)
+    assert sorted(set(expression.bands.values())) == ["i1"]
+    assert BandExpression("b1", MANIFEST).is_band
+    assert not BandExpression("b1 + 1", MANIFEST).is_band
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "__import__('os').system('true')",
+        "b0.__class__",
+        "(lambda: b0)()",
+        "[b0, b1]",
+        "b0 if b1 else b2",
+        "b0 // 2",
+        "b0 @ b1",
+        "b0 < b1",
+        "'text' * b0",
+        "abs(b0, b1)",
+        "max(b0, b1=1)",
+        "open('/etc/passwd')",
+        "band(b0)",
+        'band("missing")',
+        "b3",
+        "w551",
+        "2 ** 8",
+        "b0 +",
+    ],
+)
+def test_rejected(source):
+    with pytest.raises(ValueError):
+        BandExpression(source, MANIFEST)
+
+
+def test_exponents_stay_in_float32():
+    # a tower of powers is never computed with the integers of Python
+    result = evaluate("b1 ** 9 ** 9 ** 9 ** 9 ** 9")
+    assert result.dtype == np.float32
+    assert np.isinf(result).all()
+    assert np.isinf(evaluate("b0 ** (b2 * 1000)")).all()
+
+
+def test_size_limits():
+    with pytest.raises(ValueError):
+        BandExpression("b0 " + "+ 1 " * MAX_LENGTH, MANIFEST)
+    with pytest.raises(ValueError):
+        BandExpression("-" * (MAX_DEPTH + 1) + "b0", MANIFEST)
+    with pytest.raises(ValueError):
+        BandExpression("b0" + " ** b0" * (MAX_DEPTH + 1), MANIFEST)
+    assert np.allclose(evaluate("-" * MAX_DEPTH + "b0"), 2 * (-1) ** MAX_DEPTH)
+
+
+def test_division_by_zero():
+    result = evaluate("b0 / (b1 - 4)")
+    assert np.isinf(result).all()
@@ -0,0 +1,71 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Tests of the manifests of the series, and of the classification of their bands."""
+
+import math
+
+import numpy as np
+
+from spectraloptica.manifest import band_name, classify, parse_band, to_floats
+
+
+def test_classify_boundaries():
+    wavelengths = np.array([365.0, 399.9, 400.0, 550.0, 700.0, 700.1, 940.0])
+    assert classify(wavelengths).tolist() == [
+        "UV",
+        "UV",
+        "VIS",
+        "VIS",
+        "VIS",
+        "IR",
+        "IR",
+    ]
+
+
+def test_classify_custom_boundaries():
+    wavelengths = np.array([380.0, 420.0, 650.0, 680.0])
+    assert classify(wavelengths, (420.0, 650.0)).tolist() == [
+        "UV",
+        "VIS",
+        "VIS",
+        "IR",
+    ]
+
+
+def test_classify_unknown_wavelength_is_visible():
+    wavelengths = to_floats(["", "365", "not a number"])
+    assert math.isnan(wavelengths[0])
+    assert classify(wavelengths).tolist() == ["VIS", "UV", "VIS"]
+
+
+def test_band_names():
+    assert parse_band(band_name("abc", 3)) == ("abc", 3)
+    assert parse_band("abc") == ("abc", None)
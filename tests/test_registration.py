@@ -0,0 +1,93 @@
+# Spectraloptica - Orthanc Plugin
+
+# Copyright (C) 2025 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU Affero General Public License
+
+# as published by the Free Software Foundation, either version 3 of
+
+# the License, or (at your option) any later version.
+
+#
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# Affero General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU Affero General Public License
+
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Tests of the alignment of the bands, by phase correlation."""
+
+import numpy as np
+import pytest
+
+from spectraloptica.registration import (
+    IDENTITY,
+    estimate_transform,
+    phase_correlation,
+    scale_transform,
+    shift,
+    warp,
+)
+
+
+def smooth_noise(height, width, seed=0):
+    """Random texture, smoothed so that sub-pixel shifts are measurable."""
+    noise = np.random.default_rng(seed).random((height, width))
+    kernel = np.ones(5) / 5
+    for axis in (0, 1):
+        noise = np.apply_along_axis(np.convolve, axis, noise, kernel, "same")
+    return noise
+
+
+@pytest.mark.parametrize("dx, dy", [(0, 0), (5, -3), (-12, 7), (20, 15)])
+def test_shift_recovery(dx, dy):
+    image = smooth_noise(180, 220)
+    reference = image[30:158, 30:190]
+    # the content at (x, y) of the moving band is at (x + dx, y + dy) in the
+    # reference
+    moving = image[30 + dy : 158 + dy, 30 + dx : 190 + dx]
+    found_dx, found_dy, confidence = phase_correlation(reference, moving)
+    assert found_dx == pytest.approx(dx, abs=0.1)
+    assert found_dy == pytest.approx(dy, abs=0.1)
+    assert confidence > 0.5
+
+
+def test_warp_aligns_onto_reference():
+    image = smooth_noise(180, 220, seed=1)
+    reference = image[30:158, 30:190]
+    moving = image[27:155, 35:195]
+    matrix, _ = estimate_transform(reference, moving)
+    assert np.allclose(matrix[:, :2], IDENTITY[:, :2])
+    aligned = warp(moving, matrix)
+    assert np.allclose(aligned[10:-10, 10:-10], reference[10:-10, 10:-10])
+
+
+def test_unrelated_images_have_low_confidence():
+    reference = smooth_noise(128, 128, seed=2)
+    moving = smooth_noise(128, 128, seed=3)
+    assert phase_correlation(reference, moving)[2] < 0.2
+
+
+def test_shift_fills_edges():
+    array = np.arange(12).reshape(3, 4)
+    assert shift(array, 1, -1).tolist() == [[0, 4, 5, 6], [0, 8, 9, 10], [0, 0, 0, 0]]
+    assert not shift(array, 4, 0).any()
+
+
+def test_scale_transform():
+    matrix = IDENTITY.copy()
+    matrix[:, 2] = 8, -4
+    assert scale_transform(matrix, 0.25)[:, 2].tolist() == [2, -1]